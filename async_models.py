@@ -0,0 +1,244 @@
+"""
+async_models.py
+models の非同期版 (Firestore の AsyncClient を使う)
+
+async def のハンドラからはこちらを使う．
+RPCの間もイベントループを止めないので他のリクエストを待たせず，
+独立したクエリは asyncio.gather で同時に投げられる．
+クエリの組み立て・キャッシュ・スラッグの扱いは models と共通．
+
+Copyright (c) RightCode Inc. All rights reserved.
+"""
+from google.api_core.exceptions import AlreadyExists, NotFound
+
+from init_db import adb, async_transactional
+from cache import cached, invalidate
+import replica
+import search
+from models import (SlugAlreadyExists, LISTING_FIELDS, WHATS_NEW_FIELDS, _check_slug, _articles_query, _page_query, _page_result,
+                    _valid_cursor, _article_data, _category_writes, _renamed_articles_queries, _batches, _update_search_index,
+                    _counter_changes, _counter_refs, _write_counters, _public)
+
+
+async def add(obj):
+    """
+    Add an Article / Category / Tag to Firestore
+    slugが被っていれば SlugAlreadyExists  記事ならカテゴリ・タグの記事数も増やす
+    """
+    ref = adb.collection(obj.COLLECTION).document(obj.slug)
+    try:
+        if obj.COLLECTION == 'articles':
+            await _add_article_in_transaction(adb.transaction(), ref, obj.to_dict())
+        else:
+            await ref.create(obj.to_dict())
+    except AlreadyExists:
+        raise SlugAlreadyExists('Error: The slug "{}" has already been existed.'.format(obj.slug))
+
+    if obj.COLLECTION == 'articles':
+        invalidate('articles', 'categories', 'tags', public=_public(obj.to_dict()))
+        search.index.update(obj.to_dict())
+    else:
+        invalidate(obj.COLLECTION, public=obj.COLLECTION != 'tags')  # 記事のないタグはサイドメニューに表示しない
+
+
+async def _delete(ref):
+    """ 存在するドキュメントだけを削除 (False => 存在しない) """
+    try:
+        await ref.delete(option=adb.write_option(exists=True))
+    except NotFound:
+        return False
+    return True
+
+
+async def _get_counters(transaction, changes: dict):
+    if not changes:
+        return []
+    return [snapshot async for snapshot in await transaction.get_all(_counter_refs(changes, client=adb))]
+
+
+@async_transactional
+async def _add_article_in_transaction(transaction, ref, data: dict):
+    changes = _counter_changes(new=data)
+    snapshots = await _get_counters(transaction, changes)
+    transaction.create(ref, data)
+    _write_counters(transaction, snapshots, changes)
+
+
+@async_transactional
+async def _update_article_in_transaction(transaction, old_ref, new_ref, data: dict):
+    """ models._update_article_in_transaction の非同期版 """
+    snapshot = await old_ref.get(transaction=transaction)
+    if not snapshot.exists:
+        return None
+
+    old = snapshot.to_dict()
+    new = dict(old, **data)
+    changes = _counter_changes(old, new)
+    snapshots = await _get_counters(transaction, changes)
+    if new_ref.id != old_ref.id:
+        transaction.create(new_ref, new)
+        transaction.delete(old_ref)
+    else:
+        transaction.update(old_ref, data)
+    _write_counters(transaction, snapshots, changes)
+    return old
+
+
+@async_transactional
+async def _delete_article_in_transaction(transaction, ref):
+    snapshot = await ref.get(transaction=transaction)
+    if not snapshot.exists:
+        return None
+
+    old = snapshot.to_dict()
+    changes = _counter_changes(old=old)
+    snapshots = await _get_counters(transaction, changes)
+    transaction.delete(ref)
+    _write_counters(transaction, snapshots, changes)
+    return old
+
+
+@cached('articles')
+async def get_articles(unreleased: bool = True, category: str = None, fields: tuple = None):
+    """ models.get_articles の非同期版 """
+    if replica.active():
+        return replica.store.get_articles(unreleased, category, fields)
+
+    query = _articles_query(released_only=not unreleased, category=category, fields=fields, client=adb)
+    return [art.to_dict() async for art in query.stream()]
+
+
+@cached('articles')
+async def get_articles_page(page_size: int = 10, after: str = None, before: str = None, category: str = None,
+                            tag: str = None):
+    """ models.get_articles_page の非同期版 """
+    after, before = _valid_cursor(after), _valid_cursor(before)  # 不正な値は無視
+    if replica.active():
+        return replica.store.get_articles_page(page_size, after, before, category, LISTING_FIELDS, tag=tag)
+
+    query = _page_query(page_size, after, before, category, client=adb, tag=tag)
+    return _page_result([art.to_dict() for art in await query.get()], page_size, after, before)
+
+
+@cached('articles')
+async def get_article(slug: str):
+    """ models.get_article の非同期版 """
+    if replica.active():
+        return replica.store.get_article(slug)
+
+    article = await adb.collection('articles').document(slug).get()
+    if not article.exists:
+        return None
+
+    return article.to_dict()
+
+
+@cached('articles')
+async def get_whats_new(num: int = 5):
+    """ models.get_whats_new の非同期版 """
+    if replica.active():
+        return replica.store.get_whats_new(num, WHATS_NEW_FIELDS)
+
+    query = _articles_query(released_only=True, fields=WHATS_NEW_FIELDS, client=adb).limit(num)
+    return [art.to_dict() async for art in query.stream()]
+
+
+async def update_article_by_slug(original_slug,
+                                 title,
+                                 thumbnail,
+                                 description,
+                                 slug,
+                                 contents,
+                                 category,
+                                 tags,
+                                 release,
+                                 ):
+    """ models.update_article_by_slug の非同期版 """
+    data = _article_data(title, thumbnail, description, slug, contents, category, tags, release)
+    _check_slug(slug)
+    try:
+        old = await _update_article_in_transaction(adb.transaction(),
+                                                   adb.collection('articles').document(original_slug),
+                                                   adb.collection('articles').document(slug), data)
+    except AlreadyExists:
+        raise SlugAlreadyExists('Error: The slug "{}" has already been existed.'.format(slug))
+    invalidate('articles', 'categories', 'tags', public=old is not None and _public(old, data))
+    if old is not None:
+        _update_search_index(original_slug, data)
+    return old is not None
+
+
+async def delete_article_by_slug(slug: str):
+    """ models.delete_article_by_slug の非同期版 """
+    old = await _delete_article_in_transaction(adb.transaction(), adb.collection('articles').document(slug))
+    invalidate('articles', 'categories', 'tags', public=_public(old))
+    search.index.remove(slug)
+    return old is not None
+
+
+@cached('categories')
+async def get_categories():
+    """ models.get_categories の非同期版 """
+    if replica.active():
+        return replica.store.get_categories()
+
+    return [cat.to_dict() async for cat in adb.collection('categories').stream()]
+
+
+async def get_category_names():
+    """ models.get_category_names の非同期版 """
+    return {
+        cat['slug']: cat['name']
+        for cat in await get_categories()
+    }
+
+
+@cached('categories')
+async def get_category_name(slug):
+    """ models.get_category_name の非同期版 """
+    if replica.active():
+        return replica.store.get_category_name(slug)
+
+    category = await adb.collection('categories').document(slug).get()
+    if not category.exists:
+        return None
+
+    return category.to_dict()['name']
+
+
+async def delete_category_by_slug(slug: str):
+    """ models.delete_category_by_slug の非同期版 """
+    deleted = await _delete(adb.collection('categories').document(slug))
+    invalidate('categories')
+    return deleted
+
+
+async def update_categories(changes: dict):
+    """ models.update_categories の非同期版 """
+    current = {cat.id: cat.to_dict() async for cat in adb.collection('categories').stream()}
+    writes, renamed = _category_writes(current, changes)
+
+    for query in _renamed_articles_queries(renamed, client=adb):
+        async for art in query.stream():
+            writes.append(('update', 'articles', art.id, {'category': renamed[art.to_dict()['category']]}))
+
+    if not writes:
+        return renamed
+
+    for batch in _batches(writes, client=adb):
+        await batch.commit()
+
+    invalidate('categories')
+    if renamed:
+        invalidate('articles')
+        search.index.rebuild_later()
+    return renamed
+
+
+@cached('tags')
+async def get_tags():
+    """ models.get_tags の非同期版 """
+    if replica.active():
+        return replica.store.get_tags()
+
+    return [tag.to_dict() async for tag in adb.collection('tags').stream()]
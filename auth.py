@@ -4,69 +4,39 @@ Firebase Authentication
 Copyright (c) RightCode Inc. All rights reserved.
 """
 
-import requests
-import json
+import asyncio
 from firebase_admin import auth
 from datetime import timedelta
 from getpass import getpass
 
+from identity_toolkit import client
+
 
 def _sign_up(email, password, displayName):
-    # Api key取得
-    with open('private/apikey.txt') as f:
-        api_key = f.read()
-
-    # 管理者ユーザ追加
-    url = 'https://identitytoolkit.googleapis.com/v1/accounts:signUp?key={}'.format(api_key)
-    headers = {'Content-type': 'application/json'}
-    data = json.dumps({'email': email,
-                       'password': password,
-                       'returnSecureToken': True})
-
-    result = requests.post(url=url,
-                           headers=headers,
-                           data=data,
-                           )
-
-    if 'error' in result.json():
-        print('error: {}'.format(result.json()['error']['errors'][0]['message']))
-        return result.json()
+    # 管理者ユーザ追加 (二重に作成しないように，送信済みかもしれない場合は再試行しない)
+    result = client.post('accounts:signUp', {'email': email,
+                                             'password': password,
+                                             'returnSecureToken': True}, retry=False)
 
-    # DisplayNameを更新
-    url = 'https://identitytoolkit.googleapis.com/v1/accounts:update?key={}'.format(api_key)
-    data = json.dumps({
-        'idToken': result.json()['idToken'],
-        'displayName': displayName
-    })
+    if 'error' in result:
+        print('error: {}'.format(result['error']['errors'][0]['message']))
+        return result
 
-    result = requests.post(url=url,
-                           headers=headers,
-                           data=data,
-                           )
+    # DisplayNameを更新
+    result = client.post('accounts:update', {'idToken': result['idToken'],
+                                             'displayName': displayName})
 
-    if 'error' in result.json():
-        print('error: {}'.format(result.json()['error']['errors'][0]['message']))
-        return result.json()
+    if 'error' in result:
+        print('error: {}'.format(result['error']['errors'][0]['message']))
+        return result
 
-    return result.json()
+    return result
 
 
 def _login(email, password, expires=5):
-    with open('private/apikey.txt') as f:
-        api_key = f.read()
-
-    url = 'https://www.googleapis.com/identitytoolkit/v3/relyingparty/verifyPassword?key={}'.format(api_key)
-    headers = {'Content-type': 'application/json'}
-    data = json.dumps({'email': email,
-                       'password': password,
-                       'returnSecureToken': True})
-
-    result = requests.post(url=url,
-                           headers=headers,
-                           data=data,
-                           )
-
-    result = result.json()
+    result = client.post('accounts:signInWithPassword', {'email': email,
+                                                         'password': password,
+                                                         'returnSecureToken': True})
 
     # エラーがある場合
     if 'error' in result:
@@ -78,6 +48,20 @@ def _login(email, password, expires=5):
     return result, session_cookie
 
 
+async def _login_async(email, password, expires=5):
+    """ _login の非同期版 (async def のハンドラ用) """
+    result = await client.apost('accounts:signInWithPassword', {'email': email,
+                                                                'password': password,
+                                                                'returnSecureToken': True})
+    if 'error' in result:
+        return result, None
+
+    session_cookie = await asyncio.get_running_loop().run_in_executor(
+        None, auth.create_session_cookie, result['idToken'], timedelta(expires))
+
+    return result, session_cookie
+
+
 def _get_user(email):
     return auth.get_user_by_email(email).__dict__['_data']
 
@@ -0,0 +1,369 @@
+"""
+bench.py
+メモリ上の Firestore (fake_firestore) を使ったベンチマーク・負荷試験
+
+記事を N 件作成してから，controllers.api の全てのルートにASGIで直接リクエストを送り，
+ルートごとのスループット・レイテンシ(p50/p99)・リクエストあたりのFirestoreのRPC数・読み込んだドキュメント数を出力する．
+RPC数・ドキュメント数は，キャッシュを毎回消して1つずつ送ったリクエスト(uncached)と，
+キャッシュを使って同時に送ったリクエストの両方で数える．
+書き込むルート(WRITES)は，リクエストごとに作成直後のデータに戻してから1つずつ送る
+(書き込みでキャッシュは消えるので，uncached も同じ値になる)．
+しきい値のファイルと比較し，超えたルート・エラー(5xxなど)を返したルートがあれば終了コード1で終わる (デプロイ前の確認用)．
+
+fake_firestore は RPC を自分で記録する (metrics.instrument_firestore() は使わない) ので，
+本物のクライアントの計測が壊れていてもこのベンチマークでは分からない．そちらは tests/test_metrics.py で確認する．
+
+$ python bench.py                          全てのルートを計測してしきい値と比較
+$ python bench.py --rpc-latency 5          RPCごとに5ms待つ (ネットワークの往復の代わり)
+$ python bench.py --update-thresholds      現在の結果からしきい値のファイルを作り直す
+
+Copyright (c) RightCode Inc. All rights reserved.
+"""
+import os
+
+os.environ['BLOG_BACKEND'] = 'memory'  # init_db を読み込む前に (本物の Firestore には接続しない)
+
+import argparse
+import asyncio
+import json
+import random
+import sys
+import tempfile
+import time
+
+import httpx
+
+import cache
+import metrics
+import search
+import session
+import sitemap_generator
+from init_db import db
+from models import Article, Category, Tag, SlugAlreadyExists
+from controllers import api
+
+THRESHOLDS_FILE = 'bench_thresholds.json'
+SEED = 1
+
+# 外部のサービスに問い合わせる・作業ディレクトリのファイルを書き換えるルートは計測しない {ルート: 理由}
+SKIP = {
+    '/admin/upload': 'writes files under static/ and starts the variant workers',
+    '/admin/profile': 'calls Firebase Authentication',
+    '/admin/profile/update': 'POST (calls Firebase Authentication)',
+}
+
+# 書き込むルート {ルート: (メソッド, フォームを返す関数)}
+WRITES = {
+    '/logout': ('GET', None),
+    '/admin/add': ('POST', lambda: _article_form('bench-article')),  # 記事数のカウンタ・サイトマップ・検索
+    '/admin/article/update': ('POST', lambda: dict(_article_form('article-1', 'category2', ['tag2', 'tag3']),
+                                                   original_slug='article-1')),  # カテゴリ・タグのカウンタを移す
+    '/admin/article/delete': ('GET', None),
+    '/admin/category/add': ('POST', lambda: {'new_cat_name': 'カテゴリ bench', 'new_cat_slug': 'bench-category'}),
+    '/admin/category/delete': ('GET', None),
+    '/admin/category/update': ('POST', lambda: {'cat_name_category3': 'カテゴリ renamed',
+                                                'cat_slug_category3': 'category3-renamed'}),  # 記事のカテゴリも変わる
+}
+
+# クエリを付けて計測するルート
+QUERIES = {
+    '/search': '?q=ブログ',
+    '/admin/edit/{slug}': '',
+    '/admin/article/delete': '?slug=article-2',
+    '/admin/category/delete': '?slug=category4',
+}
+
+# 正常とみなすステータス (リダイレクトはログインしていない場合など)
+EXPECTED_STATUS = {200, 304, 301, 302, 303, 307, 308}
+
+UNCACHED_REQUESTS = 20  # キャッシュを消して送るリクエスト数 (ルートごと)
+
+SESSION_COOKIE = 'bench-session'
+
+_WORDS = ('ブログ', '記事', 'Python', 'Firestore', '検索', '画像', 'サーバ', 'キャッシュ', 'テンプレート', '日本語')
+
+
+def _contents(rnd: random.Random, paragraphs: int):
+    """ 見出し・段落・リスト・コードを含むMarkdown """
+    lines = ['# ' + rnd.choice(_WORDS)]
+    for i in range(paragraphs):
+        lines.append('## {} {}'.format(rnd.choice(_WORDS), i))
+        lines.append(''.join(rnd.choice(_WORDS) + 'について。' for _ in range(20)))
+        lines.append('\n'.join('- ' + rnd.choice(_WORDS) for _ in range(3)))
+        lines.append('```python\nprint({})\n```'.format(i))
+    return '\n\n'.join(lines)
+
+
+def _article_form(slug: str, category: str = 'category1', tags=('tag0', 'tag1')):
+    """ 記事の保存のフォーム """
+    return {'title': 'ベンチマークの記事', 'thumbnail': '', 'description': '書き込みの計測用です。',
+            'slug': slug, 'contents': _contents(random.Random(SEED), 5), 'category': category, 'tags': list(tags)}
+
+
+def seed(num_articles: int, num_categories: int = 5, num_tags: int = 10, paragraphs: int = 5):
+    """
+    記事・カテゴリ・タグを作成 (models を通すので記事数のカウンタ・変換済みのHTMLも作られる)
+    :return: {'category': カテゴリ, 'slug': そのカテゴリの公開済みの記事, 'tag': タグ, 'num': '1'}  ルートの引数
+    """
+    rnd = random.Random(SEED)
+    categories = ['category{}'.format(i) for i in range(num_categories)]
+    tags = ['tag{}'.format(i) for i in range(num_tags)]
+    for slug in categories:
+        Category('カテゴリ ' + slug, slug).add()
+    for slug in tags:
+        Tag('タグ ' + slug, slug).add()
+
+    for i in range(num_articles):
+        try:
+            Article(title='{}の記事 {}'.format(rnd.choice(_WORDS), i),
+                    thumbnail='',
+                    contents=_contents(rnd, paragraphs),
+                    description='{}についての記事です。'.format(rnd.choice(_WORDS)),
+                    author='bench',
+                    slug='article-{}'.format(i),
+                    category=categories[i % num_categories],
+                    tags=rnd.sample(tags, 2),
+                    released=i % 10 != 0).add()
+        except SlugAlreadyExists:
+            pass
+
+    return {'category': categories[1], 'slug': 'article-1', 'tag': tags[0], 'num': '1'}
+
+
+def _url(route: str, params: dict):
+    url = route
+    for name, value in params.items():
+        url = url.replace('{' + name + '}', value)
+    return url + QUERIES.get(route, '')
+
+
+def _percentile(values, p: float):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def _firestore_counts(route: str):
+    """ :return: (これまでのRPC数, 読み込んだドキュメント数)  ルートのもの """
+    rpcs = metrics.firestore_seconds.counts()
+    docs = metrics.firestore_documents.values()
+    return (sum(value for labels, value in rpcs.items() if labels[0] == route),
+            sum(value for labels, value in docs.items() if labels[0] == route))
+
+
+def _login(client):
+    """ 管理画面は検証済みのセッションとして扱う (Firebase Authentication には問い合わせない) """
+    session.sessions.set(session._key(SESSION_COOKIE), {'uid': 'bench', 'exp': time.time() + 24 * 60 * 60})
+    client.cookies.set('session', SESSION_COOKIE)
+    client.cookies.set('username', 'bench')
+
+
+async def _drive(client, url: str, requests: int, concurrency: int, before=None, method: str = 'GET', data=None):
+    """
+    :param before: リクエストごとに先に呼ぶ関数 (時間には含めない．concurrency は 1 にすること)
+    :return: (各リクエストの時間 [s], 全体の時間 [s], ステータス)
+    """
+    latencies, statuses = [], set()
+    queue = list(range(requests))
+
+    async def worker():
+        while queue:
+            queue.pop()
+            if before is not None:
+                before()
+            start = time.perf_counter()
+            res = await client.request(method, url, data=data)
+            latencies.append(time.perf_counter() - start)
+            statuses.add(res.status_code)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return latencies, time.perf_counter() - start, statuses
+
+
+async def _run_write(client, route: str, url: str, requests: int, seeded: dict):
+    """ 書き込むルート: リクエストごとに seed の直後のデータ・ログイン状態に戻してから1つずつ送る """
+    method, form = WRITES[route]
+    data = form() if form is not None else None
+
+    def reset():
+        db.load(seeded)
+        cache.invalidate()
+        _login(client)
+
+    reset()
+    await client.request(method, url, data=data)  # 1回目は含めない
+
+    rpcs, docs = _firestore_counts(route)
+    latencies, elapsed, statuses = await _drive(client, url, requests, 1, reset, method, data)
+    rpcs_after, docs_after = _firestore_counts(route)
+    reset()
+
+    result = {
+        'url': url,
+        'status': sorted(statuses),
+        'rps': requests / elapsed,
+        'p50_ms': _percentile(latencies, 50) * 1000,
+        'p99_ms': _percentile(latencies, 99) * 1000,
+        'rpcs_per_request': (rpcs_after - rpcs) / requests,
+        'docs_per_request': (docs_after - docs) / requests,
+    }
+    result.update(uncached_p99_ms=result['p99_ms'], uncached_rpcs=result['rpcs_per_request'],
+                  uncached_docs=result['docs_per_request'])
+    return result
+
+
+async def run(routes, params: dict, requests: int, concurrency: int, seeded: dict):
+    """
+    :param seeded: seed の直後のデータ (db.dump())  書き込むルートの前に戻す
+    :return: {ルート: 結果}
+    """
+    results = {}
+    transport = httpx.ASGITransport(app=api, raise_app_exceptions=False)  # 例外は500として記録する
+    async with httpx.AsyncClient(transport=transport, base_url='http://bench', follow_redirects=False) as client:
+        _login(client)
+        # 書き込むルートは最後 (サイトマップ・検索インデックスは戻さないので，読み込むルートの結果が変わらないように)
+        for route in [r for r in routes if r not in WRITES] + [r for r in routes if r in WRITES]:
+            url = _url(route, params)
+            if route in WRITES:
+                results[route] = await _run_write(client, route, url, requests, seeded)
+                continue
+
+            await client.get(url)  # 1回目(テンプレートの読み込みなど)は含めない
+
+            # キャッシュなし: 1つずつ送るので，同時に送るリクエストとキャッシュを共有せず毎回同じRPC数になる
+            rpcs, docs = _firestore_counts(route)
+            uncached, _, uncached_statuses = await _drive(client, url, UNCACHED_REQUESTS, 1, cache.invalidate)
+            rpcs_after, docs_after = _firestore_counts(route)
+            uncached_rpcs = (rpcs_after - rpcs) / UNCACHED_REQUESTS
+            uncached_docs = (docs_after - docs) / UNCACHED_REQUESTS
+
+            # キャッシュあり: 同時に送る
+            latencies, elapsed, statuses = await _drive(client, url, requests, concurrency)
+            rpcs, docs = _firestore_counts(route)
+
+            results[route] = {
+                'url': url,
+                'status': sorted(statuses | uncached_statuses),
+                'rps': requests / elapsed,
+                'p50_ms': _percentile(latencies, 50) * 1000,
+                'p99_ms': _percentile(latencies, 99) * 1000,
+                'rpcs_per_request': (rpcs - rpcs_after) / requests,
+                'docs_per_request': (docs - docs_after) / requests,
+                'uncached_p99_ms': _percentile(uncached, 99) * 1000,
+                'uncached_rpcs': uncached_rpcs,
+                'uncached_docs': uncached_docs,
+            }
+    return results
+
+
+def report(results: dict):
+    """ rpc/req・docs/req: キャッシュありの平均，uncached: キャッシュを毎回消した場合 """
+    print('{:<28} {:>7} {:>9} {:>8} {:>8} {:>8} {:>8} | {:>8} {:>8} {:>9}'.format(
+        'route', 'status', 'req/s', 'p50 ms', 'p99 ms', 'rpc/req', 'docs/req',
+        'p99 ms', 'rpc/req', 'docs/req'))
+    print('{:<28} {:>7} {:>9} {:>8} {:>8} {:>8} {:>8} | {:>28}'.format('', '', '', '', '', '', '', 'uncached'))
+    for route, r in results.items():
+        print('{:<28} {:>7} {:>9.1f} {:>8.2f} {:>8.2f} {:>8.2f} {:>8.1f} | {:>8.2f} {:>8.2f} {:>9.1f}'.format(
+            route, ','.join(map(str, r['status'])), r['rps'], r['p50_ms'], r['p99_ms'],
+            r['rpcs_per_request'], r['docs_per_request'],
+            r['uncached_p99_ms'], r['uncached_rpcs'], r['uncached_docs']))
+
+
+def check_status(results: dict):
+    """ :return: 5xx・想定外のステータスを返したルートのリスト """
+    return ['{} status: {}'.format(route, ','.join(map(str, r['status'])))
+            for route, r in results.items() if not set(r['status']) <= EXPECTED_STATUS]
+
+
+def check(results: dict, thresholds: dict):
+    """ :return: しきい値を超えた項目・想定外のステータスのリスト """
+    failures = check_status(results)
+    for route, limits in thresholds.items():
+        if route not in results:
+            continue
+        for key, limit in limits.items():
+            value = results[route].get(key)
+            if value is not None and value > limit + 1e-9:
+                failures.append('{} {}: {:.2f} > {:.2f}'.format(route, key, value, limit))
+    return failures
+
+
+def make_thresholds(results: dict, headroom: float):
+    """ RPC数・ドキュメント数はそのまま，レイテンシは余裕を持たせる (実行する環境で変わるので) """
+    return {
+        route: {
+            'uncached_rpcs': round(r['uncached_rpcs'], 2),
+            'uncached_docs': round(r['uncached_docs'], 1),
+            'rpcs_per_request': round(r['rpcs_per_request'], 2),
+            'p99_ms': round(max(r['p99_ms'] * headroom, 100.0), 1),
+            'uncached_p99_ms': round(max(r['uncached_p99_ms'] * headroom, 100.0), 1),
+        }
+        for route, r in results.items()
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='メモリ上の Firestore を使ったベンチマーク')
+    parser.add_argument('--articles', type=int, default=300, help='作成する記事数 (default: 300)')
+    parser.add_argument('--requests', type=int, default=100, help='ルートごとのリクエスト数 (default: 100)')
+    parser.add_argument('--concurrency', type=int, default=4, help='同時に送るリクエスト数 (default: 4)')
+    parser.add_argument('--rpc-latency', type=float, default=0.0, help='RPCごとに待つ時間 [ms] (default: 0)')
+    parser.add_argument('--routes', nargs='*', help='計測するルート (default: 全て)')
+    parser.add_argument('--thresholds', default=THRESHOLDS_FILE, help='しきい値のファイル')
+    parser.add_argument('--update-thresholds', action='store_true', help='結果からしきい値のファイルを作り直す')
+    parser.add_argument('--headroom', type=float, default=3.0, help='しきい値のレイテンシの余裕 (倍)')
+    parser.add_argument('--json', help='結果をJSONで書き出すファイル')
+    args = parser.parse_args()
+
+    # サイトマップ・検索インデックスは一時ディレクトリに作る (作業ディレクトリのファイルを書き換えない)
+    tmp = tempfile.mkdtemp(prefix='blog-bench-')
+    sitemap_generator.SITEMAP_DIR = tmp
+    # 子サイトマップ(sitemap-N.xml)も計測できるように，少ない記事数でも分割する
+    sitemap_generator.MAX_URLS = max(10, args.articles // 4)
+    search.index = search.SearchIndex(os.path.join(tmp, search.INDEX_FILE))
+
+    start = time.perf_counter()
+    params = seed(args.articles)
+    search.index.rebuild()
+    sitemap_generator.rebuild_sitemap()
+    print('seeded {} articles ({:.1f}s)'.format(args.articles, time.perf_counter() - start))
+
+    db.latency = args.rpc_latency / 1000
+    routes = [route.route for route in api.router.routes
+              if route.route not in SKIP and (not args.routes or route.route in args.routes)]
+    results = asyncio.run(run(routes, params, args.requests, args.concurrency, db.dump()))
+    report(results)
+    for route, reason in SKIP.items():
+        print('skipped {}: {}'.format(route, reason))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.update_thresholds:
+        failures = check_status(results)
+        if failures:  # エラーを返すルートをしきい値にしない
+            for failure in failures:
+                print('ERROR ' + failure, file=sys.stderr)
+            return 1
+        with open(args.thresholds, 'w') as f:
+            json.dump(make_thresholds(results, args.headroom), f, indent=2, ensure_ascii=False)
+            f.write('\n')
+        print('thresholds written to {}'.format(args.thresholds))
+        return 0
+
+    try:
+        with open(args.thresholds) as f:
+            thresholds = json.load(f)
+    except FileNotFoundError:
+        print('no thresholds file: {}'.format(args.thresholds))
+        return 0
+
+    failures = check(results, thresholds)
+    for failure in failures:
+        print('REGRESSION ' + failure, file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,334 @@
+"""
+bulk.py
+記事・カテゴリ・タグの一括エクスポート / インポート
+
+$ python bulk.py export <dir> [--format jsonl|markdown] [--resume]
+$ python bulk.py import <dir> [--overwrite] [--resume]
+
+形式
+    jsonl:    <dir>/articles.jsonl, categories.jsonl, tags.jsonl (1行1ドキュメント)
+    markdown: <dir>/articles/{slug}.md (フロントマター + 本文), categories.jsonl, tags.jsonl
+
+ドキュメントは1件ずつ読み書きし，全体をメモリに載せない．
+インポートは最初に入力のslugの重複・不正を確認してから BulkWriter で並列に書き込み，
+書き込み済みの件数を <dir>/.bulk_state.json に記録するので，中断しても --resume で続きから再開できる．
+
+Copyright (c) RightCode Inc. All rights reserved.
+"""
+import argparse
+import json
+import os
+import sys
+from datetime import datetime
+
+from init_db import db
+from models import _check_slug, get_article_slugs, get_category_slugs, get_tag_slugs, recount_articles
+from renderer import render_article, RENDERER_VERSION
+from sitemap_generator import rebuild_sitemap
+import cache
+import search
+
+COLLECTIONS = ('categories', 'tags', 'articles')  # 記事が参照するものから
+STATE_FILE = '.bulk_state.json'
+CHECKPOINT = 500  # この件数ごとに書き込みを待って進捗を記録する
+MAX_ATTEMPTS = 5
+
+DATETIME_FIELDS = ('last_update',)
+RENDERED_FIELDS = ('contents_html', 'thumbnail_html', 'render_version')  # markdown形式には書き出さない
+
+# 再試行する gRPC のステータス (ABORTED, UNAVAILABLE, DEADLINE_EXCEEDED, RESOURCE_EXHAUSTED)
+_RETRYABLE = (10, 14, 4, 8)
+_ALREADY_EXISTS = 6
+
+_SLUGS = {
+    'articles': get_article_slugs,
+    'categories': get_category_slugs,
+    'tags': get_tag_slugs,
+}
+
+
+def _encode(doc: dict):
+    return {k: v.isoformat() if isinstance(v, datetime) else v for k, v in doc.items()}
+
+
+def _decode(doc: dict):
+    for field in DATETIME_FIELDS:
+        if isinstance(doc.get(field), str):
+            doc[field] = datetime.fromisoformat(doc[field])
+    return doc
+
+
+# --- Markdown (フロントマター) ---
+
+def _to_markdown(doc: dict):
+    """ 値はJSONで書き出す (YAMLとしても読める) """
+    lines = ['---']
+    for key, value in doc.items():
+        if key != 'contents' and key not in RENDERED_FIELDS:
+            lines.append('{}: {}'.format(key, json.dumps(value, ensure_ascii=False)))
+    lines.append('---')
+    return '\n'.join(lines) + '\n' + doc.get('contents', '')
+
+
+def _from_markdown(text: str):
+    """ フロントマター(key: value) + 本文  値がJSONとして読めなければ文字列 """
+    lines = text.split('\n')
+    if not lines or lines[0].strip() != '---':
+        raise ValueError('front matter not found')
+
+    doc = {}
+    for i, line in enumerate(lines[1:], 1):
+        if line.strip() == '---':
+            doc['contents'] = '\n'.join(lines[i + 1:])
+            return doc
+        if not line.strip():
+            continue
+        key, _, value = line.partition(':')
+        value = value.strip()
+        try:
+            doc[key.strip()] = json.loads(value)
+        except ValueError:
+            doc[key.strip()] = value
+    raise ValueError('front matter is not closed')
+
+
+# --- 入力 ---
+
+def _detect_format(path: str):
+    return 'markdown' if os.path.isdir(os.path.join(path, 'articles')) else 'jsonl'
+
+
+def _read(path: str, collection: str, fmt: str):
+    """ 1件ずつ読み込む (ファイルがなければ何もしない) """
+    if collection == 'articles' and fmt == 'markdown':
+        directory = os.path.join(path, 'articles')
+        for name in sorted(os.listdir(directory)):
+            if name.endswith('.md'):
+                with open(os.path.join(directory, name), encoding='utf-8') as f:
+                    doc = _from_markdown(f.read())
+                doc.setdefault('slug', name[:-len('.md')])
+                yield _decode(doc)
+        return
+
+    filename = os.path.join(path, collection + '.jsonl')
+    if not os.path.exists(filename):
+        return
+    with open(filename, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield _decode(json.loads(line))
+
+
+def validate(path: str, collection: str, fmt: str):
+    """
+    書き込む前に入力のslugを確認 (slugだけをメモリに保持する)
+    :return: (slugの数, 重複したslug, 使えないslug)
+    """
+    seen, duplicated, invalid = set(), [], []
+    for doc in _read(path, collection, fmt):
+        slug = doc.get('slug')
+        try:
+            _check_slug(slug)
+        except (ValueError, TypeError):
+            invalid.append(slug)
+            continue
+        if slug in seen:
+            duplicated.append(slug)
+        seen.add(slug)
+    return len(seen), duplicated, invalid
+
+
+# --- 進捗 ---
+
+def _load_state(path: str):
+    try:
+        with open(os.path.join(path, STATE_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_state(path: str, state: dict):
+    tmp = os.path.join(path, STATE_FILE + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp, os.path.join(path, STATE_FILE))
+
+
+# --- インポート ---
+
+def _article_data(doc: dict):
+    """ 変換済みのHTMLが古い・ない記事は変換する """
+    doc.setdefault('last_update', datetime.now())
+    doc.setdefault('released', False)
+    doc.setdefault('tags', [])
+    doc.setdefault('thumbnail', '')
+    if doc.get('render_version') != RENDERER_VERSION:
+        doc.update(render_article(doc.get('contents', ''), doc.get('thumbnail', '')))
+    return doc
+
+
+def import_collection(path: str, collection: str, fmt: str, overwrite: bool = False, resume: bool = False):
+    """
+    1つのコレクションをインポート
+    :param overwrite: True => 既存のドキュメントを上書き  False => 既存のslugは飛ばす
+    :param resume:    前回中断したところから再開
+    :return: (書き込んだ数, 飛ばした数, 失敗したslugのリスト)
+    """
+    state = _load_state(path) if resume else {}
+    done = state.get('import', {}).get(collection, 0)
+
+    # 既存のslugはIDだけを一度だけ取得して確認する
+    existing = set() if overwrite else set(_SLUGS[collection]())
+
+    failed = []
+
+    def on_error(failure, _):
+        if failure.code in _RETRYABLE and failure.attempts < MAX_ATTEMPTS:
+            return True
+        if failure.code != _ALREADY_EXISTS:  # 中断前に書き込み済みのものは成功とみなす
+            failed.append(failure.operation.reference.id)
+        return False
+
+    writer = db.bulk_writer()
+    writer.on_write_error(on_error)
+
+    ref = db.collection(collection)
+    written = skipped = 0
+    for i, doc in enumerate(_read(path, collection, fmt)):
+        if i < done:
+            continue
+
+        slug = doc['slug']
+        if slug in existing:
+            skipped += 1
+        else:
+            if collection == 'articles':
+                doc = _article_data(doc)
+            if overwrite:
+                writer.set(ref.document(slug), doc)
+            else:
+                writer.create(ref.document(slug), doc)
+            written += 1
+
+        if (i + 1) % CHECKPOINT == 0:
+            writer.flush()  # ここまでの書き込みが終わってから記録する
+            state.setdefault('import', {})[collection] = i + 1
+            _save_state(path, state)
+
+    writer.close()
+    state.setdefault('import', {})[collection] = done + written + skipped
+    _save_state(path, state)
+    return written, skipped, failed
+
+
+def import_all(path: str, overwrite: bool = False, resume: bool = False):
+    fmt = _detect_format(path)
+
+    # 全てのコレクションを確認してから書き込む (途中で失敗して中途半端にならないように)
+    errors = []
+    for collection in COLLECTIONS:
+        count, duplicated, invalid = validate(path, collection, fmt)
+        print('{}: {} documents'.format(collection, count))
+        errors += ['{}: duplicated slug "{}"'.format(collection, slug) for slug in duplicated]
+        errors += ['{}: invalid slug "{}"'.format(collection, slug) for slug in invalid]
+    if errors:
+        for error in errors:
+            print(error, file=sys.stderr)
+        return False
+
+    for collection in COLLECTIONS:
+        written, skipped, failed = import_collection(path, collection, fmt, overwrite, resume)
+        print('{}: {} written, {} skipped (already exists), {} failed'.format(collection, written, skipped,
+                                                                              len(failed)))
+        for slug in failed:
+            print('    failed: {}'.format(slug), file=sys.stderr)
+
+    recount_articles()  # BulkWriter の書き込みではカテゴリ・タグの記事数を増やしていない
+    cache.invalidate()
+    rebuild_sitemap()
+    search.index.rebuild()
+    return True
+
+
+# --- エクスポート ---
+
+def export_collection(path: str, collection: str, fmt: str, resume: bool = False):
+    """
+    1つのコレクションをエクスポート (ドキュメントIDの順に1件ずつ)
+    :return: 書き出した数
+    """
+    state = _load_state(path) if resume else {}
+    checkpoint = state.get('export', {}).get(collection)  # {'last': 最後のID, 'offset': その時点のファイルの位置}
+
+    query = db.collection(collection).order_by('__name__')
+    if checkpoint is not None:
+        snapshot = db.collection(collection).document(checkpoint['last']).get()
+        if snapshot.exists:
+            query = query.start_after(snapshot)
+
+    markdown = collection == 'articles' and fmt == 'markdown'
+    if markdown:
+        os.makedirs(os.path.join(path, 'articles'), exist_ok=True)
+        out = None
+    elif checkpoint is not None:
+        # 記録した後に書き出した行は捨てる (再開後にもう一度書き出す)
+        out = open(os.path.join(path, collection + '.jsonl'), 'r+', encoding='utf-8')
+        out.truncate(checkpoint['offset'])
+        out.seek(checkpoint['offset'])
+    else:
+        out = open(os.path.join(path, collection + '.jsonl'), 'w', encoding='utf-8')
+
+    count = 0
+    try:
+        for doc in query.stream():
+            data = _encode(doc.to_dict())
+            if markdown:
+                with open(os.path.join(path, 'articles', doc.id + '.md'), 'w', encoding='utf-8') as f:
+                    f.write(_to_markdown(data))
+            else:
+                out.write(json.dumps(data, ensure_ascii=False) + '\n')
+            count += 1
+
+            if count % CHECKPOINT == 0:
+                offset = None
+                if out is not None:
+                    out.flush()
+                    os.fsync(out.fileno())
+                    offset = out.tell()
+                state.setdefault('export', {})[collection] = {'last': doc.id, 'offset': offset}
+                _save_state(path, state)
+    finally:
+        if out is not None:
+            out.close()
+
+    state.setdefault('export', {}).pop(collection, None)  # 最後まで書き出した
+    _save_state(path, state)
+    return count
+
+
+def export_all(path: str, fmt: str = 'jsonl', resume: bool = False):
+    os.makedirs(path, exist_ok=True)
+    for collection in COLLECTIONS:
+        print('{}: {} documents exported.'.format(collection, export_collection(path, collection, fmt, resume)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='記事・カテゴリ・タグの一括エクスポート / インポート')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('export', help='Firestore => ファイル')
+    p.add_argument('dir')
+    p.add_argument('--format', choices=['jsonl', 'markdown'], default='jsonl')
+    p.add_argument('--resume', action='store_true', help='中断したところから再開')
+
+    p = sub.add_parser('import', help='ファイル => Firestore')
+    p.add_argument('dir')
+    p.add_argument('--overwrite', action='store_true', help='既存のドキュメントを上書き (デフォルトは飛ばす)')
+    p.add_argument('--resume', action='store_true', help='中断したところから再開')
+
+    args = parser.parse_args()
+    if args.command == 'export':
+        export_all(args.dir, args.format, args.resume)
+    elif not import_all(args.dir, args.overwrite, args.resume):
+        sys.exit(1)
@@ -0,0 +1,171 @@
+"""
+cache.py
+models の読み出し結果をプロセス内に保持するキャッシュ (TTL + LRU)
+
+書き込み系の関数から invalidate() を呼ぶことで，
+管理画面での更新直後でも古いデータが表示されないようにする．
+キャッシュした値は共有されるので，呼び出し側で書き換えないこと．
+
+Copyright (c) RightCode Inc. All rights reserved.
+"""
+import functools
+import inspect
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_TTL = 60  # seconds
+DEFAULT_MAXSIZE = 256  # entries
+
+_MISSING = object()
+
+
+class Cache(object):
+    def __init__(self, maxsize: int = DEFAULT_MAXSIZE, ttl: float = DEFAULT_TTL):
+        """
+        Create cache
+        :param maxsize: 保持する最大エントリ数 (超えたら最も古く使われたものから捨てる)
+        :param ttl:     有効期限 [s]
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key => (expires, namespaces, value)
+        self._lock = threading.RLock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.generation = 0  # invalidate() のたびに増える (作成中に無効化されたかの確認用)
+
+    def get(self, key, default=None):
+        """ Get a value (期限切れ・未登録なら default) """
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is _MISSING or entry[0] < time.monotonic():
+                if entry is not _MISSING:
+                    del self._data[key]
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def set(self, key, value, namespaces=(), ttl: float = None):
+        """
+        Set a value
+        :param key:
+        :param value:
+        :param namespaces: invalidate() で一括削除するためのグループ名
+        :param ttl:        エントリ個別の有効期限 (Noneならデフォルト)
+        """
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires, frozenset(namespaces), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        """ Delete an entry """
+        with self._lock:
+            self._data.pop(key, None)
+
+    def invalidate(self, *namespaces):
+        """
+        Delete entries which belong to the namespaces
+        引数なしなら全て削除
+        """
+        with self._lock:
+            self.generation += 1
+            if not namespaces:
+                self._data.clear()
+                return
+
+            targets = set(namespaces)
+            for key in [k for k, entry in self._data.items() if entry[1] & targets]:
+                del self._data[key]
+
+    def stats(self):
+        """ ヒット率などの統計情報 """
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / total if total else 0.0,
+            }
+
+
+# models 用の共有キャッシュ
+store = Cache()
+
+# 公開ページのレスポンス用 (page_cache.py)
+pages = Cache(maxsize=512)
+
+
+def cached(*namespaces, ttl: float = None):
+    """
+    関数の戻り値を引数ごとにキャッシュするデコレータ
+    async def の関数にも使える (awaitした結果をキャッシュする)
+    呼び出し中に invalidate() された場合は，結果を返すだけでキャッシュしない
+    :param namespaces: 無効化に使うグループ名 (例: 'articles')
+    :param ttl:        有効期限 (Noneならデフォルト)
+    """
+    def decorator(func):
+        def make_key(args, kwargs):
+            return func.__module__, func.__qualname__, args, tuple(sorted(kwargs.items()))
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                key = make_key(args, kwargs)
+                value = store.get(key, _MISSING)
+                if value is _MISSING:
+                    generation = store.generation
+                    value = await func(*args, **kwargs)
+                    if store.generation == generation:  # 読み込み中に無効化されたら古いかもしれないので保存しない
+                        store.set(key, value, namespaces, ttl)
+                return value
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = make_key(args, kwargs)
+            value = store.get(key, _MISSING)
+            if value is _MISSING:
+                generation = store.generation
+                value = func(*args, **kwargs)
+                if store.generation == generation:  # 読み込み中に無効化されたら古いかもしれないので保存しない
+                    store.set(key, value, namespaces, ttl)
+            return value
+
+        return wrapper
+
+    return decorator
+
+
+def invalidate(*namespaces, public: bool = True):
+    """
+    Delete cached values and pages of the namespaces (引数なしなら全て)
+    :param public: False => 公開ページに表示されない変更 (下書きなど) なので，公開ページのキャッシュは残す
+    """
+    store.invalidate(*namespaces)
+    if public:
+        pages.invalidate(*namespaces)
+
+
+def stats():
+    """ Get hit/miss counters of the shared cache """
+    return store.stats()
+
+
+def page_stats():
+    """ Get hit/miss counters of the page cache """
+    return pages.stats()
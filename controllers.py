@@ -7,73 +7,173 @@ Copyright (c) RightCode Inc. All rights reserved.
 
 import responder
 
-from auth import _login, _sign_up, _get_user, _change_user_info
+from auth import _login_async, _sign_up, _get_user, _change_user_info
 from models import *
-from sitemap_generator import update_sitemap
-
-import markdown
-import os
+from models import _valid_cursor
+import async_models
+from sitemap_generator import update_sitemap, get_sitemap
+from renderer import render, article_html, THUMBNAIL_SIZES
+from page_cache import PageCacheMiddleware, _not_modified as _etag_not_modified
+from media import save_upload, schedule_variants, UploadError, index as media_index
+from session import AdminAuthMiddleware, forget as forget_session
+import search
+import metrics
+import cache
+
+import asyncio
 from datetime import datetime, timedelta
+from email.utils import parsedate_to_datetime
 
 api = responder.API()
+api.add_middleware(PageCacheMiddleware)  # 公開ページは更新されるまでメモリから返す
+api.add_middleware(AdminAuthMiddleware)  # /admin 以下はセッションクッキーを検証する (結果はキャッシュ)
+api.add_middleware(metrics.MetricsMiddleware, routes=api.router.routes)  # 一番外側: キャッシュから返したページも計測
+metrics.instrument_templates(api.templates)
 
 firebase_error_massages = {
     'EMAIL_NOT_FOUND': 'メールアドレスが正しくありません',
     'INVALID_PASSWORD': 'パスワードが正しくありません',
     'WEAK_PASSWORD': 'パスワードが短すぎます。最低でも6文字以上にしてください。',
     'INVALID_EMAIL': 'メールアドレスが正しくありません。',
+    'INVALID_LOGIN_CREDENTIALS': 'メールアドレスまたはパスワードが正しくありません',
+    'NETWORK_ERROR': '認証サーバに接続できませんでした。しばらくしてからもう一度お試しください。',
 }
 
 COOKIE_EXPIRES = 5  # days later
+ARTICLES_PER_PAGE = 12  # 一覧ページの1ページあたりの記事数
+# サイドメニューは記事・カテゴリ・タグの更新時に作り直す．これは念のための有効期限 [s]
+# (作成中に更新された場合は cache.cached() がキャッシュしないので，古い内容が長く残ることはない)
+SIDEMENU_TTL = 60 * 60
+
+
+@cache.cached('articles', 'categories', 'tags', ttl=SIDEMENU_TTL)
+async def render_sidemenu():
+    """ サイドメニュー(What's New + カテゴリ・タグと記事数)のHTML """
+    whats_new, categories, tags = await asyncio.gather(async_models.get_whats_new(),
+                                                       async_models.get_categories(),
+                                                       async_models.get_tags())
+    # 記事数はカテゴリ・タグのドキュメントに保存してあるので数えない
+    return api.template('sidemenu.html',
+                        whats_new=whats_new,
+                        categories=categories,
+                        tags=[tag for tag in tags if tag.get('count')])
+
+
+@api.background.task
+def _update_sitemap(**changes):
+    """ サイトマップの差分更新はバックグラウンドで (レスポンスを待たせない) """
+    update_sitemap(**changes)
+
+
+async def _article_form_error(req, resp, action, slug, article, error):
+    """ 保存できなかった場合は入力内容を残したまま編集画面に戻す """
+    categories, tags = await asyncio.gather(async_models.get_categories(), async_models.get_tags())
+    resp.html = api.template('new.html',
+                             action=action,
+                             slug=slug,
+                             article=article,
+                             error=error,
+                             name=req.cookies.get('username'),
+                             categories=categories,
+                             tags=tags)
+
+
+def _page_cursors(req):
+    """ 一覧ページのカーソル(after, before)をクエリから取得 (不正な値は無視) """
+    return _valid_cursor(req.params.get('after', None)), _valid_cursor(req.params.get('before', None))
 
 
 @api.route('/')
-def index(req, resp):
+async def index(req, resp):
     """ ルート """
-    articles = get_articles(unreleased=False)  # 公開済みのものだけ
+    after, before = _page_cursors(req)
 
-    # new
+    # カテゴリ名は1回のクエリでまとめて取得 (記事の取得と同時に)
+    (articles, prev_cursor, next_cursor), cat_names = await asyncio.gather(
+        async_models.get_articles_page(ARTICLES_PER_PAGE, after=after, before=before),
+        async_models.get_category_names(),
+    )
     art_categories = [
-        get_category_name(art['category'])
+        cat_names.get(art['category'], art['category'])
         for art in articles
     ]
 
-    md = markdown.Markdown(extensions=['tables'])
+    # 保存済みのHTMLを使う
     thumbnails = [
-        md.convert(art['thumbnail']) for art in articles
+        article_html(art, 'thumbnail') for art in articles
     ]
 
     resp.html = api.template('index.html',
                              title='ブログ一覧',
                              thumbnails=thumbnails,
                              art_categories=art_categories,  # new
-                             articles=articles,)
+                             articles=articles,
+                             prev_cursor=prev_cursor,
+                             next_cursor=next_cursor)
 
 
 @api.route('/category/{category}')
-def category(req, resp, *, category):
+async def category(req, resp, *, category):
     """ カテゴリごとの記事一覧 """
-    articles = get_articles(unreleased=False)  # 公開済みのものだけ
-
-    # カテゴリ抽出
-    articles = [
-        art for art in articles
-        if art['category'] == category
-    ]
+    after, before = _page_cursors(req)
+    (articles, prev_cursor, next_cursor), cat_names = await asyncio.gather(
+        async_models.get_articles_page(ARTICLES_PER_PAGE, after=after, before=before, category=category),
+        async_models.get_category_names(),
+    )
 
-    md = markdown.Markdown(extensions=['tables'])
     thumbnails = [
-        md.convert(art['thumbnail']) for art in articles
+        article_html(art, 'thumbnail') for art in articles
     ]
 
     # カテゴリ名
-    cat_name = get_category_name(category)
+    cat_name = cat_names.get(category, category)
 
     resp.html = api.template('index.html',
                              title=f'「{cat_name}」の記事一覧',
                              art_categories=[cat_name for _ in articles],  # 全て同じ
                              thumbnails=thumbnails,
-                             articles=articles)
+                             articles=articles,
+                             prev_cursor=prev_cursor,
+                             next_cursor=next_cursor)
+
+
+@api.route('/tag/{tag}')
+async def tag_articles(req, resp, *, tag):
+    """ タグごとの記事一覧 """
+    after, before = _page_cursors(req)
+    (articles, prev_cursor, next_cursor), cat_names, tags = await asyncio.gather(
+        async_models.get_articles_page(ARTICLES_PER_PAGE, after=after, before=before, tag=tag),
+        async_models.get_category_names(),
+        async_models.get_tags(),
+    )
+
+    tag_name = next((t['name'] for t in tags if t['slug'] == tag), tag)
+    resp.html = api.template('index.html',
+                             title=f'「{tag_name}」の記事一覧',
+                             art_categories=[cat_names.get(art['category'], art['category']) for art in articles],
+                             thumbnails=[article_html(art, 'thumbnail') for art in articles],
+                             articles=articles,
+                             prev_cursor=prev_cursor,
+                             next_cursor=next_cursor)
+
+
+@api.route('/search')
+async def search_articles(req, resp):
+    """ 記事の検索 (メモリマップした転置インデックスから1ページ分だけ) """
+    query = req.params.get('q', '').strip()
+    page = req.params.get('page', '1')
+    page = int(page) if page.isdigit() and int(page) > 0 else 1
+
+    results, total = search.index.search(query, page=page) if query else ([], 0)
+    cat_names = await async_models.get_category_names()
+    resp.html = api.template('search.html',
+                             title='「{}」の検索結果'.format(query) if query else '記事の検索',
+                             q=query,
+                             results=results,
+                             art_categories=[cat_names.get(art['category'], art['category']) for art in results],
+                             total=total,
+                             page=page,
+                             num_pages=-(-total // search.RESULTS_PER_PAGE))
 
 
 @api.route('/login')
@@ -94,6 +194,8 @@ def login(req, resp):
 def logout(req, resp):
     """ ログアウト処理 """
     # クッキーのログイン情報を破棄してリダイレクト
+    if req.cookies.get('session'):
+        forget_session(req.cookies.get('session'))
     resp.set_cookie(key='session', value='', expires=0, max_age=0)
     resp.set_cookie(key='username', value='', expires=0, max_age=0)
     resp.set_cookie(key='email', value='', expires=0, max_age=0)
@@ -111,7 +213,7 @@ class Admin:
 
         # ログイン済み
         else:
-            articles = get_articles()  # New
+            articles = await async_models.get_articles(fields=ADMIN_FIELDS)  # 本文は取得しない
             resp.html = api.template('admin.html',
                                      title='管理者ページ',
                                      token=req.cookies.get('token'),
@@ -125,7 +227,7 @@ class Admin:
         password = data['password']
 
         # 認証
-        res, session = _login(email, password, COOKIE_EXPIRES)
+        res, session = await _login_async(email, password, COOKIE_EXPIRES)
 
         if 'error' not in res:
             # [new] クッキーにログイン情報をセット
@@ -135,7 +237,7 @@ class Admin:
             resp.set_cookie(key='email', value=email, expires=expires)
 
             # 認証成功ならば管理者ページへ
-            articles = get_articles()
+            articles = await async_models.get_articles(fields=ADMIN_FIELDS)
             resp.html = api.template('admin.html',
                                      title='管理者ページ',
                                      name=res['displayName'],
@@ -146,15 +248,14 @@ class Admin:
 
 
 @api.route('/admin/new')
-def new_article(req, resp):
+async def new_article(req, resp):
     """ 新規記事追加 """
     if req.cookies.get('session') is None:
         api.redirect(resp, '/login')
 
     # ログイン済み
     else:
-        categories = get_categories()
-        tags = get_tags()
+        categories, tags = await asyncio.gather(async_models.get_categories(), async_models.get_tags())
         resp.html = api.template('new.html',
                                  action='add',  # new
                                  slug=None,  # new
@@ -165,16 +266,16 @@ def new_article(req, resp):
 
 
 @api.route('/admin/edit/{slug}')
-def edit(req, resp, *, slug):
+async def edit(req, resp, *, slug):
     """ 記事の編集 """
     if req.cookies.get('session') is None:
         api.redirect(resp, '/login')
 
     # ログイン済み
     else:
-        article = get_article(slug)
-        categories = get_categories()
-        tags = get_tags()
+        article, categories, tags = await asyncio.gather(async_models.get_article(slug),
+                                                         async_models.get_categories(),
+                                                         async_models.get_tags())
         resp.html = api.template('new.html',
                                  action='article/update',
                                  slug=slug,
@@ -205,49 +306,52 @@ async def article_update(req, resp):
     # プレビュー の場合
     if data.get('preview', None) is not None:
         # マークダウンからHTMLへ
-        # tableはでデフォルトでは変換してくれないのでここで指定する
-        md = markdown.Markdown(extensions=['tables', 'fenced_code', 'codehilite'])
-        html = md.convert(contents)
-
-        thumbnail = md.convert(thumbnail)  # 追加 md => html
+        html = render(contents)
+        thumbnail = render(thumbnail, sizes=THUMBNAIL_SIZES)  # 追加 md => html
 
-        whats_new = get_whats_new()
-        categories = get_categories()
         resp.html = api.template('preview.html',
                                  title=title,
                                  contents=html,
                                  thumbnail=thumbnail,
                                  category=category,
                                  tags=tags,
-                                 whats_new=whats_new,
-                                 categories=categories
+                                 sidemenu=await render_sidemenu()
                                  )
         return
 
     released = False if data.get('draft', None) is not None else True
 
     # update
-    update_article_by_slug(
-        original_slug,
-        title,
-        thumbnail,
-        description,
-        slug,
-        contents,
-        category,
-        tags,
-        released
-    )
+    try:
+        updated = await async_models.update_article_by_slug(
+            original_slug,
+            title,
+            thumbnail,
+            description,
+            slug,
+            contents,
+            category,
+            tags,
+            released
+        )
+    except ValueError as e:  # slugが既に使われているなど
+        article = dict(title=title, thumbnail=thumbnail, description=description, slug=slug,
+                       contents=contents, category=category, tags=tags)
+        await _article_form_error(req, resp, 'article/update', original_slug, article, str(e))
+        return
 
-    if released:
-        update_sitemap()
+    # 記事が見つからなければ何もせずに戻る
+    # 非公開にした記事・slugを変更する前のURLはサイトマップから外す
+    if updated:
+        _update_sitemap(articles=[{'slug': slug, 'category': category, 'released': released}],
+                        deleted=[original_slug] if slug != original_slug else [])
 
     api.redirect(resp, '/admin')
     return
 
 
 @api.route('/admin/article/delete')
-def delete_article(req, resp):
+async def delete_article(req, resp):
     """ 記事削除 """
     if req.cookies.get('session') is None:
         api.redirect(resp, '/login')
@@ -261,10 +365,9 @@ def delete_article(req, resp):
             api.redirect(resp, '/admin')
             return
 
-        # delete
-        delete_article_by_slug(art_slug)
-
-        update_sitemap()
+        # delete (存在しなければ何もしない)
+        if await async_models.delete_article_by_slug(art_slug):
+            _update_sitemap(deleted=[art_slug])
 
         api.redirect(resp, '/admin')
 
@@ -274,13 +377,12 @@ class Add:
     """ 新規記事の保存・プレビュー ・公開 """
     async def on_get(self, req, resp):
         # ログインしてなければ
-        if req.cookies.get('token') is None:
+        if req.cookies.get('session') is None:
             api.redirect(resp, '/login')
 
-        # ログイン済み
+        # ログイン済み (フォームは /admin/new で表示する)
         else:
-            resp.html = api.template('new.html',
-                                     name=req.cookies.get('username'))
+            api.redirect(resp, '/admin/new')
 
     async def on_post(self, req, resp):
         data = await req.media()
@@ -295,68 +397,88 @@ class Add:
         # プレビュー の場合
         if data.get('preview', None) is not None:
             # マークダウンからHTMLへ
-            # tableはでデフォルトでは変換してくれないのでここで指定する
-            md = markdown.Markdown(extensions=['tables', 'fenced_code', 'codehilite'])
-            html = md.convert(contents)
-            thumbnail = md.convert(thumbnail)  # 追加 md => html
+            html = render(contents)
+            thumbnail = render(thumbnail, sizes=THUMBNAIL_SIZES)  # 追加 md => html
 
-            whats_new = get_whats_new()
-            categories = get_categories()
             resp.html = api.template('preview.html',
                                      title=title,
                                      contents=html,
                                      thumbnail=thumbnail,
                                      category=category,
                                      tags=tags,
-                                     whats_new=whats_new,
-                                     categories=categories
+                                     sidemenu=await render_sidemenu()
                                      )
             return
 
         # それ以外
         released = False if data.get('draft', None) is not None else True
 
-        article = Article(
-            title=title,
-            thumbnail=thumbnail,
-            description=description,
-            author=req.cookies.get('username'),
-            slug=slug,
-            contents=contents,
-            category=category,
-            tags=tags,
-            released=released,
-        )
-
-        article.add()
+        try:
+            article = Article(
+                title=title,
+                thumbnail=thumbnail,
+                description=description,
+                author=req.cookies.get('username'),
+                slug=slug,
+                contents=contents,
+                category=category,
+                tags=tags,
+                released=released,
+            )
+
+            await async_models.add(article)
+        except ValueError as e:  # slugが既に使われているなど
+            article = dict(title=title, thumbnail=thumbnail, description=description, slug=slug,
+                           contents=contents, category=category, tags=tags)
+            await _article_form_error(req, resp, 'add', None, article, str(e))
+            return
 
         if released:
-            update_sitemap()
+            _update_sitemap(articles=[article.to_dict()])
 
         api.redirect(resp, '/admin')
 
 
 @api.route('/category/{category}/{slug}')
-def single(req, resp, *, category, slug):
+async def single(req, resp, *, category, slug):
     """ 記事 """
-    article = get_article(slug)
+    # 記事・カテゴリ名・サイドメニューは独立しているので同時に取得
+    article, cat_names, sidemenu = await asyncio.gather(async_models.get_article(slug),
+                                                        async_models.get_category_names(),
+                                                        render_sidemenu())
     if article is None or not article['released']:
         resp.html = api.template('404.html', title='お探しの記事は見つかりませんでした。')
         return
 
-    categories = get_categories()
-    whats_new = get_whats_new()
-
-    md = markdown.Markdown(extensions=['tables', 'fenced_code', 'codehilite'])
-    article['thumbnail'] = md.convert(article['thumbnail'])
-    article['contents'] = md.convert(article['contents'])
+    # 保存時に変換済みのHTMLを使う (キャッシュされた値は書き換えない)
+    article = dict(article)
+    article['thumbnail'] = article_html(article, 'thumbnail')
+    article['contents'] = article_html(article, 'contents')
 
     resp.html = api.template('single.html',
                              title=article['title'],
-                             cat_name=get_category_name(article['category']),
+                             cat_name=cat_names.get(article['category'], article['category']),
                              article=article,
-                             whats_new=whats_new,
-                             categories=categories)
+                             sidemenu=sidemenu)
+
+
+def _media_page(req, resp, error=None):
+    """ メディアページ (ページ番号・年月・ファイル名で絞り込み) """
+    page = req.params.get('page', '1')
+    page = int(page) if page.isdigit() else 1
+    query = req.params.get('q', '').strip()
+    month = req.params.get('month', None) or None
+
+    imgs, num_pages = media_index.page(page, query=query, month=month)
+    resp.html = api.template('media.html',
+                             name=req.cookies.get('username'),
+                             imgs=imgs,
+                             page=min(page, num_pages),
+                             num_pages=num_pages,
+                             months=media_index.months(),
+                             q=query,
+                             month=month,
+                             error=error)
 
 
 @api.route('/admin/media')
@@ -367,11 +489,8 @@ def media(req, resp):
 
     # ログイン済み
     else:
-        # 今ある画像パスを全て取得
-        imgs = get_images()
-        resp.html = api.template('media.html',
-                                 name=req.cookies.get('username'),
-                                 imgs=imgs)
+        # 一覧は毎回ディレクトリを読まずに，保存したインデックスから1ページ分だけ取得
+        _media_page(req, resp)
 
 
 @api.route('/admin/upload')
@@ -382,26 +501,19 @@ async def upload(req, resp):
 
     # ログイン済み
     else:
-        # アップロードはバックグラウンドで
-        @api.background.task
-        def _upload(data, filename):
-            file = data['file']
-            f = open('static/images/{}'.format(filename), 'wb')
-            f.write(file['content'])
-            f.close()
-
-        data = await req.media(format='files')
-
-        # 画像の名前を被らない名前にする
-        # 今回は日付 + filename
-        # この接頭辞を使って最新の画像は一番上にする
-        now = datetime.today().strftime('%Y%m%d%H%M%S')
+        # 受け取りながら一時ファイルに書き込む (全体をメモリに載せない)
+        # ファイル名は 日付 + ハッシュ + filename (日付の接頭辞を使って最新の画像は一番上にする)
+        try:
+            uploaded = await save_upload(req)
+        except UploadError as e:
+            resp.status_code = e.status_code
+            _media_page(req, resp, error=str(e))
+            return
 
-        filename = data['file']['filename']
-        filename = f'{now}_{filename}'
+        media_index.add(uploaded.filename)
 
-        # Upload
-        _upload(data, filename)
+        # 縮小した画像・WebPはバックグラウンドのプロセスで作成
+        schedule_variants(uploaded.filename)
 
         # media にリダイレクト
         api.redirect(resp, '/admin/media')
@@ -463,7 +575,7 @@ async def profile_update(req, resp):
 
 
 @api.route('/admin/category')
-def category(req, resp):
+async def category(req, resp):
     """ カテゴリの追加・更新・削除ページ """
     if req.cookies.get('session') is None:
         api.redirect(resp, '/login')
@@ -471,7 +583,7 @@ def category(req, resp):
     # ログイン済み
     else:
         # 今あるカテゴリ取得
-        categories = get_categories()
+        categories = await async_models.get_categories()
         resp.html = api.template('category.html',
                                  name=req.cookies.get('username'),
                                  categories=categories)
@@ -495,20 +607,19 @@ async def add_category(req, resp):
             api.redirect(resp, '/admin/category')
             return
 
-        if slug in get_category_slugs():  # 既に同じスラッグが存在します
+        # カテゴリを追加 (既に同じスラッグが存在すれば追加されない)
+        try:
+            cat = Category(name, slug)
+            await async_models.add(cat)
+        except ValueError:
             # 本当はエラー処理を追加すべきだが割愛 その2
-            api.redirect(resp, '/admin/category')
-            return
-
-        # カテゴリを追加
-        cat = Category(name, slug)
-        cat.add()
+            pass
 
         api.redirect(resp, '/admin/category')
 
 
 @api.route('/admin/category/delete')
-def delete_category(req, resp):
+async def delete_category(req, resp):
     """ カテゴリ削除 """
     if req.cookies.get('session') is None:
         api.redirect(resp, '/login')
@@ -523,7 +634,7 @@ def delete_category(req, resp):
             return
 
         # delete
-        delete_category_by_slug(cat_slug)
+        await async_models.delete_category_by_slug(cat_slug)
 
         api.redirect(resp, '/admin/category')
 
@@ -536,40 +647,93 @@ async def update_category(req, resp):
 
     # ログイン済み
     else:
-        # ユーザ情報取得
+        # フォームの内容 (cat_name_{slug}, cat_slug_{slug})
         data = await req.media()
-        categories = get_category_slugs()
+        changes = {}
+        for key in data.keys():
+            for prefix, field in [('cat_name_', 'name'), ('cat_slug_', 'slug')]:
+                if key.startswith(prefix):
+                    changes.setdefault(key[len(prefix):], {})[field] = data.get(key)
 
-        # 全ての更新情報を取得
-        names = [
-            data.get(f'cat_name_{cat_slug}', None) for cat_slug in categories
-        ]
-        slugs = [
-            data.get(f'cat_slug_{cat_slug}', None) for cat_slug in categories
-        ]
-
-        for slug, new_name, new_slug in zip(categories, names, slugs):
-            update_category_by_slug(slug, new_name, new_slug)
+        # 変更のあるものだけを1回のコミットで更新
+        renamed = await async_models.update_categories(changes)
+        if renamed:
+            _update_sitemap(renamed_categories=renamed)
 
         api.redirect(resp, '/admin/category')
 
 
+@api.route('/admin/cache')
+def cache_stats(req, resp):
+    """ キャッシュのヒット率 (チューニング用)  pages は公開ページのレスポンスのキャッシュ """
+    if req.cookies.get('session') is None:
+        api.redirect(resp, '/login')
+
+    # ログイン済み
+    else:
+        resp.media = dict(cache.stats(), pages=cache.page_stats())
+
+
+def _not_modified(req, etag, mtime):
+    """ 条件付きGET: クライアントのキャッシュが最新なら True """
+    if_none_match = req.headers.get('If-None-Match')
+    if if_none_match is not None:  # 弱いETag (W/"...")・複数のETagも公開ページと同じように比較する
+        return _etag_not_modified(if_none_match, etag)
+
+    if_modified_since = req.headers.get('If-Modified-Since')
+    if if_modified_since is not None:
+        try:
+            return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+
+    return False
+
+
+def _send_sitemap(req, resp, name):
+    """ メモリに保持したサイトマップを返す (ETag, Last-Modified, gzip対応) """
+    sitemap = get_sitemap(name)
+    if sitemap is None:
+        resp.status_code = 404
+        return
+
+    use_gzip = 'gzip' in req.headers.get('Accept-Encoding', '')
+    etag = sitemap.gzip_etag if use_gzip else sitemap.etag
+
+    resp.headers['ETag'] = etag
+    resp.headers['Last-Modified'] = sitemap.last_modified
+    resp.headers['Vary'] = 'Accept-Encoding'
+    resp.headers['Content-type'] = 'application/xml'
+
+    if _not_modified(req, etag, sitemap.mtime):
+        resp.status_code = 304
+        return
+
+    if use_gzip:
+        resp.headers['Content-Encoding'] = 'gzip'
+        resp.content = sitemap.gzipped
+    else:
+        resp.content = sitemap.body
+
+
+@api.route('/metrics')
+def metrics_page(req, resp):
+    """ Prometheus 用のメトリクス (ルートごとのFirestoreのRPC・ドキュメント数・処理時間) """
+    resp.text = metrics.expose()
+    resp.headers['Content-Type'] = metrics.CONTENT_TYPE
+
+
 @api.route('/sitemap.xml')
 def sitemap(req, resp):
     """ サイトマップ """
-    resp.text = open('sitemap.xml').read()
-    resp.headers['Content-type'] = 'application/xml'
+    _send_sitemap(req, resp, 'sitemap.xml')
 
 
-def get_images(image_path='static/images/'):
-    """ Get images existing in the directory, [image_path] """
-    files = os.listdir(image_path)
-    extensions = ['.png', '.jpg', '.bmp', 'gif']  # 画像拡張子
-    images = [f'{image_path}{f}'
-              for f in files
-              if os.path.splitext(f)[-1] in extensions  # 画像拡張子のみ取得
-              ]
-    # 降順 = 日付が新しい順
-    images.sort(reverse=True)
+@api.route('/sitemap-{num}.xml')
+def sitemap_child(req, resp, *, num):
+    """ 子サイトマップ (URLが多い場合だけ) """
+    if not num.isdigit():
+        resp.status_code = 404
+        return
 
-    return images
+    _send_sitemap(req, resp, f'sitemap-{num}.xml')
@@ -0,0 +1,293 @@
+"""
+export.py
+公開ページを静的なHTMLとして書き出す (静的ファイルサーバ・CDNで配信する場合)
+
+トップ・カテゴリ一覧・タグ一覧・公開済みの記事・サイトマップ・static を出力先に書き出す．
+ページは controllers と同じ処理(テンプレート)で作成し，プロセスプールで並列に書き出す．
+
+$ python export.py [出力先]                全て書き出す
+$ python export.py [出力先] --incremental  前回から last_update が変わった記事に関係するページだけ書き出す
+
+出力先の構成 (URLは / で終わるディレクトリ)
+    index.html, index-2.html, ...                   トップ (2ページ目以降)
+    category/{category}/index.html, index-2.html    カテゴリごとの一覧
+    tag/{tag}/index.html, index-2.html              タグごとの一覧
+    category/{category}/{slug}/index.html           記事
+
+Copyright (c) RightCode Inc. All rights reserved.
+"""
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from models import get_articles, get_categories, get_tags, _encode_cursor
+import sitemap_generator
+
+OUT_DIR = 'public'
+STATE_FILE = '.export.json'  # 前回書き出した内容 (差分の書き出しに使う)
+STATIC_DIR = 'static'
+
+EXPORT_FIELDS = ('title', 'slug', 'category', 'tags', 'last_update')
+ARTICLES_PER_PAGE = 12  # controllers.ARTICLES_PER_PAGE と同じ
+WHATS_NEW_NUM = 5  # サイドメニューの What's New の件数 (models.get_whats_new)
+
+# 一覧ページのページ送り (?after=..., ?before=...) を書き出したページへのリンクにする
+_PAGER_LINK = re.compile(r'href="\?(after|before)=(\d+)"')
+
+_client = None  # ワーカープロセスごとのテストクライアント
+
+
+def _init_worker():
+    """ ワーカープロセスの初期化 (アプリを読み込む) """
+    global _client
+    from controllers import api
+    _client = api.requests
+
+
+def _write_file(path, data: bytes):
+    """ 一時ファイルに書いてから置き換える (配信中のファイルが壊れない) """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def _export_pages(out_dir, pages):
+    """
+    ページを作成して書き出す (ワーカープロセスで実行)
+    :param out_dir: 出力先
+    :param pages:   [(書き出すファイル, URL, {(after|before, カーソル): リンク先})]
+    :return: 書き出したページ数
+    """
+    for path, url, links in pages:
+        res = _client.get(url)
+        res.raise_for_status()
+        html = res.text
+        if links:
+            html = _PAGER_LINK.sub(lambda m: 'href="{}"'.format(links.get((m[1], m[2]), m[0][6:-1])), html)
+        _write_file(os.path.join(out_dir, path), html.encode('utf-8'))
+    return len(pages)
+
+
+def _listing_pages(base, articles):
+    """
+    一覧ページ (トップ・カテゴリ・タグ)
+    :param base:     一覧のURL ('/', '/category/{category}/', '/tag/{tag}/')
+    :param articles: 一覧に表示する記事 (新しい順)
+    :return: {書き出すファイル: (URL, ページ送りのリンク)}
+    """
+    chunks = [articles[i:i + ARTICLES_PER_PAGE] for i in range(0, len(articles), ARTICLES_PER_PAGE)] or [[]]
+    hrefs = [base if n == 0 else '{}index-{}.html'.format(base, n + 1) for n in range(len(chunks))]
+
+    # 各ページの前後のリンクは，そのページの最初・最後の記事のカーソル
+    links = {}
+    for n, chunk in enumerate(chunks[1:], 1):
+        links[('before', _encode_cursor(chunk[0]['last_update']))] = hrefs[n - 1]
+        links[('after', _encode_cursor(chunks[n - 1][-1]['last_update']))] = hrefs[n]
+
+    pages = {}
+    for n in range(len(chunks)):
+        url = base.rstrip('/') or '/'  # ルーティングは末尾の / なし
+        if n > 0:
+            url += '?after={}'.format(_encode_cursor(chunks[n - 1][-1]['last_update']))
+        path = (base + ('index.html' if n == 0 else 'index-{}.html'.format(n + 1))).lstrip('/')
+        pages[path] = (url, links)
+    return pages
+
+
+def _site_pages(articles, categories, tags):
+    """
+    書き出す全てのページ
+    :return: {'/': {...}, 'category/{category}': {...}, 'tag/{tag}': {...}, 'article/{slug}': {...}}
+             (一覧・記事ごとの _listing_pages の形式)
+    """
+    groups = {'/': _listing_pages('/', articles)}
+
+    by_category = {slug: [] for slug in categories}
+    for art in articles:
+        by_category.setdefault(art['category'], []).append(art)
+    for category, arts in by_category.items():
+        groups['category/' + category] = _listing_pages('/category/{}/'.format(category), arts)
+
+    by_tag = {slug: [] for slug in tags}
+    for art in articles:
+        for tag in art.get('tags') or ():
+            by_tag.setdefault(tag, []).append(art)
+    for tag, arts in by_tag.items():
+        groups['tag/' + tag] = _listing_pages('/tag/{}/'.format(tag), arts)
+
+    for art in articles:
+        path = 'category/{}/{}/index.html'.format(art['category'], art['slug'])
+        groups['article/' + art['slug']] = {path: ('/category/{}/{}'.format(art['category'], art['slug']), None)}
+    return groups
+
+
+def _load_state(out_dir):
+    try:
+        with open(os.path.join(out_dir, STATE_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _state(articles, categories, tags, pages):
+    return {
+        'exported_at': time.time(),
+        'articles': {art['slug']: [art['category'], _encode_cursor(art['last_update']), sorted(art.get('tags') or ())]
+                     for art in articles},
+        'categories': categories,
+        'tags': tags,
+        'whats_new': [[art['slug'], art['title']] for art in articles[:WHATS_NEW_NUM]],
+        'pages': sorted(pages),
+    }
+
+
+def _affected(old, new):
+    """
+    前回からの変更で作り直す必要のあるページのグループ
+    記事の last_update・カテゴリ・タグが変わっていれば，その記事と，前後のカテゴリ・タグ・トップの一覧
+    What's New・カテゴリ・タグの記事数が変わっていれば，サイドメニューのある全てのページ
+    :return: (グループのset, 変更された記事のslug, 公開されなくなった記事のslug)  Noneなら全て
+    """
+    if old is None or old['categories'] != new['categories'] or old.get('tags') != new['tags']:
+        return None, None, None
+
+    changed = [slug for slug, value in new['articles'].items() if old['articles'].get(slug) != value]
+    removed = [slug for slug in old['articles'] if slug not in new['articles']]
+    if not changed and not removed:
+        return set(), changed, removed
+
+    groups = {'/'}
+    for slug in changed + removed:
+        for value in (old['articles'].get(slug), new['articles'].get(slug)):
+            if value is not None:
+                groups.add('category/' + value[0])
+                groups.update('tag/' + tag for tag in value[2])
+    if old['whats_new'] != new['whats_new'] or _counts(old) != _counts(new):
+        groups.update('category/' + slug for slug, _ in new['categories'])
+        groups.update('tag/' + slug for slug, _ in new['tags'])
+        groups.update('article/' + slug for slug in new['articles'])
+    else:
+        groups.update('article/' + slug for slug in changed)
+    return groups, changed, removed
+
+
+def _counts(state):
+    """ サイドメニューに表示するカテゴリ・タグごとの記事数 """
+    counts = {}
+    for category, _, tags in state['articles'].values():
+        for key in ['category/' + category] + ['tag/' + tag for tag in tags]:
+            counts[key] = counts.get(key, 0) + 1
+    return counts
+
+
+def _copy_static(out_dir):
+    """ static をコピー (前回から変わっていないファイルはコピーしない) """
+    copied = 0
+    for root, _, files in os.walk(STATIC_DIR):
+        for name in files:
+            src = os.path.join(root, name)
+            dst = os.path.join(out_dir, src)
+            st = os.stat(src)
+            try:
+                dst_st = os.stat(dst)
+                if dst_st.st_size == st.st_size and dst_st.st_mtime_ns == st.st_mtime_ns:
+                    continue
+            except OSError:
+                pass
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            shutil.copy2(src, dst)
+            copied += 1
+    return copied
+
+
+def _export_sitemap(out_dir, articles, changed, removed):
+    """ サイトマップを更新してから出力先にコピー """
+    if changed is None:
+        sitemap_generator.rebuild_sitemap()
+    elif changed or removed:
+        slugs = set(changed)
+        sitemap_generator.update_sitemap(articles=[art for art in articles if art['slug'] in slugs],
+                                         deleted=removed)
+
+    for pattern in ('sitemap.xml*', 'sitemap-*.xml*'):
+        for path in glob.glob(os.path.join(sitemap_generator.SITEMAP_DIR, pattern)):
+            shutil.copy2(path, os.path.join(out_dir, os.path.basename(path)))
+
+
+def export(out_dir: str = OUT_DIR, incremental: bool = False, workers: int = None):
+    """
+    公開ページを書き出す
+    :param out_dir:     出力先
+    :param incremental: 前回から変わった記事に関係するページだけ書き出す (前回の記録がなければ全て)
+    :param workers:     プロセス数 (Noneならコア数)
+    :return: 書き出したページ数
+    """
+    articles = get_articles(False, fields=EXPORT_FIELDS)  # 公開済み・新しい順
+    categories = sorted([cat['slug'], cat['name']] for cat in get_categories())
+    tags = sorted([tag['slug'], tag['name']] for tag in get_tags())
+
+    groups = _site_pages(articles, [slug for slug, _ in categories], [slug for slug, _ in tags])
+    pages = {path: page for group in groups.values() for path, page in group.items()}
+    old = _load_state(out_dir) if incremental else None
+    new = _state(articles, categories, tags, pages)
+
+    affected, changed, removed = _affected(old, new)
+    if affected is None:
+        todo = list(pages.items())
+    else:
+        todo = [item for name in affected if name in groups for item in groups[name].items()]
+
+    # 作成は記事ごとにFirestoreの読み込みとテンプレートの処理があるので，複数のプロセスで分担する
+    # (gRPCのクライアントは fork したプロセスで使えないので spawn で起動する)
+    written = 0
+    if todo:
+        workers = workers or os.cpu_count() or 1
+        size = max(1, min(50, len(todo) // (workers * 4)))
+        chunks = [[(path, url, links) for path, (url, links) in todo[i:i + size]]
+                  for i in range(0, len(todo), size)]
+        with ProcessPoolExecutor(max_workers=workers,
+                                 mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=_init_worker) as executor:
+            for future in as_completed([executor.submit(_export_pages, out_dir, chunk) for chunk in chunks]):
+                written += future.result()
+
+    # 公開されなくなった記事・減ったページを削除
+    if old is not None:
+        for path in set(old['pages']) - set(pages):
+            try:
+                os.unlink(os.path.join(out_dir, path))
+                if path.endswith('/index.html'):
+                    os.rmdir(os.path.dirname(os.path.join(out_dir, path)))
+            except OSError:
+                pass
+
+    _export_sitemap(out_dir, articles, changed, removed)
+    _copy_static(out_dir)
+    _write_file(os.path.join(out_dir, STATE_FILE), json.dumps(new, ensure_ascii=False).encode('utf-8'))
+    return written
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='公開ページを静的なHTMLとして書き出す')
+    parser.add_argument('out_dir', nargs='?', default=OUT_DIR, help='出力先 (default: {})'.format(OUT_DIR))
+    parser.add_argument('--incremental', action='store_true', help='前回から変更された記事に関係するページだけ書き出す')
+    parser.add_argument('--workers', type=int, default=None, help='プロセス数 (default: コア数)')
+    args = parser.parse_args()
+
+    start = time.monotonic()
+    written = export(args.out_dir, incremental=args.incremental, workers=args.workers)
+    print('{} pages exported to {} ({:.1f}s).'.format(written, args.out_dir, time.monotonic() - start))
@@ -0,0 +1,728 @@
+"""
+fake_firestore.py
+Firestore の代わりにメモリ上で動くクライアント (ベンチマーク・認証情報のない環境用)
+
+BLOG_BACKEND=memory のとき init_db.db / init_db.adb がこれになる．
+models・async_models・bulk が使う範囲 (コレクション・ドキュメント・クエリ・WriteBatch・
+トランザクション・BulkWriter) だけを Firestore と同じ呼び出し方・同じ例外で実装している．
+RPCに相当する操作は metrics に Firestore と同じ名前(run_query, commit など)で記録するので，
+リクエストあたりのRPC数・読み込んだドキュメント数を実際の Firestore と同じように数えられる．
+
+トランザクションは楽観的: 読み込んだドキュメントがコミットまでに書き換えられていれば Aborted で再試行する．
+スナップショットリスナー(on_snapshot)は登録時に1度，その後はコレクションへの書き込みのたびに書き込んだスレッドで呼ばれる．
+
+Copyright (c) RightCode Inc. All rights reserved.
+"""
+import asyncio
+import copy
+import functools
+import operator
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+from google.api_core.exceptions import Aborted, AlreadyExists, NotFound
+from google.cloud.firestore_v1.transforms import Increment
+from google.cloud.firestore_v1.watch import ChangeType, DocumentChange
+
+import metrics
+
+MAX_ATTEMPTS = 5  # トランザクションの試行回数 (Firestore のデフォルトと同じ)
+
+_OPERATORS = {
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    'in': lambda value, values: value in values,
+    'not-in': lambda value, values: value not in values,
+    'array_contains': lambda value, item: isinstance(value, list) and item in value,
+    'array_contains_any': lambda value, items: isinstance(value, list) and any(item in value for item in items),
+}
+
+_MISSING = object()
+
+
+def _normalize(value):
+    """ 保存する値: Firestore と同じく日時はUTCのaware (naiveはUTCとみなす) """
+    if isinstance(value, datetime):
+        return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value.astimezone(timezone.utc)
+    if isinstance(value, dict):
+        return {k: _normalize(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_normalize(v) for v in value]
+    return value
+
+
+def _sort_key(value):
+    """ 型の違う値も Firestore と同じ順(null < bool < 数値 < 日時 < 文字列 < ...)で比較できるようにする """
+    if value is None:
+        return 0, 0
+    if isinstance(value, bool):
+        return 1, value
+    if isinstance(value, (int, float)):
+        return 2, value
+    if isinstance(value, datetime):
+        return 3, _normalize(value)
+    if isinstance(value, str):
+        return 4, value
+    if isinstance(value, bytes):
+        return 5, value
+    return 6, repr(value)
+
+
+class _Store(object):
+    def __init__(self):
+        """ 全てのドキュメント {(コレクション, ID): データ} と更新回数 """
+        self.lock = threading.RLock()
+        self.docs = {}
+        self.versions = {}
+        self.watches = []
+        self.latency = 0.0  # RPCごとに待つ時間 [s] (ネットワークの往復の代わり)
+
+    def record(self, rpc: str, start: float, documents: int = 0, writes: int = 0):
+        """ metrics.instrument_firestore と同じ形で記録 """
+        route = metrics.current_route.get()
+        metrics.firestore_seconds.observe(time.perf_counter() - start + self.latency, route, rpc)
+        if documents:
+            metrics.firestore_documents.inc(route, rpc, amount=documents)
+        if writes:
+            metrics.firestore_writes.inc(route, rpc, amount=writes)
+
+    def read(self, key):
+        """ :return: (データ, 更新回数)  存在しなければ (None, 更新回数) """
+        with self.lock:
+            data = self.docs.get(key)
+            return (copy.deepcopy(data) if data is not None else None), self.versions.get(key, 0)
+
+    def commit(self, writes: list, read_versions: dict = None):
+        """
+        書き込みをまとめて反映 (途中で失敗すれば何も反映しない)
+        :param writes:        [(処理, (コレクション, ID), データ, オプション)]
+        :param read_versions: トランザクションで読み込んだドキュメントの更新回数
+        """
+        with self.lock:
+            for key, version in (read_versions or {}).items():
+                if self.versions.get(key, 0) != version:
+                    raise Aborted('Transaction lock timeout (document was modified).')
+
+            docs = {}
+            for op, key, data, option in writes:
+                current = docs[key] if key in docs else self.docs.get(key)
+                docs[key] = _apply(op, key, current, data, option)
+
+            for key, data in docs.items():
+                if data is None:
+                    self.docs.pop(key, None)
+                else:
+                    self.docs[key] = data
+                self.versions[key] = self.versions.get(key, 0) + 1
+
+            collections = {key[0] for key in docs}
+            for watch in list(self.watches):
+                if watch.collection_id in collections:
+                    watch.notify()
+
+    def query(self, query):
+        with self.lock:
+            return [(key[1], copy.deepcopy(data)) for key, data in self.docs.items() if key[0] == query.collection_id]
+
+
+def _transform(current, data: dict):
+    """ Increment を現在の値に適用 """
+    result = {}
+    for field, value in data.items():
+        if isinstance(value, Increment):
+            base = (current or {}).get(field)
+            value = (base if isinstance(base, (int, float)) and not isinstance(base, bool) else 0) + value.value
+        result[field] = _normalize(value)
+    return result
+
+
+def _apply(op: str, key, current, data, option):
+    """ 1件の書き込みの結果 (削除ならNone) """
+    path = '{}/{}'.format(*key)
+    if op == 'create':
+        if current is not None:
+            raise AlreadyExists('Document already exists: {}'.format(path))
+        return _transform(None, data)
+    if op == 'set':
+        if option:  # merge
+            return dict(current or {}, **_transform(current, data))
+        return _transform(None, data)
+    if op == 'update':
+        if current is None:
+            raise NotFound('No document to update: {}'.format(path))
+        return dict(current, **_transform(current, data))
+    # delete
+    if option is not None and option.get('exists') and current is None:
+        raise NotFound('No document to delete: {}'.format(path))
+    return None
+
+
+# --- ドキュメント ---
+
+class DocumentSnapshot(object):
+    def __init__(self, reference, data: dict, fields=None):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        if data is not None and fields is not None:
+            data = {field: data[field] for field in fields if field in data}
+        self._data = data
+
+    def to_dict(self):
+        return copy.deepcopy(self._data)
+
+    def get(self, field: str):
+        return self._data[field]
+
+
+class DocumentReference(object):
+    def __init__(self, client, collection_id: str, document_id: str):
+        self._client = client
+        self.id = document_id
+        self.parent = client.collection(collection_id)
+        self.path = '{}/{}'.format(collection_id, document_id)
+
+    @property
+    def _key(self):
+        return self.parent.id, self.id
+
+    def __eq__(self, other):
+        return isinstance(other, DocumentReference) and self._key == other._key
+
+    def __hash__(self):
+        return hash(self._key)
+
+    def _get(self, transaction=None):
+        store = self._client._store
+        start = time.perf_counter()
+        data, version = store.read(self._key)
+        if transaction is not None:
+            transaction._read_versions.setdefault(self._key, version)
+        store.record('batch_get_documents', start, documents=1)
+        return DocumentSnapshot(self, data)
+
+    def _write(self, op: str, data=None, option=None):
+        store = self._client._store
+        start = time.perf_counter()
+        store.commit([(op, self._key, data, option)])
+        store.record('commit', start, writes=1)
+
+    def get(self, field_paths=None, transaction=None):
+        self._client._sleep()
+        return self._get(transaction)
+
+    def create(self, document_data: dict):
+        self._client._sleep()
+        self._write('create', document_data)
+
+    def set(self, document_data: dict, merge: bool = False):
+        self._client._sleep()
+        self._write('set', document_data, merge)
+
+    def update(self, field_updates: dict, option=None):
+        self._client._sleep()
+        self._write('update', field_updates)
+
+    def delete(self, option=None):
+        self._client._sleep()
+        self._write('delete', None, option)
+
+
+class AsyncDocumentReference(DocumentReference):
+    async def get(self, field_paths=None, transaction=None):
+        await self._client._sleep()
+        return self._get(transaction)
+
+    async def create(self, document_data: dict):
+        await self._client._sleep()
+        self._write('create', document_data)
+
+    async def set(self, document_data: dict, merge: bool = False):
+        await self._client._sleep()
+        self._write('set', document_data, merge)
+
+    async def update(self, field_updates: dict, option=None):
+        await self._client._sleep()
+        self._write('update', field_updates)
+
+    async def delete(self, option=None):
+        await self._client._sleep()
+        self._write('delete', None, option)
+
+
+# --- クエリ ---
+
+class Query(object):
+    ASCENDING = 'ASCENDING'
+    DESCENDING = 'DESCENDING'
+
+    def __init__(self, client, collection_id: str, filters=(), fields=None, orders=(), limit=None,
+                 limit_to_last=False, start=None, end=None):
+        self._client = client
+        self.collection_id = collection_id
+        self._filters = filters
+        self._fields = fields
+        self._orders = orders
+        self._limit = limit
+        self._limit_to_last = limit_to_last
+        self._start = start  # (値のリスト, 前後のどちらか) start_after
+        self._end = end  # end_before
+
+    def _copy(self, **changes):
+        attrs = dict(filters=self._filters, fields=self._fields, orders=self._orders, limit=self._limit,
+                     limit_to_last=self._limit_to_last, start=self._start, end=self._end)
+        attrs.update(changes)
+        return self._client._query_class(self._client, self.collection_id, **attrs)
+
+    def where(self, field_path: str, op_string: str, value):
+        if op_string not in _OPERATORS:
+            raise ValueError('Operator string {!r} is invalid.'.format(op_string))
+        return self._copy(filters=self._filters + ((field_path, op_string, value),))
+
+    def select(self, field_paths):
+        return self._copy(fields=tuple(field_paths))
+
+    def order_by(self, field_path: str, direction: str = ASCENDING):
+        return self._copy(orders=self._orders + ((field_path, direction),))
+
+    def limit(self, count: int):
+        return self._copy(limit=count, limit_to_last=False)
+
+    def limit_to_last(self, count: int):
+        return self._copy(limit=count, limit_to_last=True)
+
+    def _cursor(self, document_fields_or_snapshot):
+        """ 並び順のフィールドの値 (スナップショットならドキュメントIDまで) """
+        if isinstance(document_fields_or_snapshot, DocumentSnapshot):
+            snapshot = document_fields_or_snapshot
+            data = dict(snapshot._data or {}, __name__=snapshot.id)
+            return [data.get(field) for field, _ in self._all_orders()]
+        values = document_fields_or_snapshot
+        return [values[field] for field, _ in self._orders if field in values]
+
+    def start_after(self, document_fields_or_snapshot):
+        return self._copy(start=self._cursor(document_fields_or_snapshot))
+
+    def end_before(self, document_fields_or_snapshot):
+        return self._copy(end=self._cursor(document_fields_or_snapshot))
+
+    def _all_orders(self):
+        """ 最後にドキュメントIDの順 (最後の並び順と同じ向き) が付く """
+        orders = list(self._orders)
+        if not any(field == '__name__' for field, _ in orders):
+            orders.append(('__name__', orders[-1][1] if orders else self.ASCENDING))
+        return orders
+
+    def _compare(self, values, cursor, orders):
+        """ 並び順でのドキュメントとカーソルの比較 (-1: 前, 0: 同じ, 1: 後) """
+        for value, bound, (_, direction) in zip(values, cursor, orders):
+            a, b = _sort_key(value), _sort_key(bound)
+            if a != b:
+                result = -1 if a < b else 1
+                return -result if direction == self.DESCENDING else result
+        return 0
+
+    def _matches(self, data: dict):
+        for field, op, value in self._filters:
+            if field not in data or not _OPERATORS[op](data[field], value):
+                return False
+        return True
+
+    def _rows(self):
+        """ 条件に合うドキュメントを並べたもの [(DocumentSnapshot, 全てのフィールド)] """
+        store = self._client._store
+        orders = self._all_orders()
+
+        rows = []
+        for doc_id, data in store.query(self):
+            if not self._matches(data):
+                continue
+            data_with_name = dict(data, __name__=doc_id)
+            if any(field not in data_with_name for field, _ in orders):  # 並び順のフィールドがないものは含まない
+                continue
+            rows.append(([data_with_name[field] for field, _ in orders], doc_id, data))
+
+        for i in reversed(range(len(orders))):  # 後ろのキーから安定ソート
+            rows.sort(key=lambda row: _sort_key(row[0][i]), reverse=orders[i][1] == self.DESCENDING)
+
+        if self._start is not None:
+            rows = [row for row in rows if self._compare(row[0], self._start, orders) > 0]
+        if self._end is not None:
+            rows = [row for row in rows if self._compare(row[0], self._end, orders) < 0]
+        if self._limit is not None:
+            rows = rows[-self._limit:] if self._limit_to_last else rows[:self._limit]
+
+        collection = self._client.collection(self.collection_id)
+        return [(DocumentSnapshot(collection.document(doc_id), data, self._fields), data) for _, doc_id, data in rows]
+
+    def _run(self):
+        start = time.perf_counter()
+        snapshots = [snapshot for snapshot, _ in self._rows()]
+        self._client._store.record('run_query', start, documents=len(snapshots))
+        return snapshots
+
+    def stream(self, transaction=None):
+        self._client._sleep()
+        yield from self._run()
+
+    def get(self, transaction=None):
+        self._client._sleep()
+        return self._run()
+
+    def on_snapshot(self, callback):
+        """ callback(docs, changes, read_time) を今の結果で1度呼び，以降は書き込みのたびに呼ぶ """
+        return Watch(self, callback)
+
+
+class Watch(object):
+    def __init__(self, query: Query, callback):
+        """ 前回の結果 {ID: データ} との差分を DocumentChange にして渡す """
+        self._query = query
+        self._callback = callback
+        self._last = None  # まだ呼んでいない
+        self.collection_id = query.collection_id
+
+        store = query._client._store
+        with store.lock:
+            store.watches.append(self)
+            self.notify()
+
+    def notify(self):
+        rows = self._query._rows()
+        current = {snapshot.id: data for snapshot, data in rows}
+        first, last = self._last is None, self._last or {}
+        changes = []
+        for index, (snapshot, data) in enumerate(rows):
+            if snapshot.id not in last:
+                changes.append(DocumentChange(ChangeType.ADDED, snapshot, -1, index))
+            elif last[snapshot.id] != data:
+                changes.append(DocumentChange(ChangeType.MODIFIED, snapshot, index, index))
+        collection = self._query._client.collection(self.collection_id)
+        for doc_id in last.keys() - current.keys():
+            changes.append(DocumentChange(ChangeType.REMOVED, DocumentSnapshot(collection.document(doc_id), None), 0, -1))
+        self._last = current
+
+        if changes or first:  # 最初の1回は空でも呼ぶ
+            self._callback([snapshot for snapshot, _ in rows], changes, datetime.now(timezone.utc))
+
+    def unsubscribe(self):
+        store = self._query._client._store
+        with store.lock:
+            if self in store.watches:
+                store.watches.remove(self)
+
+
+class AsyncQuery(Query):
+    async def stream(self, transaction=None):
+        await self._client._sleep()
+        for snapshot in self._run():
+            yield snapshot
+
+    async def get(self, transaction=None):
+        await self._client._sleep()
+        return self._run()
+
+
+class _Collection(object):
+    def _init_collection(self, collection_id: str):
+        self.id = collection_id
+
+    def document(self, document_id: str = None):
+        return self._client._document_class(self._client, self.id, document_id or uuid.uuid4().hex[:20])
+
+
+class CollectionReference(_Collection, Query):
+    def __init__(self, client, collection_id: str):
+        Query.__init__(self, client, collection_id)
+        self._init_collection(collection_id)
+
+
+class AsyncCollectionReference(_Collection, AsyncQuery):
+    def __init__(self, client, collection_id: str):
+        AsyncQuery.__init__(self, client, collection_id)
+        self._init_collection(collection_id)
+
+
+# --- 書き込み ---
+
+class WriteBatch(object):
+    def __init__(self, client):
+        self._client = client
+        self._writes = []
+
+    def create(self, reference, document_data: dict):
+        self._writes.append(('create', reference._key, document_data, None))
+
+    def set(self, reference, document_data: dict, merge: bool = False):
+        self._writes.append(('set', reference._key, document_data, merge))
+
+    def update(self, reference, field_updates: dict, option=None):
+        self._writes.append(('update', reference._key, field_updates, None))
+
+    def delete(self, reference, option=None):
+        self._writes.append(('delete', reference._key, None, option))
+
+    def _commit(self, read_versions=None):
+        store = self._client._store
+        start = time.perf_counter()
+        try:
+            store.commit(self._writes, read_versions)
+        finally:
+            store.record('commit', start, writes=len(self._writes))
+        self._writes = []
+
+    def commit(self):
+        self._client._sleep()
+        self._commit()
+
+
+class AsyncWriteBatch(WriteBatch):
+    async def commit(self):
+        await self._client._sleep()
+        self._commit()
+
+
+class Transaction(WriteBatch):
+    def __init__(self, client):
+        super().__init__(client)
+        self._read_versions = {}
+
+    def _begin(self):
+        self._writes = []
+        self._read_versions = {}
+        self._client._store.record('begin_transaction', time.perf_counter())
+
+    def _rollback(self):
+        self._writes = []
+        self._client._store.record('rollback', time.perf_counter())
+
+    def _get_all(self, references):
+        return [ref._get(transaction=self) for ref in references]
+
+    def get_all(self, references):
+        self._client._sleep()
+        yield from self._get_all(references)
+
+
+class AsyncTransaction(Transaction):
+    async def get_all(self, references):
+        await self._client._sleep()
+        snapshots = self._get_all(references)
+
+        async def generate():
+            for snapshot in snapshots:
+                yield snapshot
+
+        return generate()
+
+
+def transactional(to_wrap):
+    """ google.cloud.firestore.transactional と同じ使い方 (Aborted なら最初からやり直す) """
+    @functools.wraps(to_wrap)
+    def wrapper(transaction, *args, **kwargs):
+        for attempt in range(MAX_ATTEMPTS):
+            transaction._client._sleep()
+            transaction._begin()
+            try:
+                result = to_wrap(transaction, *args, **kwargs)
+                transaction._client._sleep()
+                transaction._commit(transaction._read_versions)
+                return result
+            except Aborted:
+                transaction._rollback()
+                if attempt == MAX_ATTEMPTS - 1:
+                    raise
+            except BaseException:
+                transaction._rollback()
+                raise
+
+    wrapper.to_wrap = to_wrap
+    return wrapper
+
+
+def async_transactional(to_wrap):
+    """ google.cloud.firestore.async_transactional と同じ使い方 """
+    @functools.wraps(to_wrap)
+    async def wrapper(transaction, *args, **kwargs):
+        for attempt in range(MAX_ATTEMPTS):
+            await transaction._client._sleep()
+            transaction._begin()
+            try:
+                result = await to_wrap(transaction, *args, **kwargs)
+                await transaction._client._sleep()
+                transaction._commit(transaction._read_versions)
+                return result
+            except Aborted:
+                transaction._rollback()
+                if attempt == MAX_ATTEMPTS - 1:
+                    raise
+            except BaseException:
+                transaction._rollback()
+                raise
+
+    wrapper.to_wrap = to_wrap
+    return wrapper
+
+
+class BulkWriteFailure(object):
+    def __init__(self, operation, code: int, message: str, attempts: int):
+        self.operation = operation
+        self.code = code
+        self.message = message
+        self.attempts = attempts
+
+
+class _BulkOperation(object):
+    def __init__(self, op, reference, data, option):
+        self.op = op
+        self.reference = reference
+        self.data = data
+        self.option = option
+
+
+class BulkWriter(object):
+    # gRPC のステータスコード
+    _CODES = {AlreadyExists: 6, NotFound: 5, Aborted: 10}
+
+    def __init__(self, client):
+        """ 書き込みを1件ずつコミットし，失敗は on_write_error のコールバックで再試行を判断する """
+        self._client = client
+        self._operations = []
+        self._on_error = lambda failure, writer: failure.attempts < MAX_ATTEMPTS and failure.code == 10
+
+    def on_write_error(self, callback):
+        self._on_error = callback
+
+    def create(self, reference, document_data: dict):
+        self._operations.append(_BulkOperation('create', reference, document_data, None))
+
+    def set(self, reference, document_data: dict, merge: bool = False):
+        self._operations.append(_BulkOperation('set', reference, document_data, merge))
+
+    def update(self, reference, field_updates: dict):
+        self._operations.append(_BulkOperation('update', reference, field_updates, None))
+
+    def delete(self, reference, option=None):
+        self._operations.append(_BulkOperation('delete', reference, None, option))
+
+    def flush(self):
+        operations, self._operations = self._operations, []
+        store = self._client._store
+        for operation in operations:
+            attempts = 0
+            while True:
+                attempts += 1
+                start = time.perf_counter()
+                try:
+                    store.commit([(operation.op, operation.reference._key, operation.data, operation.option)])
+                    store.record('batch_write', start, writes=1)
+                    break
+                except (AlreadyExists, NotFound, Aborted) as e:
+                    store.record('batch_write', start)
+                    failure = BulkWriteFailure(operation, self._CODES[type(e)], str(e), attempts)
+                    if not self._on_error(failure, self):
+                        break
+
+    def close(self):
+        self.flush()
+
+
+# --- クライアント ---
+
+class Client(object):
+    _query_class = Query
+    _collection_class = CollectionReference
+    _document_class = DocumentReference
+    _batch_class = WriteBatch
+    _transaction_class = Transaction
+
+    def __init__(self, store: _Store = None):
+        self._store = store or _Store()
+        self._collections = {}
+
+    def _sleep(self):
+        if self._store.latency:
+            time.sleep(self._store.latency)
+
+    @property
+    def latency(self):
+        return self._store.latency
+
+    @latency.setter
+    def latency(self, seconds: float):
+        """ RPCごとに待つ時間 [s] (同じデータを使う非同期のクライアントにも反映される) """
+        self._store.latency = seconds
+
+    def collection(self, collection_id: str):
+        collection = self._collections.get(collection_id)
+        if collection is None:
+            collection = self._collections[collection_id] = self._collection_class(self, collection_id)
+        return collection
+
+    def document(self, document_path: str):
+        collection_id, document_id = document_path.split('/')
+        return self.collection(collection_id).document(document_id)
+
+    def batch(self):
+        return self._batch_class(self)
+
+    def transaction(self, **kwargs):
+        return self._transaction_class(self)
+
+    def bulk_writer(self, options=None):
+        return BulkWriter(self)
+
+    @staticmethod
+    def write_option(**kwargs):
+        return kwargs
+
+    def get_all(self, references, transaction=None):
+        self._sleep()
+        for ref in references:
+            yield ref._get(transaction)
+
+    def dump(self):
+        """ 今の全てのドキュメント (load で戻せる) """
+        with self._store.lock:
+            return dict(self._store.docs)  # 保存したデータは書き換えずに置き換えるので浅いコピーでよい
+
+    def load(self, docs: dict):
+        """ dump した時点のドキュメントに戻す (読み込み中のトランザクションは Aborted になる) """
+        store = self._store
+        with store.lock:
+            for key in store.docs.keys() | docs.keys():
+                store.versions[key] = store.versions.get(key, 0) + 1
+            store.docs = dict(docs)
+            for watch in list(store.watches):
+                watch.notify()
+
+    def clear(self):
+        """ 全てのドキュメントを削除 """
+        self.load({})
+
+
+class AsyncClient(Client):
+    _query_class = AsyncQuery
+    _collection_class = AsyncCollectionReference
+    _document_class = AsyncDocumentReference
+    _batch_class = AsyncWriteBatch
+    _transaction_class = AsyncTransaction
+
+    def __init__(self, client: Client = None):
+        """ :param client: データを共有する同期版のクライアント """
+        super().__init__(client._store if client is not None else None)
+
+    async def _sleep(self):
+        if self._store.latency:
+            await asyncio.sleep(self._store.latency)
+
+    async def get_all(self, references, transaction=None):
+        await self._sleep()
+        for ref in references:
+            yield ref._get(transaction)
@@ -0,0 +1,80 @@
+"""
+identity_toolkit.py
+Identity Toolkit (Firebase Authentication の REST API) のクライアント
+
+APIキーは最初の呼び出しで一度だけ読み込み，接続はプールして使い回す (keep-alive)．
+タイムアウトを設定し，接続できない・5xx の場合は間隔を空けて再試行する．
+async def のハンドラからは apost() を使う (イベントループを止めない)．
+
+Copyright (c) RightCode Inc. All rights reserved.
+"""
+import asyncio
+import functools
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+API_KEY_FILE = 'private/apikey.txt'
+BASE_URL = 'https://identitytoolkit.googleapis.com/v1/'
+
+TIMEOUT = (3.05, 10)  # (接続, 読み込み) [s]
+POOL_SIZE = 10
+RETRIES = 3
+BACKOFF = 0.3  # 再試行の間隔 0.3s, 0.6s, 1.2s
+
+# 通信できなかった場合も Identity Toolkit のエラーと同じ形で返す
+NETWORK_ERROR = 'NETWORK_ERROR'
+
+
+class IdentityToolkit(object):
+    def __init__(self, api_key_file: str = API_KEY_FILE, base_url: str = BASE_URL):
+        self.api_key_file = api_key_file
+        self.base_url = base_url
+        self._api_key = None
+
+        retry = Retry(total=RETRIES, backoff_factor=BACKOFF, status_forcelist=(500, 502, 503, 504),
+                      allowed_methods=None)  # POSTも再試行する
+        no_retry = Retry(total=RETRIES, connect=RETRIES, read=0, status=0, other=0, backoff_factor=BACKOFF)
+
+        self.session = requests.Session()
+        self.session.headers['Content-type'] = 'application/json'
+        self.session.mount('https://', HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE,
+                                                   max_retries=retry))
+
+        # 送信済みの可能性がある場合に再試行すると困るもの(ユーザの作成など)用: 接続できなかった場合だけ再試行
+        self._once = requests.Session()
+        self._once.headers['Content-type'] = 'application/json'
+        self._once.mount('https://', HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE,
+                                                 max_retries=no_retry))
+
+    @property
+    def api_key(self):
+        if self._api_key is None:
+            with open(self.api_key_file) as f:
+                self._api_key = f.read().strip()
+        return self._api_key
+
+    def post(self, method: str, data: dict, retry: bool = True):
+        """
+        APIを呼び出す
+        :param method: 'accounts:signInWithPassword' など
+        :param data:   送信するデータ
+        :param retry:  False => 接続できなかった場合だけ再試行 (二重に実行されると困るもの)
+        :return: レスポンス (エラーの場合も {'error': {...}} のdict)
+        """
+        session = self.session if retry else self._once
+        try:
+            res = session.post(self.base_url + method, params={'key': self.api_key}, json=data, timeout=TIMEOUT)
+            return res.json()
+        except (requests.RequestException, ValueError) as e:
+            return {'error': {'code': 503, 'message': NETWORK_ERROR,
+                              'errors': [{'message': NETWORK_ERROR, 'reason': str(e)}]}}
+
+    async def apost(self, method: str, data: dict, retry: bool = True):
+        """ post() の非同期版 (スレッドで実行し，接続プールは共有する) """
+        return await asyncio.get_running_loop().run_in_executor(
+            None, functools.partial(self.post, method, data, retry=retry))
+
+
+client = IdentityToolkit()
@@ -1,13 +1,38 @@
 """
 Initialize Database of Firestore
+
+BLOG_BACKEND=memory なら Firestore の代わりにメモリ上のクライアント(fake_firestore)を使う
+(認証情報のない環境・ベンチマーク用．データはプロセスの終了で消える)
 """
+import os
+
+import metrics
+
+BACKEND = os.environ.get('BLOG_BACKEND', 'firestore')
+
+if BACKEND == 'memory':
+    import fake_firestore
+
+    # RPCの回数・読み込んだドキュメント数は fake_firestore が Firestore と同じ名前で記録する (/metrics)
+    db = fake_firestore.Client()
+    adb = fake_firestore.AsyncClient(db)  # 同じデータを使う
+    transactional = fake_firestore.transactional
+    async_transactional = fake_firestore.async_transactional
+
+else:
+    import firebase_admin
+    from firebase_admin import credentials
+    from firebase_admin import firestore
+    from firebase_admin import firestore_async
+    from google.cloud.firestore import transactional, async_transactional
 
-import firebase_admin
-from firebase_admin import credentials
-from firebase_admin import firestore
+    # Use a service account
+    cred = credentials.Certificate('private/keys.json')
+    firebase_admin.initialize_app(cred)
 
-# Use a service account
-cred = credentials.Certificate('private/keys.json')
-firebase_admin.initialize_app(cred)
+    db = firestore.client()
+    adb = firestore_async.client()  # async def のハンドラ用 (async_models)
 
-db = firestore.client()
+    # RPCの回数・時間・読み込んだドキュメント数を記録する (/metrics)
+    metrics.instrument_firestore(db)
+    metrics.instrument_firestore(adb)
@@ -0,0 +1,536 @@
+"""
+media.py
+メディア(画像)の保存
+
+アップロードはリクエストを読みながら static/images/ の一時ファイルに書き込み，
+最後まで受け取れたら rename で置き換える (ファイル全体をメモリに載せない)．
+サイズ・種類の上限を超えたものは途中で打ち切る．
+受け取りながら計算したハッシュをファイル名に入れ，同じ画像が既にあれば保存せずにそれを使う．
+
+保存した画像は，バックグラウンドのプロセスプールで幅ごとに縮小した画像とWebPを
+static/images/variants/ に作成する (記事の <img> は renderer で srcset にする)．
+既にある画像の分は
+$ python media.py
+で作成する．
+
+メディア一覧は毎回ディレクトリを読まずに MediaIndex (ファイルに保存した一覧) から返す．
+
+Copyright (c) RightCode Inc. All rights reserved.
+"""
+import bisect
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import re
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from python_multipart.multipart import MultipartParser, parse_options_header
+
+logger = logging.getLogger(__name__)
+
+IMAGE_DIR = 'static/images'
+MAX_UPLOAD_SIZE = 10 * 1024 * 1024  # 1ファイルの上限 [byte]
+
+# 保存できる画像 (拡張子 => ファイルの先頭のバイト列)
+# 拡張子だけでなく中身も確認する
+IMAGE_TYPES = {
+    '.png': (b'\x89PNG\r\n\x1a\n',),
+    '.jpg': (b'\xff\xd8\xff',),
+    '.gif': (b'GIF87a', b'GIF89a'),
+    '.bmp': (b'BM',),
+}
+EXTENSION_ALIASES = {'.jpeg': '.jpg'}
+
+HASH_LENGTH = 12  # ファイル名に入れるハッシュの長さ
+
+# 縮小した画像 ({元のファイル名}-{幅}w.{webp|元の形式})
+VARIANT_DIR = IMAGE_DIR + '/variants'
+VARIANT_WIDTHS = (320, 640, 1280)  # 元の画像より小さいものだけ作る
+VARIANT_TYPES = ('.png', '.jpg', '.bmp')  # gifはアニメーションがあるのでそのまま
+WEBP_QUALITY = 80
+JPEG_QUALITY = 85
+VARIANT_WORKERS = 2
+_SIGNATURE_LENGTH = max(len(sig) for sigs in IMAGE_TYPES.values() for sig in sigs)
+_UNSAFE_CHARS = re.compile(r'[^\w.-]')
+
+
+class UploadError(ValueError):
+    def __init__(self, message: str, status_code: int = 400):
+        """ 保存できないアップロード (status_code はレスポンスのステータス) """
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class Upload(object):
+    def __init__(self, filename: str, size: int, digest: str, elapsed: float, duplicated: bool):
+        """ 保存した画像 """
+        self.filename = filename
+        self.path = '{}/{}'.format(IMAGE_DIR, filename)
+        self.size = size
+        self.digest = digest
+        self.elapsed = elapsed
+        self.duplicated = duplicated  # 同じ画像が既にあった
+
+    @property
+    def throughput(self):
+        """ 受信速度 [byte/s] """
+        return self.size / self.elapsed if self.elapsed > 0 else 0.0
+
+
+def _safe_filename(filename: str):
+    """ パスを含まない，URLにそのまま使えるファイル名にする (拡張子は小文字に統一) """
+    name, ext = os.path.splitext(os.path.basename(filename.replace('\\', '/')))
+    ext = ext.lower()
+    ext = EXTENSION_ALIASES.get(ext, ext)
+    if ext not in IMAGE_TYPES:
+        raise UploadError('アップロードできるのは画像({})のみです'.format(', '.join(IMAGE_TYPES)), 415)
+
+    name = _UNSAFE_CHARS.sub('_', name).lstrip('.') or 'image'
+    return name + ext
+
+
+def _too_large(max_size: int):
+    return UploadError('ファイルが大きすぎます (上限 {}MB)'.format(max_size // (1024 * 1024)), 413)
+
+
+class _FileReceiver(object):
+    def __init__(self, field: str, image_dir: str, max_size: int):
+        """ multipart の1つのフィールドを一時ファイルに書き込む (MultipartParser のコールバック) """
+        self.field = field
+        self.image_dir = image_dir
+        self.max_size = max_size
+
+        self.filename = None
+        self.tmp = None
+        self.size = 0
+        self.head = b''
+        self.hash = hashlib.sha256()
+        self.done = False
+
+        self._file = None
+        self._headers = {}
+        self._header_field = b''
+        self._header_value = b''
+        self._receiving = False
+
+    def callbacks(self):
+        return {
+            'on_part_begin': self._on_part_begin,
+            'on_header_field': self._on_header_field,
+            'on_header_value': self._on_header_value,
+            'on_header_end': self._on_header_end,
+            'on_headers_finished': self._on_headers_finished,
+            'on_part_data': self._on_part_data,
+            'on_part_end': self._on_part_end,
+        }
+
+    def _on_part_begin(self):
+        self._headers = {}
+
+    def _on_header_field(self, data, start, end):
+        self._header_field += data[start:end]
+
+    def _on_header_value(self, data, start, end):
+        self._header_value += data[start:end]
+
+    def _on_header_end(self):
+        self._headers[self._header_field.lower()] = self._header_value
+        self._header_field = self._header_value = b''
+
+    def _on_headers_finished(self):
+        _, options = parse_options_header(self._headers.get(b'content-disposition', b''))
+        name = options.get(b'name', b'').decode('utf-8', 'replace')
+        filename = options.get(b'filename', b'').decode('utf-8', 'replace')
+        self._receiving = name == self.field and bool(filename) and not self.done
+        if not self._receiving:
+            return
+
+        self.filename = _safe_filename(filename)
+        fd, self.tmp = tempfile.mkstemp(dir=self.image_dir, prefix='.upload-', suffix='.tmp')
+        self._file = os.fdopen(fd, 'wb')
+
+    def _on_part_data(self, data, start, end):
+        if not self._receiving:
+            return
+
+        chunk = data[start:end]
+        self.size += len(chunk)
+        if self.size > self.max_size:
+            raise _too_large(self.max_size)
+
+        if len(self.head) < _SIGNATURE_LENGTH:
+            self.head += chunk[:_SIGNATURE_LENGTH - len(self.head)]
+        self.hash.update(chunk)
+        self._file.write(chunk)
+
+    def _on_part_end(self):
+        if self._receiving:
+            self._file.close()
+            self._file = None
+            self._receiving = False
+            self.done = True
+
+    def cleanup(self):
+        """ 一時ファイルを削除 (保存しなかった場合) """
+        if self._file is not None:
+            self._file.close()
+        if self.tmp is not None and os.path.exists(self.tmp):
+            os.unlink(self.tmp)
+
+
+async def save_upload(req, field: str = 'file', media_index=None, max_size: int = MAX_UPLOAD_SIZE):
+    """
+    multipart/form-data で送られた画像を保存
+    :param req:         リクエスト (本文はまだ読み込んでいないこと)
+    :param field:       ファイルのフィールド名
+    :param media_index: 保存先の MediaIndex (同じ画像があるかもこれで調べる)  Noneなら static/images/
+    :param max_size:    ファイルサイズの上限 [byte]
+    :return: Upload
+    """
+    if media_index is None:
+        media_index = index
+    image_dir = media_index.image_dir
+
+    content_type, options = parse_options_header(req.headers.get('Content-Type', ''))
+    if content_type != b'multipart/form-data' or b'boundary' not in options:
+        raise UploadError('ファイルが選択されていません')
+
+    # ファイル以外の部分の分だけ余裕を持たせて，明らかに大きいものは読み込まずに断る
+    limit = max_size + 64 * 1024
+    content_length = req.headers.get('Content-Length', '')
+    if content_length.isdigit() and int(content_length) > limit:
+        raise _too_large(max_size)
+
+    receiver = _FileReceiver(field, image_dir, max_size)
+    parser = MultipartParser(options[b'boundary'], receiver.callbacks())
+    start = time.monotonic()
+    try:
+        received = 0
+        async for chunk in req.stream():
+            received += len(chunk)
+            if received > limit:
+                raise _too_large(max_size)
+            parser.write(chunk)
+        parser.finalize()
+        elapsed = time.monotonic() - start
+
+        if not receiver.done or receiver.size == 0:
+            raise UploadError('ファイルが選択されていません')
+
+        ext = os.path.splitext(receiver.filename)[1]
+        if not receiver.head.startswith(IMAGE_TYPES[ext]):
+            raise UploadError('画像として読み込めないファイルです', 415)
+
+        digest = receiver.hash.hexdigest()
+        duplicate = media_index.find(digest)
+        if duplicate is not None:
+            receiver.cleanup()
+            filename = duplicate
+        else:
+            # 日付 + ハッシュ + ファイル名 (日付を先頭にして，名前順 = 新しい順にする)
+            now = datetime.today().strftime('%Y%m%d%H%M%S')
+            filename = '{}_{}_{}'.format(now, digest[:HASH_LENGTH], receiver.filename)
+            os.chmod(receiver.tmp, 0o644)
+            os.replace(receiver.tmp, os.path.join(image_dir, filename))
+    except BaseException:
+        receiver.cleanup()
+        raise
+
+    upload = Upload(filename, receiver.size, digest, elapsed, duplicate is not None)
+    logger.info('upload %s: %d bytes in %.2fs (%.1f KB/s)%s', upload.filename, upload.size, upload.elapsed,
+                upload.throughput / 1024, ' [duplicated]' if upload.duplicated else '')
+    return upload
+
+
+# メディア一覧
+INDEX_FILE = '.media_index.json'  # static の外に保存する
+INDEX_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.gif')
+IMAGES_PER_PAGE = 60
+_DATE_PREFIX = re.compile(r'^(\d{14})_')
+_HASH_PREFIX = re.compile(r'^\d{14}_([0-9a-f]{%d})_' % HASH_LENGTH)  # アップロードした画像のファイル名の {hash}
+
+
+class MediaIndex(object):
+    def __init__(self, image_dir: str = IMAGE_DIR, path: str = INDEX_FILE):
+        """
+        static/images/ の画像の一覧
+        アップロード日時の順に保持し，ディレクトリが変更されたときだけ読み直す
+        :param image_dir: 画像のディレクトリ
+        :param path:      一覧を保存するファイル (再起動後もディレクトリを読まずに済む)
+        """
+        self.image_dir = image_dir
+        self.path = path
+        self._lock = threading.Lock()
+        self._order = []  # [(日時, filename)] の昇順
+        self._info = {}  # {filename: [size, mtime, 日時 'YYYYmmddHHMMSS']}
+        self._hashes = {}  # {ファイル名のハッシュ: filename}  同じ画像の確認用
+        self._dir_mtime = None  # 一覧を作った時点のディレクトリの更新時刻
+
+    def _stat_dir(self):
+        return os.stat(self.image_dir).st_mtime_ns
+
+    def _refresh(self):
+        """ 他のプロセスのアップロード・手動での追加・削除があれば読み直す """
+        dir_mtime = self._stat_dir()
+        if dir_mtime == self._dir_mtime:
+            return
+
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+            if saved['dir_mtime'] == dir_mtime:
+                self._set(saved['images'], dir_mtime)
+                return
+        except (OSError, ValueError, KeyError):
+            pass
+
+        info = {}
+        with os.scandir(self.image_dir) as entries:
+            for entry in entries:
+                if entry.name.startswith('.') or os.path.splitext(entry.name)[1].lower() not in INDEX_EXTENSIONS:
+                    continue
+                if entry.is_file():
+                    st = entry.stat()
+                    info[entry.name] = [st.st_size, st.st_mtime, _uploaded_at(entry.name, st.st_mtime)]
+        self._set(info, dir_mtime)
+        self._save()
+
+    def _set(self, info, dir_mtime):
+        self._info = info
+        self._order = sorted((value[2], name) for name, value in info.items())
+        self._hashes = {m[1]: name for m, name in ((_HASH_PREFIX.match(name), name) for name in info) if m}
+        self._dir_mtime = dir_mtime
+
+    def _save(self):
+        data = json.dumps({'dir_mtime': self._dir_mtime, 'images': self._info}, ensure_ascii=False)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), prefix='.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(data)
+            os.replace(tmp, self.path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def add(self, filename: str):
+        """ アップロードした画像を追加 (ディレクトリ全体は読み直さない) """
+        with self._lock:
+            if self._dir_mtime is None:
+                self._refresh()
+            if filename not in self._info:
+                st = os.stat(os.path.join(self.image_dir, filename))
+                self._info[filename] = [st.st_size, st.st_mtime, _uploaded_at(filename, st.st_mtime)]
+                bisect.insort(self._order, (self._info[filename][2], filename))
+                m = _HASH_PREFIX.match(filename)
+                if m:
+                    self._hashes[m[1]] = filename
+            self._dir_mtime = self._stat_dir()
+            self._save()
+
+    def find(self, digest: str):
+        """ 同じハッシュの画像のファイル名 (ファイル名の '_{hash}_' で探す)  なければ None """
+        with self._lock:
+            self._refresh()
+            filename = self._hashes.get(digest[:HASH_LENGTH])
+        if filename is not None and os.path.isfile(os.path.join(self.image_dir, filename)):
+            return filename
+        return None
+
+    def months(self):
+        """ [(年月 'YYYY-MM', 枚数)] 新しい順 """
+        with self._lock:
+            self._refresh()
+            counts = {}
+            for info in self._info.values():
+                month = '{}-{}'.format(info[2][:4], info[2][4:6])
+                counts[month] = counts.get(month, 0) + 1
+        return sorted(counts.items(), reverse=True)
+
+    def page(self, page: int = 1, per_page: int = IMAGES_PER_PAGE, query: str = None, month: str = None):
+        """
+        1ページ分の画像のパス (新しい順)
+        :param page:     ページ番号 (1から)
+        :param per_page: 1ページの枚数
+        :param query:    ファイル名に含む文字列 (大文字・小文字は区別しない)
+        :param month:    'YYYY-MM' で絞り込む
+        :return: (画像のパスのリスト, ページ数)
+        """
+        with self._lock:
+            self._refresh()
+            names = [name for _, name in self._order]
+            if query or month:
+                query = (query or '').lower()
+                prefix = (month or '').replace('-', '')
+                names = [name for name in names if query in name.lower() and self._info[name][2].startswith(prefix)]
+
+        num_pages = max(1, -(-len(names) // per_page))
+        page = min(max(1, page), num_pages)
+        end = len(names) - (page - 1) * per_page
+        return ['{}/{}'.format(self.image_dir, name) for name in reversed(names[max(0, end - per_page):end])], num_pages
+
+
+def _uploaded_at(filename: str, mtime: float):
+    """ ファイル名の日付(アップロード日時)  なければ更新日時 """
+    m = _DATE_PREFIX.match(filename)
+    if m:
+        return m[1]
+    return datetime.fromtimestamp(mtime).strftime('%Y%m%d%H%M%S')
+
+
+index = MediaIndex()
+
+
+def variant_path(filename: str, width: int, ext: str):
+    """ 縮小した画像のパス (ext: '.webp' or 元の形式) """
+    stem = os.path.splitext(filename)[0]
+    return '{}/{}-{}w{}'.format(VARIANT_DIR, stem, width, ext)
+
+
+def variant_widths(width: int):
+    """ 作成する幅 (元の幅のWebPも作る) """
+    return [w for w in VARIANT_WIDTHS if w < width] + [width]
+
+
+def image_size(path: str):
+    """ 表示される大きさ (width, height)  ヘッダだけ読む (EXIFの回転も考慮)  読めない・Pillowがなければ None """
+    try:
+        from PIL import Image, UnidentifiedImageError
+    except ImportError:  # 記事は srcset・width/height なしの <img loading="lazy"> になる
+        return None
+
+    try:
+        with Image.open(path) as image:
+            width, height = image.size
+            if image.getexif().get(0x0112) in (5, 6, 7, 8):  # Orientation: 90°回転
+                width, height = height, width
+    except (OSError, UnidentifiedImageError):
+        return None
+    return width, height
+
+
+def _save_image(image, path, **options):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.', suffix=os.path.splitext(path)[1])
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            image.save(f, format=options.pop('format'), **options)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def generate_variants(filename: str, image_dir: str = IMAGE_DIR):
+    """
+    縮小した画像・WebPを作成 (プロセスプールで実行する)
+    作成済みのもの(元の画像より新しいもの)は作り直さない
+    :param filename: static/images/ の画像のファイル名
+    :return: 作成した数
+    """
+    from PIL import Image, ImageOps
+
+    ext = os.path.splitext(filename)[1].lower()
+    if ext not in VARIANT_TYPES:
+        return 0
+
+    src = os.path.join(image_dir, filename)
+    mtime = os.stat(src).st_mtime
+    os.makedirs(VARIANT_DIR, exist_ok=True)
+
+    created = 0
+    with Image.open(src) as original:
+        image = ImageOps.exif_transpose(original)
+        if image.mode not in ('RGB', 'RGBA', 'L'):
+            image = image.convert('RGBA' if 'transparency' in image.info or image.mode in ('P', 'LA') else 'RGB')
+
+        for width in variant_widths(image.width):
+            # 元の幅はWebPだけ，それより小さいものは元の形式(WebP非対応のブラウザ用)も作る
+            targets = [('.webp', dict(format='WEBP', quality=WEBP_QUALITY, method=4))]
+            if width < image.width:
+                if ext == '.jpg':
+                    targets.append(('.jpg', dict(format='JPEG', quality=JPEG_QUALITY, optimize=True, progressive=True)))
+                else:
+                    targets.append(('.png', dict(format='PNG', optimize=True)))
+
+            todo = [(path, options) for path, options in
+                    ((variant_path(filename, width, variant_ext), options) for variant_ext, options in targets)
+                    if not os.path.exists(path) or os.stat(path).st_mtime < mtime]
+            if not todo:
+                continue
+
+            height = max(1, round(image.height * width / image.width))
+            resized = image if width == image.width else image.resize((width, height), Image.LANCZOS)
+            for path, options in todo:
+                if options['format'] == 'JPEG' and resized.mode != 'RGB':
+                    _save_image(resized.convert('RGB'), path, **options)
+                else:
+                    _save_image(resized, path, **options)
+                created += 1
+
+    return created
+
+
+_executor = None
+
+
+def _variants_done(future):
+    if future.exception() is not None:
+        logger.warning('variants: %s', future.exception())
+
+
+def schedule_variants(filename: str):
+    """ 縮小した画像の作成をプロセスプールに任せる (待たない) """
+    global _executor
+    if _executor is None:
+        # サーバのプロセスは gRPC のスレッドを持っているので fork ではなく spawn で起動する
+        _executor = ProcessPoolExecutor(max_workers=VARIANT_WORKERS,
+                                        mp_context=multiprocessing.get_context('spawn'))
+
+    future = _executor.submit(generate_variants, filename)
+    future.add_done_callback(_variants_done)
+    return future
+
+
+def responsive_image(src: str):
+    """
+    <img> の src から srcset を作成
+    縮小した画像は作成済みのものだけを使う (作成中・作成に失敗したものを指さない)
+    :param src: /static/images/{filename}
+    :return: (WebPのsrcset, 元の形式のsrcset, (width, height))  static/images/ の縮小できる画像でなければ None
+             WebPがまだなければ WebPのsrcset は None (元の形式のsrcset は元の画像を必ず含む)
+    """
+    prefix = '/{}/'.format(IMAGE_DIR)
+    if not src.startswith(prefix):
+        return None
+
+    filename = src[len(prefix):]
+    if '/' in filename or os.path.splitext(filename)[1].lower() not in VARIANT_TYPES:
+        return None
+
+    size = image_size(os.path.join(IMAGE_DIR, filename))
+    if size is None:
+        return None
+
+    widths = variant_widths(size[0])
+    ext = os.path.splitext(filename)[1].lower()
+    ext = '.jpg' if ext == '.jpg' else '.png'
+    webp = ', '.join('/{} {}w'.format(path, w) for path, w in
+                     ((variant_path(filename, w, '.webp'), w) for w in widths) if os.path.exists(path))
+    fallback = ', '.join(['/{} {}w'.format(path, w) for path, w in
+                          ((variant_path(filename, w, ext), w) for w in widths[:-1]) if os.path.exists(path)] +
+                         ['{} {}w'.format(src, size[0])])
+    return webp or None, fallback, size
+
+
+if __name__ == '__main__':
+    images = [entry.name for entry in os.scandir(IMAGE_DIR)
+              if entry.is_file() and os.path.splitext(entry.name)[1].lower() in VARIANT_TYPES]
+    with ProcessPoolExecutor(mp_context=multiprocessing.get_context('spawn')) as executor:
+        created = sum(executor.map(generate_variants, images))
+    print('{} variants created for {} images.'.format(created, len(images)))
@@ -0,0 +1,311 @@
+"""
+metrics.py
+リクエスト・Firestore のRPC・Markdownの変換・テンプレートの処理時間の計測
+
+Firestore は読み込んだドキュメント数で課金されるので，RPCごとに回数・時間・読み込んだドキュメント数・
+バイト数をルート(URLのパターン)ごとに記録し，/metrics で Prometheus のテキスト形式で出力する．
+計測は Firestore クライアントの内部の API (_firestore_api) の呼び出しを包んで行うので，
+models などの呼び出し側は変更しない．
+
+Copyright (c) RightCode Inc. All rights reserved.
+"""
+import contextvars
+import functools
+import inspect
+import threading
+import time
+from contextlib import contextmanager
+
+from google.cloud.firestore import AsyncClient
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# [s]
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+NO_ROUTE = '-'  # リクエストの外 (バックグラウンドの処理・起動時など)
+OTHER_ROUTE = 'other'  # どのルートにも一致しないパス (ラベルの種類を増やさない)
+
+# 処理中のリクエストのルート
+current_route = contextvars.ContextVar('route', default=NO_ROUTE)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, _escape(v)) for k, v in pairs) + '}'
+
+
+def _format(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter(object):
+    def __init__(self, name: str, documentation: str, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def values(self):
+        """ {ラベルの値: 値} """
+        with self._lock:
+            return dict(self._values)
+
+    def expose(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation), '# TYPE {} counter'.format(self.name)]
+        with self._lock:
+            items = sorted(self._values.items())
+        for labels, value in items:
+            lines.append('{}{} {}'.format(self.name, _labels(self.labels, labels), _format(value)))
+        return lines
+
+
+class Histogram(object):
+    def __init__(self, name: str, documentation: str, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}  # {labels: [バケットごとの数..., 合計, 数]}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels):
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            counts[-2] += value
+            counts[-1] += 1
+
+    def counts(self):
+        """ {ラベルの値: 記録した数} """
+        with self._lock:
+            return {labels: counts[-1] for labels, counts in self._values.items()}
+
+    @contextmanager
+    def time(self, *labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def expose(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation), '# TYPE {} histogram'.format(self.name)]
+        with self._lock:
+            items = sorted((labels, list(counts)) for labels, counts in self._values.items())
+        for labels, counts in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(self.name, _labels(self.labels, labels, [('le', bound)]),
+                                                     cumulative))
+            lines.append('{}_bucket{} {}'.format(self.name, _labels(self.labels, labels, [('le', '+Inf')]),
+                                                 counts[-1]))
+            lines.append('{}_sum{} {}'.format(self.name, _labels(self.labels, labels), _format(counts[-2])))
+            lines.append('{}_count{} {}'.format(self.name, _labels(self.labels, labels), counts[-1]))
+        return lines
+
+
+# --- メトリクス ---
+
+request_seconds = Histogram('blog_http_request_duration_seconds', 'HTTP request latency.',
+                            ('route', 'method', 'status'))
+firestore_seconds = Histogram('blog_firestore_rpc_duration_seconds', 'Firestore RPC latency (streams: until the last response).',
+                              ('route', 'rpc'))
+firestore_documents = Counter('blog_firestore_documents_read_total', 'Documents returned by Firestore (billed reads).',
+                              ('route', 'rpc'))
+firestore_writes = Counter('blog_firestore_documents_written_total', 'Documents written to Firestore.',
+                           ('route', 'rpc'))
+firestore_bytes = Counter('blog_firestore_response_bytes_total', 'Size of Firestore responses.', ('route', 'rpc'))
+markdown_seconds = Histogram('blog_markdown_render_duration_seconds', 'Markdown to HTML conversion time.')
+template_seconds = Histogram('blog_template_render_duration_seconds', 'Jinja2 template rendering time.',
+                             ('template',))
+
+REGISTRY = [request_seconds, firestore_seconds, firestore_documents, firestore_writes, firestore_bytes,
+            markdown_seconds, template_seconds]
+
+
+def expose():
+    """ Prometheus のテキスト形式 """
+    lines = []
+    for metric in REGISTRY:
+        lines += metric.expose()
+    return '\n'.join(lines) + '\n'
+
+
+# --- Firestore ---
+
+# レスポンスを順に返すRPC  {RPC: レスポンスがドキュメントを含むフィールド}
+_STREAMING = {
+    'batch_get_documents': 'found',
+    'run_query': 'document',
+    'run_aggregation_query': None,
+}
+_UNARY = ('commit', 'batch_write', 'begin_transaction', 'rollback', 'list_documents', 'list_collection_ids')
+
+
+def _writes(kwargs):
+    request = kwargs.get('request')
+    writes = request.get('writes') if isinstance(request, dict) else getattr(request, 'writes', None)
+    return len(writes or ())
+
+
+class _Stream(object):
+    def __init__(self, rpc: str, route: str, start: float):
+        """ ストリームのレスポンスを数え，最後のレスポンスまでの時間を記録する """
+        self.rpc = rpc
+        self.route = route
+        self.start = self.last = start
+        self.field = _STREAMING[rpc]
+
+    def count(self, response):
+        pb = getattr(response, '_pb', response)
+        if self.field is not None and pb.HasField(self.field):
+            firestore_documents.inc(self.route, self.rpc)
+        firestore_bytes.inc(self.route, self.rpc, amount=pb.ByteSize())
+        self.last = time.perf_counter()
+
+    def close(self):
+        firestore_seconds.observe(self.last - self.start, self.route, self.rpc)
+
+    def wrap(self, responses):
+        try:
+            for response in responses:
+                self.count(response)
+                yield response
+        finally:
+            self.close()
+
+    async def awrap(self, responses):
+        try:
+            async for response in responses:
+                self.count(response)
+                yield response
+        finally:
+            self.close()
+
+
+def _record_unary(rpc, route, start, kwargs):
+    firestore_seconds.observe(time.perf_counter() - start, route, rpc)
+    if rpc in ('commit', 'batch_write'):
+        firestore_writes.inc(route, rpc, amount=_writes(kwargs))
+
+
+def _instrument(rpc: str, method, is_async: bool):
+    if is_async:
+        # 非同期のクライアントは全てのRPCが awaitable を返す
+        # (run_query・batch_get_documents は async def ではなく，awaitable を返す def)
+        @functools.wraps(method)
+        async def async_wrapper(*args, **kwargs):
+            route, start = current_route.get(), time.perf_counter()
+            result = method(*args, **kwargs)
+            if inspect.isawaitable(result):
+                result = await result
+            if rpc in _STREAMING:
+                return _Stream(rpc, route, start).awrap(result)
+            _record_unary(rpc, route, start, kwargs)
+            return result
+
+        return async_wrapper
+
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        route, start = current_route.get(), time.perf_counter()
+        result = method(*args, **kwargs)
+        if rpc in _STREAMING:
+            return _Stream(rpc, route, start).wrap(result)
+        _record_unary(rpc, route, start, kwargs)
+        return result
+
+    return wrapper
+
+
+def instrument_firestore(client):
+    """
+    Firestore のクライアント (同期・非同期) のRPCを計測する
+    :param client: init_db.db / init_db.adb
+    """
+    api = client._firestore_api
+    if getattr(api, '_instrumented', False):
+        return
+    is_async = isinstance(client, AsyncClient)
+    for rpc in list(_STREAMING) + list(_UNARY):
+        method = getattr(api, rpc, None)
+        if method is not None:
+            setattr(api, rpc, _instrument(rpc, method, is_async))
+    api._instrumented = True
+
+
+# --- テンプレート ---
+
+def instrument_templates(templates):
+    """ responder の api.templates の render() を計測する """
+    render = templates.render
+
+    @functools.wraps(render)
+    def wrapper(template, *args, **kwargs):
+        with template_seconds.time(template):
+            return render(template, *args, **kwargs)
+
+    templates.render = wrapper
+
+
+# --- リクエスト ---
+
+class MetricsMiddleware(object):
+    def __init__(self, app, routes=None):
+        """
+        api.add_middleware(MetricsMiddleware, routes=api.router.routes) で登録する
+        リクエストのルートを current_route に設定し，処理時間を記録する (最後に登録して一番外側で計測する)
+        :param app:    内側のASGIアプリ
+        :param routes: ルートの一覧 (ラベルにはパスではなくパターンを使う)
+        """
+        self.app = app
+        self.routes = routes if routes is not None else []
+
+    def _route(self, scope):
+        path = scope['path']
+        if path.startswith('/static/'):
+            return '/static'
+        for route in self.routes:
+            matched, _ = route.matches(scope)
+            if matched:
+                return route.route
+        return OTHER_ROUTE
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        route = self._route(scope)
+        token = current_route.set(route)
+        status = [500]
+
+        async def send_wrapper(message):
+            if message['type'] == 'http.response.start':
+                status[0] = message['status']
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            request_seconds.observe(time.perf_counter() - start, route, scope['method'], status[0])
+            current_route.reset(token)
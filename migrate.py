@@ -0,0 +1,50 @@
+"""
+migrate.py
+既存のドキュメントのIDをslugに移行し，カテゴリ・タグごとの記事数を作成する
+
+以前のバージョンで作成したデータ(自動生成ID)を使う場合に一度だけ実行する
+$ python migrate.py
+
+Copyright (c) RightCode Inc. All rights reserved.
+"""
+from google.api_core.exceptions import AlreadyExists
+
+from init_db import db
+from models import recount_articles
+
+
+def migrate_to_slug_ids(collection: str):
+    """
+    ドキュメントIDがslugでないドキュメントを，slugをIDとするドキュメントに移す
+    :param collection: コレクション名
+    :return: (移行した数, slugが重複していて移行できなかったslugのリスト)
+    """
+    moved = 0
+    duplicated = []
+    for doc in db.collection(collection).stream():
+        data = doc.to_dict()
+        if doc.id == data['slug']:
+            continue
+
+        # 作成と削除を1つのバッチで行う (slugが重複していれば何もしない)
+        batch = db.batch()
+        batch.create(db.collection(collection).document(data['slug']), data)
+        batch.delete(doc.reference)
+        try:
+            batch.commit()
+            moved += 1
+        except AlreadyExists:
+            duplicated.append(data['slug'])
+
+    return moved, duplicated
+
+
+if __name__ == '__main__':
+    for collection in ['categories', 'tags', 'articles']:
+        moved, duplicated = migrate_to_slug_ids(collection)
+        print('{}: {} documents migrated.'.format(collection, moved))
+        for slug in duplicated:
+            print('    skipped (duplicated slug): {}'.format(slug))
+
+    # カテゴリ・タグごとの記事数 (count) を作成
+    print('{} counters updated.'.format(recount_articles()))
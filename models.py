@@ -7,25 +7,225 @@ $ python models.py
 
 Copyright (c) RightCode Inc. All rights reserved.
 """
-from datetime import datetime
-from init_db import db
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from init_db import db, transactional
+from google.api_core.exceptions import AlreadyExists, NotFound
+from google.cloud import firestore
 from google.cloud.firestore import Query
+from cache import cached, invalidate
+import replica
+import search
+from renderer import render_article, RENDERER_VERSION
+
+
+class SlugAlreadyExists(ValueError):
+    """ 同じslugのドキュメントが既に存在する """
+
+
+def _update(ref, data: dict):
+    """
+    存在するドキュメントだけを更新 (1回のRPC)
+    :return: True => 更新した  False => ドキュメントが存在しない
+    """
+    try:
+        ref.update(data)
+    except NotFound:
+        return False
+    return True
+
+
+def _delete(ref):
+    """
+    存在するドキュメントだけを削除 (1回のRPC)
+    :return: True => 削除した  False => ドキュメントが存在しない
+    """
+    try:
+        ref.delete(option=db.write_option(exists=True))
+    except NotFound:
+        return False
+    return True
+
+
+def _check_slug(slug: str):
+    """ slugはドキュメントIDとして使うので，IDに使えない文字列は弾く """
+    if not slug or '/' in slug or slug in ('.', '..') or (slug.startswith('__') and slug.endswith('__')):
+        raise ValueError('Error: The slug "{}" cannot be used.'.format(slug))
+
+
+def article_ref(slug: str):
+    """ slugから記事のドキュメント参照を取得 (RPCは発生しない) """
+    return db.collection('articles').document(slug)
+
+
+def category_ref(slug: str):
+    """ slugからカテゴリのドキュメント参照を取得 (RPCは発生しない) """
+    return db.collection('categories').document(slug)
+
+
+def tag_ref(slug: str):
+    """ slugからタグのドキュメント参照を取得 (RPCは発生しない) """
+    return db.collection('tags').document(slug)
+
+
+def _create(collection: str, slug: str, data: dict):
+    """
+    slugをドキュメントIDとしてドキュメントを作成
+    存在しない場合だけ作成されるので，同時に同じslugで作成されても重複しない
+    """
+    try:
+        db.collection(collection).document(slug).create(data)
+    except AlreadyExists:
+        raise SlugAlreadyExists('Error: The slug "{}" has already been existed.'.format(slug))
+
+
+@transactional
+def _move_in_transaction(transaction, old_ref, new_ref, data: dict):
+    snapshot = old_ref.get(transaction=transaction)
+    if not snapshot.exists:
+        return False
+
+    new_data = snapshot.to_dict()
+    new_data.update(data)
+    transaction.create(new_ref, new_data)  # 移動先が既に存在すればコミットに失敗する
+    transaction.delete(old_ref)
+    return True
+
+
+def _rename(collection: str, slug: str, new_slug: str, data: dict):
+    """
+    slugの変更 = ドキュメントIDの変更
+    コピーと削除を1つのトランザクションで行う
+    :param collection: コレクション名
+    :param slug:       変更前のslug
+    :param new_slug:   変更後のslug
+    :param data:       同時に更新するデータ
+    :return: True => 変更した  False => 変更前のドキュメントが存在しない
+    """
+    _check_slug(new_slug)
+    old_ref = db.collection(collection).document(slug)
+    new_ref = db.collection(collection).document(new_slug)
+    try:
+        return _move_in_transaction(db.transaction(), old_ref, new_ref, data)
+    except AlreadyExists:
+        raise SlugAlreadyExists('Error: The slug "{}" has already been existed.'.format(new_slug))
+
+
+# --- カテゴリ・タグごとの記事数 ---
+# 公開済みの記事の数をカテゴリ・タグのドキュメントの count に持ち，記事の書き込みと同じトランザクションで増減する
+
+def _counter_changes(old: dict = None, new: dict = None):
+    """
+    記事の追加・更新・削除による記事数の増減
+    :param old: 変更前の記事 (追加ならNone)
+    :param new: 変更後の記事 (削除ならNone)
+    :return: {(コレクション, slug): 増減}  増減のないものは含まない
+    """
+    changes = Counter()
+    for art, sign in ((old, -1), (new, 1)):
+        if art and art.get('released'):
+            if art.get('category'):
+                changes[('categories', art['category'])] += sign
+            for tag in set(art.get('tags') or []):
+                changes[('tags', tag)] += sign
+    return {key: n for key, n in changes.items() if n}
+
+
+def _counter_refs(changes: dict, client=db):
+    return [client.collection(collection).document(slug) for collection, slug in changes]
+
+
+def _write_counters(transaction, snapshots, changes: dict):
+    """ 存在するカテゴリ・タグの記事数を増減 (トランザクションで読み込んだ後に呼ぶ) """
+    for snapshot in snapshots:
+        if snapshot.exists:
+            n = changes[(snapshot.reference.parent.id, snapshot.id)]
+            transaction.update(snapshot.reference, {'count': firestore.Increment(n)})
+
+
+def _public(*articles):
+    """ 公開済みの記事を含むか (含まなければ公開ページは変わらない) """
+    return any(art and art.get('released') for art in articles)
+
+
+@transactional
+def _add_article_in_transaction(transaction, ref, data: dict):
+    changes = _counter_changes(new=data)
+    snapshots = list(transaction.get_all(_counter_refs(changes))) if changes else []
+    transaction.create(ref, data)  # 既に存在すればコミットに失敗する
+    _write_counters(transaction, snapshots, changes)
+
+
+@transactional
+def _update_article_in_transaction(transaction, old_ref, new_ref, data: dict):
+    """
+    記事の更新 (slugを変更する場合はコピーと削除) と記事数の増減
+    :return: 変更前の記事 (存在しなければ None)
+    """
+    snapshot = old_ref.get(transaction=transaction)
+    if not snapshot.exists:
+        return None
+
+    old = snapshot.to_dict()
+    new = dict(old, **data)
+    changes = _counter_changes(old, new)
+    snapshots = list(transaction.get_all(_counter_refs(changes))) if changes else []
+    if new_ref.id != old_ref.id:
+        transaction.create(new_ref, new)  # 移動先が既に存在すればコミットに失敗する
+        transaction.delete(old_ref)
+    else:
+        transaction.update(old_ref, data)
+    _write_counters(transaction, snapshots, changes)
+    return old
+
+
+@transactional
+def _delete_article_in_transaction(transaction, ref):
+    """ :return: 削除した記事 (存在しなければ None) """
+    snapshot = ref.get(transaction=transaction)
+    if not snapshot.exists:
+        return None
+
+    old = snapshot.to_dict()
+    changes = _counter_changes(old=old)
+    snapshots = list(transaction.get_all(_counter_refs(changes))) if changes else []
+    transaction.delete(ref)
+    _write_counters(transaction, snapshots, changes)
+    return old
+
+
+def recount_articles():
+    """
+    カテゴリ・タグごとの記事数を数え直す (カウンタのない既存のデータ・一括インポートの後)
+    :return: 更新したカテゴリ・タグの数
+    """
+    counts = Counter()
+    for art in db.collection('articles').select(['category', 'tags', 'released']).stream():
+        counts.update(_counter_changes(new=art.to_dict()))
+
+    writes = []
+    for collection in ('categories', 'tags'):
+        for doc in db.collection(collection).select(['count']).stream():
+            count = counts.get((collection, doc.id), 0)
+            if doc.to_dict().get('count') != count:
+                writes.append(('update', collection, doc.id, {'count': count}))
+    for batch in _batches(writes):
+        batch.commit()
+
+    invalidate('categories', 'tags')
+    return len(writes)
 
 
 class Category(object):
+    COLLECTION = 'categories'
+
     def __init__(self, name: str, slug: str):
         """
         Create Category
         :param name:  category name
-        :param slug:  category slug
+        :param slug:  category slug (ドキュメントIDになる)
         """
-        # slugの被りがあるか調査
-        try:
-            if slug in get_category_slugs():
-                raise ValueError('Error: The slug you gave has already been existed.')
-        except ValueError as e:
-            print(e)
-            exit(-1)
+        _check_slug(slug)
 
         self.name = name
         self.slug = slug
@@ -35,24 +235,21 @@ class Category(object):
         return data
 
     def add(self):
-        """ Add data to Firestore """
-        db.collection('categories').add(self.to_dict())
+        """ Add data to Firestore (slugが被っていれば SlugAlreadyExists) """
+        _create(self.COLLECTION, self.slug, self.to_dict())
+        invalidate(self.COLLECTION)
 
 
 class Tag(object):
+    COLLECTION = 'tags'
+
     def __init__(self, name, slug):
         """
         Create Tag
         :param name:
-        :param slug:
+        :param slug:  tag slug (ドキュメントIDになる)
         """
-        # slugの被りがあるか調査
-        try:
-            if slug in get_category_slugs():
-                raise ValueError('Error: The slug you gave has already been existed.')
-        except ValueError as e:
-            print(e)
-            exit(-1)
+        _check_slug(slug)
 
         self.name = name
         self.slug = slug
@@ -62,10 +259,14 @@ class Tag(object):
         return data
 
     def add(self):
-        db.collection('tags').add(self.to_dict())
+        """ Add data to Firestore (slugが被っていれば SlugAlreadyExists) """
+        _create(self.COLLECTION, self.slug, self.to_dict())
+        invalidate(self.COLLECTION, public=False)  # 記事のないタグはサイドメニューに表示しない
 
 
 class Article(object):
+    COLLECTION = 'articles'
+
     def __init__(self,
                  title: str,
                  thumbnail: str,
@@ -84,19 +285,13 @@ class Article(object):
         :param contents:    記事内容
         :param description: 詳細・抜粋
         :param author:      著者
-        :param slug:        スラッグ
+        :param slug:        スラッグ (ドキュメントIDになる)
         :param category:    カテゴリ
         :param tags:        タグ
         :param released:    公開設定
         """
-        # slugの被りがあるか調査 & idを設定
-        # 記事数が増えるとこのやり方は，よくないかもしれない
-        try:
-            if slug in get_article_slugs():
-                raise ValueError('Error: The slug you gave has already been existed.')
-        except ValueError as e:
-            print(e)
-            exit(-1)
+        # slugの被りは add() で作成時に判定する
+        _check_slug(slug)
 
         self.title = title
         self.thumbnail = thumbnail
@@ -109,52 +304,158 @@ class Article(object):
         self.last_update = datetime.now()
         self.released = released
 
+        # 変換済みのHTMLを一緒に保存する
+        self.__dict__.update(render_article(contents, thumbnail))
+
     def to_dict(self):
         data = self.__dict__
         return data
 
     def add(self):
-        db.collection('articles').add(self.to_dict())
+        """ Add data to Firestore (slugが被っていれば SlugAlreadyExists)  カテゴリ・タグの記事数も増やす """
+        try:
+            _add_article_in_transaction(db.transaction(), article_ref(self.slug), self.to_dict())
+        except AlreadyExists:
+            raise SlugAlreadyExists('Error: The slug "{}" has already been existed.'.format(self.slug))
+        invalidate(self.COLLECTION, 'categories', 'tags', public=_public(self.to_dict()))
+        search.index.update(self.to_dict())
+
+
+# 一覧ページで使うフィールド (本文は取得しない)
+LISTING_FIELDS = ('title', 'slug', 'category', 'thumbnail', 'thumbnail_html', 'last_update', 'author')
+
+# 管理画面の記事一覧で使うフィールド
+ADMIN_FIELDS = ('title', 'slug', 'category', 'tags', 'last_update', 'author', 'released')
 
 
-def get_articles(unreleased: bool = True):
+def _articles_query(released_only: bool = False, category: str = None, fields=None, client=db, tag: str = None):
+    """
+    記事のクエリを作成 (新しい順)
+    絞り込みと射影はFirestore側で行う
+    :param released_only: 公開済みの記事だけ
+    :param category:      カテゴリで絞り込む
+    :param fields:        取得するフィールド (Noneなら全て)
+    :param client:        db or adb (async_models から使う)
+    :param tag:           タグで絞り込む (tags に含む記事)
+    """
+    query = client.collection('articles')
+    if released_only:
+        query = query.where('released', '==', True)
+    if category is not None:
+        query = query.where('category', '==', category)
+    if tag is not None:
+        query = query.where('tags', 'array_contains', tag)
+    if fields is not None:
+        query = query.select(fields)
+    return query.order_by('last_update', direction=Query.DESCENDING)
+
+
+@cached('articles')
+def get_articles(unreleased: bool = True, category: str = None, fields: tuple = None):
     """
     Get articles
     :param unreleased: True => all articles   False => released articles
+    :param category:   カテゴリで絞り込む
+    :param fields:     取得するフィールド (例: LISTING_FIELDS) Noneなら全て
     :return:
     """
-    if unreleased:
-        articles = [art.to_dict()
-                    for art in
-                    db.collection('articles').order_by(
-                        'last_update',
-                        direction=Query.DESCENDING
-                    ).stream()
-                    ]
+    if replica.active():
+        return replica.store.get_articles(unreleased, category, fields)
+
+    query = _articles_query(released_only=not unreleased, category=category, fields=fields)
+    return [art.to_dict() for art in query.stream()]
+
+
+# カーソルは last_update をエポックからのマイクロ秒で表した文字列
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def _encode_cursor(last_update: datetime):
+    return str((last_update - _EPOCH) // timedelta(microseconds=1))
+
+
+def _decode_cursor(cursor: str):
+    return {'last_update': _EPOCH + timedelta(microseconds=int(cursor))}
+
+
+def _valid_cursor(cursor: str):
+    """ 不正なカーソル(数字でない・日時にできない大きさ)は None """
+    if cursor is None or not cursor.isdigit():
+        return None
+    try:
+        _decode_cursor(cursor)
+    except (OverflowError, ValueError):
+        return None
+    return cursor
+
+
+@cached('articles')
+def get_articles_page(page_size: int = 10, after: str = None, before: str = None, category: str = None,
+                      tag: str = None):
+    """
+    Get a page of released articles (新しい順)
+    1ページ分のドキュメントだけを読み込む
+    :param page_size: 1ページの記事数
+    :param after:     このカーソルより古い記事のページを取得
+    :param before:    このカーソルより新しい記事のページを取得
+    :param category:  カテゴリで絞り込む
+    :param tag:       タグで絞り込む
+    :return: (articles, prev_cursor, next_cursor)  前後のページがなければカーソルはNone
+    """
+    after, before = _valid_cursor(after), _valid_cursor(before)  # 不正な値は無視
+    if replica.active():
+        return replica.store.get_articles_page(page_size, after, before, category, LISTING_FIELDS, tag=tag)
+
+    query = _page_query(page_size, after, before, category, tag=tag)
+    return _page_result([art.to_dict() for art in query.get()], page_size, after, before)
+
+
+def _page_query(page_size, after, before, category, client=db, tag=None):
+    """ get_articles_page のクエリ """
+    query = _articles_query(released_only=True, category=category, fields=LISTING_FIELDS, client=client, tag=tag)
+
+    # 1件多く取得して，その先のページがあるかを判定する
+    if before is not None:
+        return query.end_before(_decode_cursor(before)).limit_to_last(page_size + 1)
+
+    if after is not None:
+        query = query.start_after(_decode_cursor(after))
+    return query.limit(page_size + 1)
+
+
+def _page_result(articles, page_size, after, before):
+    """ get_articles_page の戻り値 (1件多く取得した結果からカーソルを作成) """
+    if before is not None:
+        has_prev, has_next = len(articles) > page_size, True
+        articles = articles[-page_size:]
     else:
-        articles = [art.to_dict()
-                    for art in
-                    db.collection('articles').order_by(
-                        'last_update',
-                        direction=Query.DESCENDING
-                    ).stream()
-                    ]
-        articles = [art for art in articles if art['released']]
+        has_prev, has_next = after is not None, len(articles) > page_size
+        articles = articles[:page_size]
+
+    if not articles:
+        return articles, None, None
 
-    return articles
+    prev_cursor = _encode_cursor(articles[0]['last_update']) if has_prev else None
+    next_cursor = _encode_cursor(articles[-1]['last_update']) if has_next else None
+    return articles, prev_cursor, next_cursor
 
 
+@cached('articles')
 def get_article(slug: str):
     """
     Get an articles with slug
     :param slug:
     :return:
     """
-    article = [art.to_dict() for art in db.collection('articles').where('slug', '==', slug).stream()]
-    if len(article) == 0:
+    if replica.active():
+        return replica.store.get_article(slug)
+
+    # slug = ドキュメントID なので1回の読み込みで済む
+    article = article_ref(slug).get()
+    if not article.exists:
         return None
 
-    return article[0]
+    return article.to_dict()
 
 
 def update_article_by_slug(original_slug,
@@ -167,11 +468,33 @@ def update_article_by_slug(original_slug,
                            tags,
                            release,
                            ):
-    # IDを取得
-    art_id = [art.id for art in db.collection('articles').where('slug', '==', original_slug).stream()][0]
-
-    # 更新
-    db.collection('articles').document(art_id).update({
+    """
+    Update an article with slug
+    カテゴリ・タグ・公開設定の変更による記事数の増減も同じトランザクションで行う
+    :return: True => 更新した  False => 記事が存在しない
+    """
+    data = _article_data(title, thumbnail, description, slug, contents, category, tags, release)
+    _check_slug(slug)
+    try:
+        old = _update_article_in_transaction(db.transaction(), article_ref(original_slug), article_ref(slug), data)
+    except AlreadyExists:
+        raise SlugAlreadyExists('Error: The slug "{}" has already been existed.'.format(slug))
+    invalidate('articles', 'categories', 'tags', public=old is not None and _public(old, data))
+    if old is not None:
+        _update_search_index(original_slug, data)
+    return old is not None
+
+
+def _update_search_index(original_slug, data: dict):
+    """ 更新した記事を検索インデックスに反映 """
+    if data['slug'] != original_slug:
+        search.index.remove(original_slug)
+    search.index.update(data)
+
+
+def _article_data(title, thumbnail, description, slug, contents, category, tags, release):
+    """ 記事の更新データ (変換済みのHTMLを含む) """
+    data = {
         'title': title,
         'thumbnail': thumbnail,
         'description': description,
@@ -181,76 +504,240 @@ def update_article_by_slug(original_slug,
         'tags': tags,
         'last_update': datetime.now(),
         'released': release,
-    })
+    }
+    data.update(render_article(contents, thumbnail))
+    return data
 
 
 def delete_article_by_slug(slug: str):
-    # slugからIDを取得
-    art_id = [art.id for art in db.collection('articles').where('slug', '==', slug).stream()][0]
+    """
+    Delete an article with slug
+    カテゴリ・タグの記事数も同じトランザクションで減らす
+    :return: True => 削除した  False => 記事が存在しない
+    """
+    old = _delete_article_in_transaction(db.transaction(), article_ref(slug))
+    invalidate('articles', 'categories', 'tags', public=_public(old))
+    search.index.remove(slug)
+    return old is not None
+
+
+def rerender_articles(force: bool = False):
+    """
+    保存済みのHTMLを現在の RENDERER_VERSION で作り直す
+    :param force: True => 全記事  False => バージョンが古い記事だけ
+    :return: 更新した記事数
+    """
+    batch = db.batch()
+    count = 0
+    for art in db.collection('articles').stream():
+        data = art.to_dict()
+        if not force and data.get('render_version') == RENDERER_VERSION:
+            continue
 
-    # ドキュメントを削除
-    db.collection('articles').document(art_id).delete()
+        batch.update(art.reference, render_article(data['contents'], data['thumbnail']))
+        count += 1
+        if count % 500 == 0:  # 1バッチの上限は500件
+            batch.commit()
+            batch = db.batch()
 
+    batch.commit()
+    invalidate('articles')
+    return count
 
+
+# What's New で使うフィールド
+WHATS_NEW_FIELDS = ('title', 'slug', 'category', 'last_update')
+
+
+@cached('articles')
 def get_whats_new(num: int = 5):
-    """ get What's New  """
-    articles = [art.to_dict() for art in db.collection('articles').where('released', '==', True).limit(num).stream()]
+    """ get What's New (公開済みの最新 num 件) """
+    if replica.active():
+        return replica.store.get_whats_new(num, WHATS_NEW_FIELDS)
 
-    # datetimeでソート
-    articles = sorted(articles, key=lambda art: art['last_update'], reverse=True)
-    return articles
+    query = _articles_query(released_only=True, fields=WHATS_NEW_FIELDS).limit(num)
+    return [art.to_dict() for art in query.stream()]
 
 
+@cached('categories')
 def get_categories():
     """ Get all categories """
+    if replica.active():
+        return replica.store.get_categories()
+
     return [cat.to_dict() for cat in db.collection('categories').stream()]
 
 
 def delete_category_by_slug(slug: str):
-    # slugからIDを取得
-    c_id = [cat.id for cat in db.collection('categories').where('slug', '==', slug).stream()][0]
-
-    # ドキュメントを削除
-    db.collection('categories').document(c_id).delete()
+    """
+    Delete a category with slug
+    :return: True => 削除した  False => カテゴリが存在しない
+    """
+    deleted = _delete(category_ref(slug))
+    invalidate('categories')
+    return deleted
 
 
 def update_category_by_slug(slug: str, new_name: str = None, new_slug: str = None):
-    # slugからIDを取得
-    c_id = [cat.id for cat in db.collection('categories').where('slug', '==', slug).stream()][0]
-
+    """
+    Update a category with slug
+    slugを変更しない場合は1回のRPCで更新する
+    :return: True => 更新した  False => カテゴリが存在しない
+    """
     data = {}
     if new_name is not None:
         data['name'] = new_name
     if new_slug is not None:
         data['slug'] = new_slug
 
-    db.collection('categories').document(c_id).update(data)
+    if not data:
+        return True
+
+    if new_slug is not None and new_slug != slug:
+        updated = _rename('categories', slug, new_slug, data)
+    else:
+        updated = _update(category_ref(slug), data)
+    invalidate('categories')
+    return updated
+
+
+def update_categories(changes: dict):
+    """
+    カテゴリをまとめて更新する
+    現在のデータと比較して変更のあるものだけを1つのWriteBatchでコミットする．
+    slugを変更したカテゴリの記事の category も同じバッチで書き換える．
+    :param changes: {slug: {'name': 新しい名前, 'slug': 新しいslug}}  (Noneの項目は変更しない)
+    :return: {変更前のslug: 変更後のslug}  slugを変更したカテゴリ
+    """
+    current = {cat.id: cat.to_dict() for cat in db.collection('categories').stream()}
+    writes, renamed = _category_writes(current, changes)
+
+    # slugを変更したカテゴリの記事 (IDだけ取得)
+    for query in _renamed_articles_queries(renamed):
+        for art in query.stream():
+            writes.append(('update', 'articles', art.id, {'category': renamed[art.to_dict()['category']]}))
+
+    if not writes:
+        return renamed
+
+    # 1バッチの上限(500件)を超える場合だけ分割する
+    for batch in _batches(writes):
+        batch.commit()
+
+    invalidate('categories')
+    if renamed:
+        invalidate('articles')
+        search.index.rebuild_later()  # 検索結果の記事のカテゴリ
+    return renamed
+
+
+def _category_writes(current: dict, changes: dict):
+    """
+    現在のカテゴリと比較して，必要な書き込みを作成
+    :param current: {slug: 現在のデータ}
+    :param changes: update_categories の changes
+    :return: ([(処理, コレクション, ID, データ)], {変更前のslug: 変更後のslug})
+    """
+    writes = []
+    renamed = {}
+    for slug, change in changes.items():
+        if slug not in current:
+            continue
+
+        data = {}
+        new_name = change.get('name')
+        if new_name is not None and new_name != current[slug]['name']:
+            data['name'] = new_name
+
+        new_slug = change.get('slug')
+        if new_slug is None or new_slug == slug:
+            if data:
+                writes.append(('update', 'categories', slug, data))
+            continue
+
+        # 既存のslug・他の変更先と被る場合は変更しない
+        try:
+            _check_slug(new_slug)
+        except ValueError:
+            continue
+        if new_slug in current or new_slug in renamed.values():
+            continue
+
+        new_data = dict(current[slug], slug=new_slug, **data)
+        writes.append(('create', 'categories', new_slug, new_data))
+        writes.append(('delete', 'categories', slug, None))
+        renamed[slug] = new_slug
+
+    return writes, renamed
+
+
+def _renamed_articles_queries(renamed: dict, client=db):
+    """ slugを変更したカテゴリの記事を探すクエリ (IDだけ取得．in は30件まで) """
+    old_slugs = list(renamed)
+    return [
+        client.collection('articles').where('category', 'in', old_slugs[i:i + 30]).select(['category'])
+        for i in range(0, len(old_slugs), 30)
+    ]
+
+
+def _batches(writes, client=db):
+    """ 書き込みを500件ずつの WriteBatch にまとめる """
+    for i in range(0, len(writes), 500):
+        batch = client.batch()
+        for op, collection, doc_id, data in writes[i:i + 500]:
+            ref = client.collection(collection).document(doc_id)
+            if op == 'create':
+                batch.create(ref, data)
+            elif op == 'update':
+                batch.update(ref, data)
+            else:
+                batch.delete(ref)
+        yield batch
 
 
 def get_category_slugs():
-    return [cat.to_dict()['slug'] for cat in db.collection('categories').stream()]
+    return [doc.id for doc in db.collection('categories').select([]).stream()]  # IDだけ取得
 
 
+def get_category_names():
+    """
+    Get a map of category slug => category name
+    全カテゴリを1回のクエリで取得する
+    :return: {slug: name}
+    """
+    return {
+        cat['slug']: cat['name']
+        for cat in get_categories()
+    }
+
+
+@cached('categories')
 def get_category_name(slug):
-    # slugからIDを取得
-    c_id = [cat.id for cat in db.collection('categories').where('slug', '==', slug).stream()][0]
+    """ Get a category name with slug (存在しなければNone) """
+    if replica.active():
+        return replica.store.get_category_name(slug)
 
-    # IDを用いてデータを取得
-    category = db.collection('categories').document(c_id).get().to_dict()
+    category = category_ref(slug).get()
+    if not category.exists:
+        return None
 
-    return category['name']  # nameだけ返す
+    return category.to_dict()['name']  # nameだけ返す
 
 
 def get_tag_slugs():
-    return [cat.to_dict()['slug'] for cat in db.collection('tags').stream()]
+    return [doc.id for doc in db.collection('tags').select([]).stream()]  # IDだけ取得
 
 
 def get_article_slugs():
-    return [cat.to_dict()['slug'] for cat in db.collection('articles').stream()]
+    return [doc.id for doc in db.collection('articles').select([]).stream()]  # IDだけ取得
 
 
+@cached('tags')
 def get_tags():
     """ Get all tags """
+    if replica.active():
+        return replica.store.get_tags()
+
     return [cat.to_dict() for cat in db.collection('tags').stream()]
 
 
@@ -259,13 +746,9 @@ if __name__ == '__main__':
 
     cat1 = Category('お知らせ', 'news')
     cat2 = Category('技術', 'technology')
-    cat1.add()
-    cat2.add()
 
     tag1 = Tag('タグ１', 'tag1')
     tag2 = Tag('タグ２', 'tag2')
-    tag1.add()
-    tag2.add()
 
     art = Article(
         title='ブログを開設しました！',
@@ -277,4 +760,10 @@ if __name__ == '__main__':
         category='news',
         tags=['tag1', 'tag2'],
     )
-    art.add()
+
+    for data in [cat1, cat2, tag1, tag2, art]:
+        try:
+            data.add()
+        except SlugAlreadyExists as e:
+            print(e)  # 追加済みならスキップ
+
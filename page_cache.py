@@ -0,0 +1,120 @@
+"""
+page_cache.py
+公開ページ(一覧・カテゴリ・記事)のレスポンスを丸ごとメモリに保持するミドルウェア
+
+公開ページの内容は管理画面で記事・カテゴリを更新したときにしか変わらないので，
+2回目以降はFirestore・Markdown・テンプレートを通さずにそのまま返す．
+ETag を付けて返し，If-None-Match が一致すれば 304 を返す．
+models の書き込み系から cache.invalidate() が呼ばれると該当するページも削除される．
+
+Copyright (c) RightCode Inc. All rights reserved.
+"""
+import hashlib
+import re
+
+import cache
+
+# キャッシュするページ ('/', '/category/{category}', '/category/{category}/{slug}')
+PUBLIC_PATHS = re.compile(r'^/(category/[^/]+(/[^/]+)?|tag/[^/]+)?$')
+
+# いずれのページにもサイドメニュー(What's New + カテゴリ・タグと記事数)があり，
+# 公開済みの記事の保存で What's New の順・記事数が変わるので，ページごとには分けずに全て作り直す．
+# 公開ページに表示されない変更 (下書きの保存・記事のないタグの追加) では削除しない (cache.invalidate の public)
+PAGE_NAMESPACES = ('articles', 'categories', 'tags')
+
+# ブラウザにも保存させるが，毎回 ETag で確認させる
+CACHE_CONTROL = 'no-cache'
+
+
+class Page(object):
+    def __init__(self, status: int, headers: list, body: bytes):
+        """ キャッシュしたレスポンス """
+        self.status = status
+        self.headers = [(k, v) for k, v in headers if k.lower() not in (b'content-length', b'etag')]
+        self.body = body
+        self.etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+
+
+def _header(scope, name: bytes):
+    for key, value in scope['headers']:
+        if key == name:
+            return value.decode('latin-1')
+    return None
+
+
+def _not_modified(if_none_match: str, etag: str):
+    """ 条件付きGET: クライアントのキャッシュが最新なら True """
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or etag in tags or 'W/' + etag in tags
+
+
+class PageCacheMiddleware(object):
+    def __init__(self, app, paths=PUBLIC_PATHS, store: cache.Cache = None):
+        """
+        api.add_middleware(PageCacheMiddleware) で登録する
+        :param app:   内側のASGIアプリ
+        :param paths: キャッシュするパスの正規表現
+        :param store: 保存先 (Noneなら cache.pages)
+        """
+        self.app = app
+        self.paths = paths
+        self.store = cache.pages if store is None else store
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['method'] != 'GET' or not self.paths.match(scope['path']):
+            await self.app(scope, receive, send)
+            return
+
+        # gzipは内側のミドルウェアで圧縮されるので，受け付けるかどうかでも分ける
+        use_gzip = 'gzip' in (_header(scope, b'accept-encoding') or '')
+        key = (scope['path'], scope['query_string'], use_gzip)
+
+        page = self.store.get(key)
+        if page is None:
+            page = await self._render(scope, receive, send, key)
+            if page is None:  # キャッシュできないレスポンスは既に送信済み
+                return
+
+        await self._send(scope, send, page)
+
+    async def _render(self, scope, receive, send, key):
+        """ 内側のアプリでページを作成 (200以外・Cookieを設定するレスポンスはそのまま返す) """
+        generation = self.store.generation
+        start, chunks = {}, []
+
+        async def capture(message):
+            if message['type'] == 'http.response.start':
+                start.update(message)
+            else:
+                chunks.append(message.get('body', b''))
+
+        await self.app(scope, receive, capture)
+
+        headers = start.get('headers', [])
+        cacheable = start.get('status') == 200 and all(k.lower() != b'set-cookie' for k, _ in headers)
+        if not cacheable:
+            await send(start)
+            await send({'type': 'http.response.body', 'body': b''.join(chunks)})
+            return None
+
+        page = Page(start['status'], headers, b''.join(chunks))
+
+        # 作成中に記事が更新されていれば古い内容なので保存しない
+        if self.store.generation == generation:
+            self.store.set(key, page, PAGE_NAMESPACES)
+        return page
+
+    @staticmethod
+    async def _send(scope, send, page: Page):
+        if_none_match = _header(scope, b'if-none-match')
+        status, body = page.status, page.body
+        if if_none_match is not None and _not_modified(if_none_match, page.etag):
+            status, body = 304, b''
+
+        headers = page.headers + [
+            (b'etag', page.etag.encode('latin-1')),
+            (b'cache-control', CACHE_CONTROL.encode('latin-1')),
+            (b'content-length', str(len(body)).encode('latin-1')),
+        ]
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': body})
@@ -0,0 +1,115 @@
+"""
+renderer.py
+Markdown => HTML の変換
+
+記事の保存時に一度だけ変換し，結果を記事データ(contents_html, thumbnail_html)に保存する．
+拡張を変更したときは RENDERER_VERSION を上げてから
+$ python renderer.py
+で全記事を再変換する (縮小した画像を後から作成した場合は --force を付ける)．
+
+Copyright (c) RightCode Inc. All rights reserved.
+"""
+from xml.etree import ElementTree
+
+import markdown
+from markdown.extensions import Extension
+from markdown.treeprocessors import Treeprocessor
+
+from media import responsive_image
+import metrics
+
+RENDERER_VERSION = 2  # 2: 画像を <picture> (WebP・縮小した画像の srcset) + loading="lazy" にする
+
+# 画像の表示幅 (ブラウザが srcset から選ぶのに使う)
+CONTENTS_SIZES = '(max-width: 1000px) 100vw, 1000px'
+THUMBNAIL_SIZES = '(max-width: 600px) 100vw, 600px'
+
+
+class ResponsiveImageProcessor(Treeprocessor):
+    def __init__(self, md, sizes):
+        super().__init__(md)
+        self.sizes = sizes
+
+    def run(self, root):
+        parents = [(parent, i, child) for parent in root.iter() for i, child in enumerate(parent) if child.tag == 'img']
+        for parent, i, img in parents:
+            img.set('loading', 'lazy')
+            img.set('decoding', 'async')
+
+            image = responsive_image(img.get('src', ''))
+            if image is None:  # 外部の画像など
+                continue
+
+            webp, fallback, (width, height) = image
+            img.set('srcset', fallback)
+            img.set('sizes', self.sizes)
+            img.set('width', str(width))  # 読み込む前から場所を確保してレイアウトがずれないようにする
+            img.set('height', str(height))
+            if webp is None:  # 縮小した画像の作成中 (作成後に保存し直すか renderer.py --force で <picture> になる)
+                continue
+
+            picture = ElementTree.Element('picture')
+            ElementTree.SubElement(picture, 'source', type='image/webp', srcset=webp, sizes=self.sizes)
+            picture.append(img)
+            picture.tail, img.tail = img.tail, None
+            parent[i] = picture
+
+
+class ResponsiveImageExtension(Extension):
+    """ static/images/ の画像を media.py で作成した縮小画像の srcset にする """
+    def __init__(self, **kwargs):
+        self.config = {'sizes': [CONTENTS_SIZES, '<img> の sizes']}
+        super().__init__(**kwargs)
+
+    def extendMarkdown(self, md):
+        md.treeprocessors.register(ResponsiveImageProcessor(md, self.getConfig('sizes')), 'responsive_image', 0)
+
+
+# tableはでデフォルトでは変換してくれないのでここで指定する
+EXTENSIONS = ['tables', 'fenced_code', 'codehilite']
+
+
+def render(text: str, sizes: str = CONTENTS_SIZES):
+    """ Convert markdown to HTML """
+    with metrics.markdown_seconds.time():
+        md = markdown.Markdown(extensions=EXTENSIONS + [ResponsiveImageExtension(sizes=sizes)])
+        return md.convert(text)
+
+
+def render_article(contents: str, thumbnail: str):
+    """
+    記事に保存する変換済みのフィールドを作成
+    :param contents:  記事内容 (markdown)
+    :param thumbnail: サムネイル (markdown)
+    :return: 記事データに追加するdict
+    """
+    return {
+        'contents_html': render(contents),
+        'thumbnail_html': render(thumbnail, sizes=THUMBNAIL_SIZES),
+        'render_version': RENDERER_VERSION,
+    }
+
+
+def article_html(article: dict, field: str):
+    """
+    保存済みのHTMLを取得
+    変換前に保存された古い記事の場合だけ，その場で変換する
+    :param article: 記事データ
+    :param field:   'contents' or 'thumbnail'
+    """
+    html = article.get(f'{field}_html')
+    if html is None:
+        html = render(article[field], sizes=THUMBNAIL_SIZES if field == 'thumbnail' else CONTENTS_SIZES)
+    return html
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from models import rerender_articles
+
+    parser = argparse.ArgumentParser(description='保存済みの記事のHTMLを作り直す')
+    parser.add_argument('--force', action='store_true', help='RENDERER_VERSION が同じ記事も作り直す (縮小した画像を作成した後など)')
+    args = parser.parse_args()
+
+    print('{} articles re-rendered.'.format(rerender_articles(force=args.force)))
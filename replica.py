@@ -0,0 +1,194 @@
+"""
+replica.py
+スナップショットリスナー(on_snapshot)で articles / categories / tags をメモリに複製する
+
+リクエストのほとんどは読み込みなので，有効にすると models / async_models の読み込みは
+この複製から返す (RPCなし)．他のプロセスでの更新も数秒以内に反映される．
+最初のスナップショットが届くまでは，これまで通りFirestoreに問い合わせる．
+
+$ BLOG_REPLICA=1 python run.py
+
+Copyright (c) RightCode Inc. All rights reserved.
+"""
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+
+import cache
+
+ENABLED = os.environ.get('BLOG_REPLICA', '') == '1'
+
+COLLECTIONS = ('articles', 'categories', 'tags')
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def _micros(last_update: datetime):
+    """ 並び順・カーソルに使う last_update (エポックからのマイクロ秒) """
+    if last_update.tzinfo is None:
+        last_update = last_update.astimezone(timezone.utc)
+    return (last_update - _EPOCH) // timedelta(microseconds=1)
+
+
+def _public(collection: str, doc: dict):
+    """ 公開ページに表示されるドキュメントか (下書き・記事のないタグは表示しない) """
+    if doc is None:
+        return False
+    if collection == 'articles':
+        return bool(doc.get('released'))
+    if collection == 'tags':
+        return bool(doc.get('count'))
+    return True
+
+
+class Replica(object):
+    def __init__(self):
+        """ Create an in-memory replica (start() で同期を開始) """
+        self._lock = threading.RLock()
+        self._docs = {collection: {} for collection in COLLECTIONS}  # {collection: {slug: data}}
+        self._ready = {collection: threading.Event() for collection in COLLECTIONS}
+        self._watches = []
+
+        # 記事のインデックス (いずれも新しい順の (並び順, slug) のリスト)
+        self._all = []
+        self._released = []
+        self._by_category = {}  # 公開済みのみ
+        self._by_tag = {}  # 公開済みのみ
+
+    def start(self, client=None):
+        """ スナップショットリスナーを登録 """
+        if client is None:
+            from init_db import db as client
+
+        for collection in COLLECTIONS:
+            self._watches.append(client.collection(collection).on_snapshot(self._listener(collection)))
+
+    def stop(self):
+        for watch in self._watches:
+            watch.unsubscribe()
+        self._watches = []
+        for event in self._ready.values():
+            event.clear()
+
+    def ready(self):
+        """ 全てのコレクションの最初のスナップショットが届いたか """
+        return all(event.is_set() for event in self._ready.values())
+
+    def _listener(self, collection):
+        def on_snapshot(docs, changes, read_time):
+            public = False  # 公開ページに表示されるものが変わったか
+            with self._lock:
+                data = self._docs[collection]
+                for change in changes:
+                    old, new = data.get(change.document.id), None
+                    if change.type.name == 'REMOVED':
+                        data.pop(change.document.id, None)
+                    else:
+                        new = data[change.document.id] = change.document.to_dict()
+                    public = public or any(_public(collection, doc) for doc in (old, new))
+
+                if collection == 'articles':
+                    self._reindex()
+
+            self._ready[collection].set()
+
+            # 他のプロセスでの更新も含めて，古いキャッシュを捨てる
+            if changes:
+                cache.invalidate(collection, public=public)
+
+        return on_snapshot
+
+    def _reindex(self):
+        """ 記事のインデックスを作り直す (書き込みは少ないので全て作り直す) """
+        order = sorted(((_micros(art['last_update']), slug) for slug, art in self._docs['articles'].items()),
+                       reverse=True)
+        articles = self._docs['articles']
+
+        released, by_category, by_tag = [], {}, {}
+        for key in order:
+            art = articles[key[1]]
+            if not art.get('released'):
+                continue
+            released.append(key)
+            by_category.setdefault(art.get('category'), []).append(key)
+            for tag in art.get('tags') or []:
+                by_tag.setdefault(tag, []).append(key)
+
+        self._all = order
+        self._released = released
+        self._by_category = by_category
+        self._by_tag = by_tag
+
+    def _project(self, slug, fields):
+        art = self._docs['articles'][slug]
+        if fields is None:
+            return art
+        return {field: art[field] for field in fields if field in art}
+
+    def _index(self, released_only=True, category=None, tag=None):
+        if category is not None:
+            return self._by_category.get(category, []) if released_only else \
+                [key for key in self._all if self._docs['articles'][key[1]].get('category') == category]
+        if tag is not None:
+            return self._by_tag.get(tag, [])
+        return self._released if released_only else self._all
+
+    def get_articles(self, unreleased=True, category=None, fields=None):
+        """ models.get_articles と同じ結果を返す """
+        with self._lock:
+            return [self._project(slug, fields) for _, slug in self._index(not unreleased, category)]
+
+    def get_articles_page(self, page_size, after=None, before=None, category=None, fields=None, tag=None):
+        """
+        models.get_articles_page と同じ結果を返す
+        Firestoreと同じく page_size + 1 件を取り出してから models._page_result に渡す
+        """
+        from models import _page_result
+
+        with self._lock:
+            index = self._index(True, category, tag)
+            if before is not None:
+                newer = [key for key in index if key[0] > int(before)]
+                keys = newer[-(page_size + 1):]
+            else:
+                if after is not None:
+                    index = [key for key in index if key[0] < int(after)]
+                keys = index[:page_size + 1]
+            articles = [self._project(slug, fields) for _, slug in keys]
+
+        return _page_result(articles, page_size, after, before)
+
+    def get_article(self, slug):
+        with self._lock:
+            return self._docs['articles'].get(slug)
+
+    def get_whats_new(self, num, fields=None):
+        with self._lock:
+            return [self._project(slug, fields) for _, slug in self._released[:num]]
+
+    def get_categories(self):
+        with self._lock:
+            return list(self._docs['categories'].values())
+
+    def get_category_name(self, slug):
+        with self._lock:
+            category = self._docs['categories'].get(slug)
+        return None if category is None else category['name']
+
+    def get_tags(self):
+        with self._lock:
+            return list(self._docs['tags'].values())
+
+
+store = Replica()
+
+
+def active():
+    """ 複製から読み込めるか """
+    return ENABLED and store.ready()
+
+
+def start():
+    """ 複製を開始 (run.py から呼ぶ) """
+    if ENABLED:
+        store.start()
@@ -3,6 +3,15 @@
 # Copyright (c) RightCode Inc. All rights reserved.
 
 from controllers import api
+import replica
+import search
+import session
 
 if __name__ == '__main__':
+    # BLOG_REPLICA=1 なら読み込みをメモリ上の複製から返す
+    replica.start()
+    # セッションクッキーの検証に使う公開鍵を先に取得しておく
+    session.prefetch_keys()
+    # 検索インデックスを開く (なければバックグラウンドで作成)
+    search.index.start()
     api.run()
@@ -0,0 +1,465 @@
+"""
+search.py
+公開済みの記事の全文検索 (転置インデックス)
+
+タイトル・説明・本文を文字の2-gramに分けて転置インデックスを作り，ファイルに保存する．
+起動時はファイルをメモリマップするだけで，検索では該当する語のポスティングだけを読む．
+記事の追加・更新・削除は models から update() / remove() で差分としてメモリに反映し，
+少し待ってからまとめてファイルを書き直す．
+複数のプロセス(サーバのワーカー・bulk.py)が書き込む場合に備えて，書き直しはロックファイルで1プロセスずつ行い，
+他のプロセスがファイルを書き直していれば開き直してから差分を反映する．
+
+$ python search.py   公開済みの記事からインデックスを作り直す
+
+ファイルの形式 (数値はネイティブのバイト順の uint32，各セクションは4バイト境界から)
+    header        MAGIC, VERSION, 文書数, 語数, 語の長さの合計, ポスティング数, 文書の情報の長さ
+    term_offsets  語の開始位置 (語数 + 1)
+    post_offsets  語ごとのポスティングの開始位置 (語数 + 1)
+    terms         語 (UTF-8，バイト列の順に連結)
+    postings      (文書番号, 重み付きの出現回数) の並び
+    docs          文書の情報 [[slug, title, category, last_update, description, 長さ], ...] (JSON)
+
+Copyright (c) RightCode Inc. All rights reserved.
+"""
+import heapq
+import html
+import json
+import fcntl
+import logging
+import math
+import mmap
+import os
+import re
+import struct
+import tempfile
+import threading
+import time
+import unicodedata
+from array import array
+from collections import Counter
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILE = '.search_index'
+MAGIC = b'BSIX'
+VERSION = 1
+_HEADER = struct.Struct('=4sIIIIII')
+
+FIELD_WEIGHTS = (('title', 3), ('description', 2), ('contents', 1))  # 出現回数にかける重み
+DESCRIPTION_LENGTH = 120  # 検索結果に表示する説明の長さ
+FLUSH_DELAY = 5  # 更新からファイルに書き出すまでの時間 [s] (続けて更新された場合はまとめて書き出す)
+RELOAD_INTERVAL = 1.0  # 検索時に他のプロセスの書き直しを確認する間隔 [s]
+RESULTS_PER_PAGE = 10
+
+# BM25 のパラメータ
+K1 = 1.2
+B = 0.75
+
+# 記号・空白で区切り，区切られた語ごとに2-gramにする (日本語は分かち書きしない)
+_SEPARATOR = re.compile(r'[\W_]+')
+_TAG = re.compile(r'<[^>]+>')
+
+
+def normalize(text: str):
+    """ 全角・半角，大文字・小文字の違いをなくす """
+    return unicodedata.normalize('NFKC', text).lower()
+
+
+def _words(text: str):
+    return [word for word in _SEPARATOR.split(normalize(text)) if word]
+
+
+def tokenize(text: str):
+    """ 文字の2-gram (1文字の語はそのまま) """
+    for word in _words(text):
+        if len(word) == 1:
+            yield word
+        for i in range(len(word) - 1):
+            yield word[i:i + 2]
+
+
+def _query_terms(query: str):
+    """
+    検索語を語に分ける
+    :return: [(語, 前方一致)]  1文字の語はその文字で始まる全ての語に一致させる
+    """
+    terms = []
+    for word in _words(query):
+        if len(word) == 1:
+            terms.append((word, True))
+        else:
+            terms.extend((word[i:i + 2], False) for i in range(len(word) - 1))
+    return list(dict.fromkeys(terms))
+
+
+def _text(article: dict, field: str):
+    """ 本文は変換済みのHTMLからタグを除いたもの (Markdownの記号を索引しない) """
+    if field == 'contents' and 'contents_html' in article:
+        return html.unescape(_TAG.sub(' ', article['contents_html']))
+    return article.get(field) or ''
+
+
+def _last_update(article: dict):
+    last_update = article.get('last_update')
+    return last_update.isoformat() if isinstance(last_update, datetime) else ''
+
+
+def analyze(article: dict):
+    """
+    記事を索引する形にする
+    :return: (文書の情報, {語: 重み付きの出現回数})
+    """
+    tf = Counter()
+    for field, weight in FIELD_WEIGHTS:
+        for term in tokenize(_text(article, field)):
+            tf[term] += weight
+    info = [article['slug'], article.get('title', ''), article.get('category', ''), _last_update(article),
+            (article.get('description') or '')[:DESCRIPTION_LENGTH], sum(tf.values())]
+    return info, dict(tf)
+
+
+def _pad(n: int):
+    return -n % 4
+
+
+def encode(docs: list, postings: dict):
+    """
+    インデックスをファイルの形式にする
+    :param docs:     文書の情報のリスト (番号 = リストの位置)
+    :param postings: {語: [(文書番号, 出現回数)]}
+    """
+    terms = sorted(term.encode('utf-8') for term in postings)
+    term_offsets, post_offsets, flat = array('I', [0]), array('I', [0]), array('I')
+    for term in terms:
+        for doc, tf in postings[term.decode('utf-8')]:
+            flat.append(doc)
+            flat.append(tf)
+        term_offsets.append(term_offsets[-1] + len(term))
+        post_offsets.append(len(flat) // 2)
+
+    term_bytes = b''.join(terms)
+    doc_bytes = json.dumps(docs, ensure_ascii=False).encode('utf-8')
+    header = _HEADER.pack(MAGIC, VERSION, len(docs), len(terms), len(term_bytes), len(flat) // 2, len(doc_bytes))
+    return b''.join([header, term_offsets.tobytes(), post_offsets.tobytes(),
+                     term_bytes, b'\0' * _pad(len(term_bytes)), flat.tobytes(), doc_bytes])
+
+
+def _file_id(st):
+    """ ファイルが書き直されたかの確認用 (os.replace で置き換えると inode が変わる) """
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+
+class Segment(object):
+    def __init__(self, buf, file_id=None):
+        """
+        ファイルに保存したインデックス (読み込み専用)
+        :param buf:     encode() の結果 (bytes または mmap)
+        :param file_id: 開いたファイルの _file_id()
+        """
+        self.file_id = file_id
+        magic, version, n_docs, n_terms, terms_len, n_postings, docs_len = _HEADER.unpack_from(buf, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('unsupported search index')
+
+        view = memoryview(buf)
+        pos = _HEADER.size
+        self.term_offsets = view[pos:pos + 4 * (n_terms + 1)].cast('I')
+        pos += 4 * (n_terms + 1)
+        self.post_offsets = view[pos:pos + 4 * (n_terms + 1)].cast('I')
+        pos += 4 * (n_terms + 1)
+        self.terms = view[pos:pos + terms_len]
+        pos += terms_len + _pad(terms_len)
+        self.postings = view[pos:pos + 8 * n_postings].cast('I')
+        pos += 8 * n_postings
+
+        # 文書の情報だけはメモリに読み込む (文書数分の小さなデータ)
+        self.docs = json.loads(bytes(view[pos:pos + docs_len]).decode('utf-8'))
+        self.ids = {doc[0]: i for i, doc in enumerate(self.docs)}
+        self.n_terms = n_terms
+        self.total_length = sum(doc[5] for doc in self.docs)
+
+    @classmethod
+    def open(cls, path: str):
+        with open(path, 'rb') as f:
+            return cls(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ), _file_id(os.fstat(f.fileno())))
+
+    @classmethod
+    def empty(cls):
+        return cls(encode([], {}))
+
+    def _term(self, i: int):
+        return self.terms[self.term_offsets[i]:self.term_offsets[i + 1]].tobytes()
+
+    def _find(self, term: bytes):
+        """ 語の位置 (二分探索) """
+        lo, hi = 0, self.n_terms
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._term(mid) < term:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def lookup(self, term: str, prefix: bool = False):
+        """ :return: {文書番号: 出現回数}  前方一致なら一致する語の合計 """
+        key = term.encode('utf-8')
+        start = end = self._find(key)
+        while end < self.n_terms and (self._term(end).startswith(key) if prefix else self._term(end) == key):
+            end += 1
+
+        result = {}
+        for i in range(start, end):
+            flat = self.postings[2 * self.post_offsets[i]:2 * self.post_offsets[i + 1]].tolist()
+            for doc, tf in zip(flat[0::2], flat[1::2]):
+                result[doc] = result.get(doc, 0) + tf
+        return result
+
+    def items(self):
+        """ :return: [(語, [(文書番号, 出現回数)])] """
+        for i in range(self.n_terms):
+            flat = self.postings[2 * self.post_offsets[i]:2 * self.post_offsets[i + 1]].tolist()
+            yield self._term(i).decode('utf-8'), list(zip(flat[0::2], flat[1::2]))
+
+
+class SearchIndex(object):
+    def __init__(self, path: str = INDEX_FILE):
+        """
+        ファイルのインデックス + まだ書き出していない差分
+        差分は version 付きで記録し，書き出しの間に更新されたものは次回に回す
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._base = None
+        self._added = {}  # {slug: (version, (文書の情報, {語: 出現回数}))}
+        self._removed = {}  # {slug: version}  ファイルの文書のうち削除・更新されたもの
+        self._version = 0
+        self._timer = None
+        self._checked = 0.0  # 最後にファイルの書き直しを確認した時刻
+
+    def _load(self):
+        """ ファイルを開く (なければ False) """
+        if self._base is None and os.path.exists(self.path):
+            try:
+                self._base = Segment.open(self.path)
+            except (OSError, ValueError) as e:
+                logger.warning('search index: %s', e)
+        return self._base is not None
+
+    def _reload(self):
+        """ 他のプロセスがファイルを書き直していれば開き直す (差分はそのまま新しいファイルに重ねる) """
+        try:
+            file_id = _file_id(os.stat(self.path))
+        except OSError:
+            return
+        with self._lock:
+            if self._base is not None and self._base.file_id == file_id:
+                return
+        try:
+            base = Segment.open(self.path)
+        except (OSError, ValueError) as e:
+            logger.warning('search index: %s', e)
+            return
+        with self._lock:
+            self._base = base
+
+    def _file_lock(self):
+        """ 書き直しのロック (他のプロセスとの間) """
+        f = open(self.path + '.lock', 'a')
+        fcntl.flock(f, fcntl.LOCK_EX)  # close() で解放される
+        return f
+
+    def start(self):
+        """ 起動時: ファイルがなければバックグラウンドで作成 """
+        with self._lock:
+            if self._load():
+                return
+            self._base = Segment.empty()  # 作成中の更新も差分として記録する
+        threading.Thread(target=self.rebuild, daemon=True).start()
+
+    # --- 更新 ---
+
+    def update(self, article: dict):
+        """ 記事の追加・更新 (公開されていなければ削除)  インデックスがなければ何もしない """
+        if not article.get('released'):
+            self.remove(article['slug'])
+            return
+
+        doc = analyze(article)
+        with self._lock:
+            if not self._load():
+                return
+            # 検索中のスレッドが参照していても変わらないように，差分は作り直して置き換える
+            self._version += 1
+            slug = doc[0][0]
+            self._added = dict(self._added)
+            self._added[slug] = (self._version, doc)
+            self._removed = dict(self._removed)
+            self._removed[slug] = self._version
+        self._schedule()
+
+    def remove(self, slug: str):
+        """ 記事の削除 """
+        with self._lock:
+            if not self._load():
+                return
+            self._version += 1
+            self._added = {k: v for k, v in self._added.items() if k != slug}
+            self._removed = dict(self._removed)
+            self._removed[slug] = self._version
+        self._schedule()
+
+    def _schedule(self):
+        with self._lock:
+            if self._timer is None:
+                self._timer = threading.Timer(FLUSH_DELAY, self.flush)
+                self._timer.start()
+
+    def _replace(self, docs: list, postings: dict, version: int):
+        """ ファイルを書き直して開き直す (version までの差分は反映済み) """
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), prefix='.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(encode(docs, postings))
+            os.replace(tmp, self.path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+        base = Segment.open(self.path)
+        with self._lock:
+            self._base = base
+            self._added = {k: v for k, v in self._added.items() if v[0] > version}
+            self._removed = {k: v for k, v in self._removed.items() if v > version}
+
+    def flush(self):
+        """ 差分をファイルに書き出す """
+        with self._write_lock, self._file_lock():
+            with self._lock:
+                self._timer = None
+                if self._base is None or not self._removed:
+                    return
+            self._reload()  # 他のプロセスの更新を消さないように，最新のファイルに差分を重ねる
+            with self._lock:
+                base, added, removed, version = self._base, self._added, self._removed, self._version
+
+            # 残す文書に番号を振り直す
+            docs, ids = [], {}
+            for i, info in enumerate(base.docs):
+                if info[0] not in removed:
+                    ids[i] = len(docs)
+                    docs.append(info)
+            postings = {}
+            for term, plist in base.items():
+                plist = [(ids[doc], tf) for doc, tf in plist if doc in ids]
+                if plist:
+                    postings[term] = plist
+            for _, (info, tf) in added.values():
+                for term, count in tf.items():
+                    postings.setdefault(term, []).append((len(docs), count))
+                docs.append(info)
+
+            self._replace(docs, postings, version)
+
+    def rebuild(self, articles: list = None):
+        """
+        公開済みの記事からインデックスを作り直す
+        :param articles: 索引する記事 (Noneなら Firestore から取得)
+        """
+        with self._write_lock, self._file_lock():
+            with self._lock:
+                version = self._version
+            if articles is None:
+                from models import get_articles
+                articles = get_articles(False)
+
+            docs, postings = [], {}
+            for art in articles:
+                info, tf = analyze(art)
+                for term, count in tf.items():
+                    postings.setdefault(term, []).append((len(docs), count))
+                docs.append(info)
+            self._replace(docs, postings, version)
+            logger.info('search index: %d articles, %d terms', len(docs), len(postings))
+
+    def rebuild_later(self):
+        """ カテゴリの変更など，多くの記事に関係する変更のあと (バックグラウンドで作り直す) """
+        with self._lock:
+            if not self._load():
+                return
+        threading.Thread(target=self.rebuild, daemon=True).start()
+
+    # --- 検索 ---
+
+    def search(self, query: str, page: int = 1, per_page: int = RESULTS_PER_PAGE):
+        """
+        全ての語を含む記事をスコア(BM25)の高い順に
+        :param query:    検索語 (空白区切りで複数)
+        :param page:     ページ番号 (1から)
+        :param per_page: 1ページの件数
+        :return: (記事 [{'slug', 'title', 'category', 'last_update', 'description'}], 全件数)
+        """
+        terms = _query_terms(query)
+        now = time.monotonic()
+        if now - self._checked >= RELOAD_INTERVAL:
+            self._checked = now
+            self._reload()
+        with self._lock:
+            self._load()
+            base, added, removed = self._base, self._added, self._removed
+        if not terms or base is None:
+            return [], 0
+
+        # ファイルの文書は番号，差分の文書は slug で区別する
+        hidden = {base.ids[slug] for slug in removed if slug in base.ids}
+        n_docs = len(base.docs) - len(hidden) + len(added)
+        length = {key: info[5] for key, (_, (info, _)) in added.items()}
+        total = base.total_length - sum(base.docs[i][5] for i in hidden) + sum(length.values())
+        avgdl = total / n_docs if n_docs else 1.0
+
+        scores = None
+        for term, prefix in terms:
+            tfs = {doc: tf for doc, tf in base.lookup(term, prefix).items() if doc not in hidden}
+            for slug, (_, (_, tf)) in added.items():
+                count = sum(c for t, c in tf.items() if t.startswith(term)) if prefix else tf.get(term, 0)
+                if count:
+                    tfs[slug] = count
+            if not tfs:
+                return [], 0
+
+            idf = math.log(1 + (n_docs - len(tfs) + 0.5) / (len(tfs) + 0.5))
+            if scores is not None:
+                tfs = {doc: tf for doc, tf in tfs.items() if doc in scores}
+            term_scores = {}
+            for doc, tf in tfs.items():
+                dl = length[doc] if isinstance(doc, str) else base.docs[doc][5]
+                term_scores[doc] = idf * tf * (K1 + 1) / (tf + K1 * (1 - B + B * dl / avgdl))
+            scores = term_scores if scores is None else {doc: scores[doc] + s for doc, s in term_scores.items()}
+            if not scores:
+                return [], 0
+
+        def info(doc):
+            return added[doc][1][0] if isinstance(doc, str) else base.docs[doc]
+
+        # 上位だけを取り出す (同じスコアなら新しい記事から)
+        top = heapq.nlargest(page * per_page, scores, key=lambda doc: (scores[doc], info(doc)[3]))
+        results = []
+        for doc in top[(page - 1) * per_page:]:
+            slug, title, category, last_update, description, _ = info(doc)
+            results.append({
+                'slug': slug,
+                'title': title,
+                'category': category,
+                'last_update': datetime.fromisoformat(last_update) if last_update else None,
+                'description': description,
+            })
+        return results, len(scores)
+
+
+index = SearchIndex()
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    index.rebuild()
@@ -0,0 +1,146 @@
+"""
+session.py
+管理画面のセッションクッキー(Firebase Authentication)の確認
+
+/admin 以下へのリクエストはミドルウェアでセッションクッキーを検証する．
+検証(auth.verify_session_cookie: 署名の確認 + 無効化されていないかの問い合わせ)はクッキーごとに一度だけ行い，
+結果(claims)を短い有効期限でメモリに保持するので，画面を移動するたびに待たされない．
+署名の確認に使うGoogleの公開鍵は起動時に prefetch_keys() で firebase_admin のキャッシュに取得しておく．
+
+Copyright (c) RightCode Inc. All rights reserved.
+"""
+import asyncio
+import hashlib
+import logging
+import threading
+import time
+
+import firebase_admin
+from firebase_admin import auth, exceptions
+from google.auth.exceptions import TransportError
+from google.oauth2 import id_token
+
+import cache
+
+logger = logging.getLogger(__name__)
+
+COOKIE_NAME = 'session'
+LOGIN_URL = '/login'
+SESSION_TTL = 5 * 60  # 検証結果を保持する時間 [s] (無効化・ユーザの無効化はこの時間内に反映される)
+
+
+class InvalidSession(ValueError):
+    pass
+
+
+# 検証済みのセッション {クッキーのハッシュ: claims}
+sessions = cache.Cache(maxsize=1024, ttl=SESSION_TTL)
+
+
+def _key(cookie: str):
+    return hashlib.sha256(cookie.encode('utf-8')).hexdigest()
+
+
+def _verify(cookie: str):
+    """ セッションクッキーを検証 (パスワードの変更・ユーザの無効化で無効化されていないかも確認する) """
+    try:
+        return auth.verify_session_cookie(cookie, check_revoked=True)
+    except (auth.InvalidSessionCookieError, auth.UserDisabledError, auth.UserNotFoundError) as e:
+        raise InvalidSession(str(e))
+    except ValueError as e:  # 形式の誤り・Firebase が初期化されていない (BLOG_BACKEND=memory など)
+        raise InvalidSession(str(e))
+
+
+def prefetch_keys():
+    """
+    セッションクッキーの署名の公開鍵をバックグラウンドで取得 (起動直後の最初の確認で待たされないように)
+    verify_session_cookie() と同じ取得処理・キャッシュ(Cache-Control)を使う
+    """
+    try:
+        verifier = auth._get_client(firebase_admin.get_app())._token_verifier
+    except ValueError:  # Firebase が初期化されていない (BLOG_BACKEND=memory など)
+        return
+
+    def run():
+        try:
+            id_token._fetch_certs(verifier.request, verifier.cookie_verifier.cert_url)
+        except (TransportError, ValueError) as e:
+            logger.warning('session keys: %s', e)
+
+    threading.Thread(target=run, daemon=True).start()
+
+
+def verify_session(cookie: str):
+    """
+    セッションクッキーを検証して claims を返す (検証済みならメモリから)
+    :raise InvalidSession: 無効なクッキー
+    """
+    key = _key(cookie)
+    claims = sessions.get(key)
+    if claims is None:
+        claims = _verify(cookie)
+        sessions.set(key, claims, ttl=min(SESSION_TTL, claims['exp'] - time.time()))
+    return claims
+
+
+def forget(cookie: str):
+    """ ログアウトしたクッキーの検証結果を削除 """
+    sessions.delete(_key(cookie))
+
+
+def _cookie(scope, name: str):
+    for key, value in scope['headers']:
+        if key == b'cookie':
+            for item in value.decode('latin-1').split(';'):
+                k, _, v = item.strip().partition('=')
+                if k == name:
+                    return v.strip('"')
+    return None
+
+
+class AdminAuthMiddleware(object):
+    def __init__(self, app, prefix: str = '/admin', public=(('POST', '/admin'),)):
+        """
+        api.add_middleware(AdminAuthMiddleware) で登録する
+        :param app:    内側のASGIアプリ
+        :param prefix: ログインが必要なパス
+        :param public: ログイン不要な (method, path)  /admin へのPOSTはログインフォーム
+        """
+        self.app = app
+        self.prefix = prefix
+        self.public = set(public)
+
+    def _protected(self, scope):
+        path = scope['path']
+        if path != self.prefix and not path.startswith(self.prefix + '/'):
+            return False
+        return (scope['method'], path) not in self.public
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not self._protected(scope):
+            await self.app(scope, receive, send)
+            return
+
+        cookie = _cookie(scope, COOKIE_NAME)
+        claims = None
+        if cookie:
+            claims = sessions.get(_key(cookie))
+            if claims is None:
+                # 署名の確認と無効化の問い合わせはイベントループを止めないようにスレッドで
+                try:
+                    claims = await asyncio.get_running_loop().run_in_executor(None, verify_session, cookie)
+                except InvalidSession as e:
+                    logger.info('invalid session: %s', e)
+                except exceptions.FirebaseError as e:  # 公開鍵の取得・ユーザの問い合わせの失敗
+                    logger.warning('session verification failed: %s', e)
+
+        if claims is None:
+            headers = [(b'location', LOGIN_URL.encode('latin-1')), (b'content-length', b'0')]
+            if cookie:
+                headers.append((b'set-cookie', '{}=""; Max-Age=0; Path=/'.format(COOKIE_NAME).encode('latin-1')))
+            await send({'type': 'http.response.start', 'status': 303, 'headers': headers})
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+
+        scope.setdefault('state', {})['user'] = claims  # ハンドラからは req.state.user
+        await self.app(scope, receive, send)
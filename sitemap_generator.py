@@ -1,55 +1,352 @@
 """
 Manege Sitemap
+
+記事の追加・更新・削除のたびに全記事を読み直すのではなく，
+変更された記事の <url> だけを差し替えて書き出す．
+URLが MAX_URLS を超える場合は sitemap.xml をサイトマップインデックスにして，
+子サイトマップ(sitemap-N.xml)に分割する．各ファイルは .xml.gz も一緒に書き出す．
+
+配信用の内容は get_sitemap() でメモリに保持し，新しく書き出されたときだけ読み込み直す．
+
+$ python sitemap_generator.py
+で全記事から作り直す
 """
-from models import get_articles
+import glob
+import gzip
+import hashlib
+import os
+import tempfile
+import threading
+import time
+import zlib
 from datetime import datetime
+from email.utils import formatdate
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+from models import get_articles
 
 
 DOMAIN = 'https://sample.com'
 
+SITEMAP_DIR = '.'
+SITEMAP_NAME = 'sitemap.xml'
+MAX_URLS = 50000  # 1ファイルあたりのURL数の上限 (sitemaps.orgの仕様)
+
+CHANGEFREQ = 'monthly'  # 記事の更新頻度
+PRIORITY = 0.7  # 記事の優先度
+
+_NS = '{http://www.sitemaps.org/schemas/sitemap/0.9}'
+
+_lock = threading.Lock()
+_entries = None  # {slug: (category, lastmod)}  書き出し済みの内容
+_num_shards = 1  # 子サイトマップの数 (1なら sitemap.xml だけ)
+_written = {}  # {ファイル名: 書き出した内容}  変更のないファイルは書き直さない
+_mtime = None  # 読み込み・書き出しをした時点の sitemap.xml の更新時刻
+
+SERVE_CHECK_INTERVAL = 1.0  # 配信中のファイルが書き換えられていないか確認する間隔 [s]
+_served = {}  # {ファイル名: Sitemap}  配信用にメモリに保持した内容
+_served_lock = threading.Lock()
+
+
+class Sitemap(object):
+    def __init__(self, body: bytes, gzipped: bytes, mtime_ns: int):
+        """
+        配信用のサイトマップ
+        :param body:     XML
+        :param gzipped:  gzip圧縮したXML
+        :param mtime_ns: ファイルの更新時刻
+        """
+        digest = hashlib.sha1(body).hexdigest()[:20]
+        self.body = body
+        self.gzipped = gzipped
+        self.etag = '"{}"'.format(digest)
+        self.gzip_etag = '"{}-gz"'.format(digest)  # 圧縮した内容は別のETagにする
+        self.mtime = mtime_ns / 1e9
+        self.last_modified = formatdate(self.mtime, usegmt=True)
+        self.mtime_ns = mtime_ns
+        self.checked = time.monotonic()
+
+
+def _loc(category, slug):
+    return '{}/category/{}/{}/'.format(DOMAIN, category, slug)
+
+
+def _shard_name(num):
+    return 'sitemap-{}.xml'.format(num)
+
+
+def _shard_of(slug):
+    """ 記事が入る子サイトマップ (記事が増減しても他の記事の位置は変わらない) """
+    return zlib.crc32(slug.encode()) % _num_shards
+
+
+def _atomic_write(name, data: bytes):
+    """ 一時ファイルに書いてから rename で置き換える (読み込み中のファイルが壊れない) """
+    path = os.path.join(SITEMAP_DIR, name)
+    fd, tmp = tempfile.mkstemp(dir=SITEMAP_DIR, prefix='.' + name, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def _write(name, data: bytes):
+    """ 内容が変わったファイルだけ，.xml と .xml.gz を書き出す """
+    if _written.get(name) == data:
+        return
+
+    gzipped = gzip.compress(data, mtime=0)
+    _atomic_write(name + '.gz', gzipped)
+    _atomic_write(name, data)
+    _written[name] = data
+
+    # 同じプロセスの配信用の内容も差し替える
+    mtime_ns = os.stat(os.path.join(SITEMAP_DIR, name)).st_mtime_ns
+    with _served_lock:
+        _served[name] = Sitemap(data, gzipped, mtime_ns)
+
+
+def _urlset(entries, with_top=False):
+    """ <urlset> を作成 """
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>',
+             '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">']
+    if with_top:
+        lines += ['    <url>',
+                  '        <loc>{}/</loc>'.format(DOMAIN),
+                  '        <lastmod>{}</lastmod>'.format(datetime.now().strftime('%Y-%m-%d')),
+                  '        <changefreq>always</changefreq>',
+                  '        <priority>1.0</priority>',
+                  '    </url>']
+
+    # 新しい順
+    for slug, (category, lastmod) in sorted(entries, key=lambda e: (e[1][1], e[0]), reverse=True):
+        lines += ['    <url>',
+                  '        <loc>{}</loc>'.format(escape(_loc(category, slug))),
+                  '        <lastmod>{}</lastmod>'.format(lastmod),
+                  '        <changefreq>{}</changefreq>'.format(CHANGEFREQ),
+                  '        <priority>{}</priority>'.format(PRIORITY),
+                  '    </url>']
+    lines.append('</urlset>\n')
+    return '\n'.join(lines).encode()
+
+
+def _sitemapindex(names):
+    """ <sitemapindex> を作成 """
+    lastmod = datetime.now().strftime('%Y-%m-%d')
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>',
+             '<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">']
+    for name in names:
+        lines += ['    <sitemap>',
+                  '        <loc>{}/{}</loc>'.format(DOMAIN, name),
+                  '        <lastmod>{}</lastmod>'.format(lastmod),
+                  '    </sitemap>']
+    lines.append('</sitemapindex>\n')
+    return '\n'.join(lines).encode()
+
+
+def _flush(changed_shards=None):
+    """
+    サイトマップを書き出す
+    :param changed_shards: 変更のあった子サイトマップ (Noneなら全て)
+    """
+    global _num_shards, _mtime
+
+    # 上限を超えたら子サイトマップを倍に増やして全て書き直す
+    # (crc32で振り分けるので，偏りを見込んで上限の8割を目安にする)
+    if _num_shards > 1 or len(_entries) + 1 > MAX_URLS:
+        num_shards = max(_num_shards, 2)
+        while len(_entries) + 1 > num_shards * MAX_URLS * 0.8:
+            num_shards *= 2
+        if num_shards != _num_shards:
+            _num_shards = num_shards
+            changed_shards = None
 
-def update_sitemap(changefreq='monthly', priority=0.7):
+    if _num_shards == 1:
+        _write(SITEMAP_NAME, _urlset(_entries.items(), with_top=True))
+        _remove_stale_shards()
+        _mtime = _stat()
+        return
+
+    shards = [[] for _ in range(_num_shards)]
+    for slug, entry in _entries.items():
+        shards[_shard_of(slug)].append((slug, entry))
+
+    names = [_shard_name(i + 1) for i in range(_num_shards)]
+    for i, entries in enumerate(shards):
+        if changed_shards is None or i in changed_shards or i == 0:
+            _write(names[i], _urlset(entries, with_top=(i == 0)))
+    _write(SITEMAP_NAME, _sitemapindex(names))
+    _remove_stale_shards()
+    _mtime = _stat()
+
+
+def _remove_stale_shards():
+    """ 使わなくなった子サイトマップを削除 """
+    for path in glob.glob(os.path.join(SITEMAP_DIR, 'sitemap-*.xml*')):
+        name = os.path.basename(path)
+        num = name[len('sitemap-'):].split('.', 1)[0]
+        if not num.isdigit() or (1 < _num_shards and int(num) <= _num_shards):
+            continue
+        os.unlink(path)
+        _written.pop(name, None)
+        with _served_lock:
+            _served.pop(name, None)
+
+
+def _stat():
+    try:
+        return os.stat(os.path.join(SITEMAP_DIR, SITEMAP_NAME)).st_mtime_ns
+    except OSError:
+        return None
+
+
+def _parse_urlset(path):
+    """ 書き出し済みのサイトマップから記事のURLを読み込む """
+    entries = {}
+    prefix = '{}/category/'.format(DOMAIN)
+    for url in ElementTree.parse(path).getroot().iter(_NS + 'url'):
+        loc = url.findtext(_NS + 'loc', '')
+        if not loc.startswith(prefix):
+            continue
+
+        category, slug = loc[len(prefix):].strip('/').split('/', 1)
+        entries[slug] = (category, url.findtext(_NS + 'lastmod', ''))
+    return entries
+
+
+def _load():
+    """
+    書き出し済みのサイトマップを読み込む
+    :return: 読み込めたら True  (存在しない・壊れている場合は False)
+    """
+    global _entries, _num_shards, _mtime
+
+    path = os.path.join(SITEMAP_DIR, SITEMAP_NAME)
+    mtime = _stat()
+    try:
+        root = ElementTree.parse(path).getroot()
+        if root.tag == _NS + 'sitemapindex':
+            names = [loc.text.rsplit('/', 1)[-1] for loc in root.iter(_NS + 'loc')]
+            entries = {}
+            for name in names:
+                entries.update(_parse_urlset(os.path.join(SITEMAP_DIR, name)))
+            num_shards = len(names)
+        else:
+            entries = _parse_urlset(path)
+            num_shards = 1
+    except (OSError, ElementTree.ParseError, ValueError):
+        return False
+
+    _entries = entries
+    _num_shards = num_shards
+    _mtime = mtime
+    return True
+
+
+def get_sitemap(name: str = SITEMAP_NAME):
     """
-    sitemapを全て更新する
+    配信用のサイトマップを取得
+    メモリに保持し，ファイルが書き換えられたとき(他のプロセスの書き出しを含む)だけ読み込み直す
+    :param name: ファイル名 (sitemap.xml, sitemap-N.xml)
+    :return: Sitemap  (存在しなければ None)
+    """
+    with _served_lock:
+        sitemap = _served.get(name)
+    now = time.monotonic()
+    if sitemap is not None and now - sitemap.checked < SERVE_CHECK_INTERVAL:
+        return sitemap
+
+    path = os.path.join(SITEMAP_DIR, name)
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+        if sitemap is None or sitemap.mtime_ns != mtime_ns:
+            with open(path, 'rb') as f:
+                body = f.read()
+            try:
+                with open(path + '.gz', 'rb') as f:
+                    gzipped = f.read()
+                if gzip.decompress(gzipped) != body:  # 書き出しの途中
+                    raise ValueError
+            except (OSError, ValueError):
+                gzipped = gzip.compress(body, mtime=0)
+            sitemap = Sitemap(body, gzipped, mtime_ns)
+    except OSError:
+        with _served_lock:
+            _served.pop(name, None)
+        return None
+
+    sitemap.checked = now
+    with _served_lock:
+        _served[name] = sitemap
+    return sitemap
+
+
+def rebuild_sitemap():
+    """
+    sitemapを全て作り直す
     カテゴリページは含めない
-    :param changefreq: 記事の更新頻度
-    :param priority: 記事の優先度
-    :return:
     """
+    global _entries, _num_shards
+
     # 公開済みのものだけ取得
-    articles = get_articles(False)
-
-    # URL
-    locs = [
-        '{}/category/{}/{}'.format(DOMAIN, article['category'], article['slug'])
-        for article in articles
-    ]
-
-    # 最終更新日
-    lastmods = [
-        article['last_update'].strftime('%Y-%m-%d')
-        for article in articles
-    ]
-
-    # 上書きする
-    sitemap = open('sitemap.xml', 'w')
-    sitemap.write('<?xml version="1.0" encoding="UTF-8"?>\n')
-    sitemap.write('<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n')
-    sitemap.write('    <url>\n')
-    sitemap.write('        <loc>{}/</loc>\n'.format(DOMAIN))
-    sitemap.write('        <lastmod>{}</lastmod>\n'.format(datetime.now().strftime('%Y-%m-%d')))
-    sitemap.write('        <changefreq>always</changefreq>\n')
-    sitemap.write('        <priority>1.0</priority>\n')
-    sitemap.write('    </url>\n')
-
-    for loc, lastmod in zip(locs, lastmods):
-        sitemap.write('    <url>\n')
-        sitemap.write('        <loc>{}/</loc>\n'.format(loc))
-        sitemap.write('        <lastmod>{}</lastmod>\n'.format(lastmod))
-        sitemap.write('        <changefreq>{}</changefreq>\n'.format(changefreq))
-        sitemap.write('        <priority>{}</priority>\n'.format(priority))
-        sitemap.write('    </url>\n')
-
-    sitemap.write('</urlset>\n')
-    sitemap.close()
+    articles = get_articles(False, fields=('slug', 'category', 'last_update'))
+
+    with _lock:
+        _entries = {
+            article['slug']: (article['category'], article['last_update'].strftime('%Y-%m-%d'))
+            for article in articles
+        }
+        _num_shards = 1
+        _written.clear()
+        _flush()
+
+
+def update_sitemap(articles=(), deleted=(), renamed_categories=None):
+    """
+    変更のあった記事の <url> だけを差し替える
+    サイトマップがまだなければ全て作り直す
+    :param articles:           追加・更新した記事 (slug, category, released, last_update)
+                               公開していない記事はサイトマップから外す
+    :param deleted:            削除した(slugを変更した)記事のslug
+    :param renamed_categories: {変更前のslug: 変更後のslug}  カテゴリのslugの変更
+    """
+    with _lock:
+        # 他のプロセスが書き出していれば読み込み直す
+        if (_entries is None or _mtime != _stat()) and not _load():
+            rebuild = True
+        else:
+            rebuild = False
+            changed = set()
+            for slug in deleted:
+                if _entries.pop(slug, None) is not None:
+                    changed.add(_shard_of(slug))
+
+            for article in articles:
+                slug = article['slug']
+                if article.get('released', True):
+                    last_update = article.get('last_update') or datetime.now()
+                    _entries[slug] = (article['category'], last_update.strftime('%Y-%m-%d'))
+                    changed.add(_shard_of(slug))
+                elif _entries.pop(slug, None) is not None:
+                    changed.add(_shard_of(slug))
+
+            for slug, (category, lastmod) in list(_entries.items()):
+                if renamed_categories and category in renamed_categories:
+                    _entries[slug] = (renamed_categories[category], lastmod)
+                    changed.add(_shard_of(slug))
+
+            if changed:
+                _flush(changed)
+
+    if rebuild:
+        rebuild_sitemap()
+
 
+if __name__ == '__main__':
+    rebuild_sitemap()
+    print('sitemap.xml updated.')
@@ -0,0 +1,37 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ['BLOG_BACKEND'] = 'memory'  # init_db は本物の Firestore に接続しない
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """ 空のメモリ上の Firestore (検索インデックスは一時ディレクトリに作る) """
+    import cache
+    import search
+    from init_db import db
+
+    db.clear()
+    cache.invalidate()
+    index = search.SearchIndex(str(tmp_path / search.INDEX_FILE))
+    monkeypatch.setattr(search, 'index', index)
+    yield db
+    if index._timer is not None:  # 書き出しを待たずに終わる
+        index._timer.cancel()
+
+
+@pytest.fixture
+def add_article(db):
+    """ 記事を作成する関数 (カテゴリ・タグの記事数も増える) """
+    from models import Article
+
+    def add(slug, category='news', tags=(), released=True, title=None, contents='本文'):
+        article = Article(title=title or slug, thumbnail='', contents=contents, description='説明',
+                          author='test', slug=slug, category=category, tags=list(tags), released=released)
+        article.add()
+        return article
+
+    return add
@@ -0,0 +1,51 @@
+"""
+tests/test_cache.py
+読み込みのキャッシュと書き込み時の無効化 (cache.cached / cache.invalidate)
+"""
+import cache
+import models
+
+
+def test_cached_until_invalidated():
+    calls = []
+
+    @cache.cached('test-ns')
+    def read(key):
+        calls.append(key)
+        return len(calls)
+
+    assert read('a') == 1
+    assert read('a') == 1
+    assert read('b') == 2  # 引数ごとに保存する
+
+    cache.invalidate('other-ns')
+    assert read('a') == 1
+
+    cache.invalidate('test-ns')
+    assert read('a') == 3
+
+
+def test_not_cached_when_invalidated_while_reading():
+    calls = []
+
+    @cache.cached('test-ns')
+    def read():
+        calls.append(1)
+        if len(calls) == 1:
+            cache.invalidate('test-ns')  # 読み込み中に書き込まれた
+        return len(calls)
+
+    assert read() == 1  # 古いかもしれない結果は返すだけで保存しない
+    assert read() == 2
+    assert read() == 2
+
+
+def test_write_invalidates_reads(db):
+    models.Category('ニュース', 'news').add()
+    assert [cat['slug'] for cat in models.get_categories()] == ['news']
+
+    models.Category('技術', 'tech').add()
+    assert sorted(cat['slug'] for cat in models.get_categories()) == ['news', 'tech']
+
+    models.delete_category_by_slug('news')
+    assert [cat['slug'] for cat in models.get_categories()] == ['tech']
@@ -0,0 +1,90 @@
+"""
+tests/test_counters.py
+カテゴリ・タグごとの公開済みの記事数 (記事の追加・更新・削除と同じトランザクションで増減する)
+"""
+import asyncio
+
+import pytest
+
+import async_models
+import models
+
+
+@pytest.fixture
+def taxonomy(db):
+    for slug in ('news', 'tech'):
+        models.Category(slug, slug).add()
+    for slug in ('python', 'web', 'db'):
+        models.Tag(slug, slug).add()
+
+
+def _counts(db):
+    return {(collection, doc.id): doc.to_dict().get('count', 0)
+            for collection in ('categories', 'tags') for doc in db.collection(collection).stream()}
+
+
+def _expected(**counts):
+    result = {('categories', slug): 0 for slug in ('news', 'tech')}
+    result.update({('tags', slug): 0 for slug in ('python', 'web', 'db')})
+    for slug, n in counts.items():
+        result[('categories' if slug in ('news', 'tech') else 'tags', slug)] = n
+    return result
+
+
+def test_add_update_delete(db, taxonomy, add_article):
+    add_article('a', category='news', tags=['python', 'web'])
+    add_article('b', category='news', tags=['python'])
+    add_article('draft', category='tech', tags=['db'], released=False)  # 下書きは数えない
+    assert _counts(db) == _expected(news=2, python=2, web=1)
+
+    # カテゴリ・タグの変更
+    models.update_article_by_slug('a', 'a', '', '', 'a', '本文', 'tech', ['web', 'db'], True)
+    assert _counts(db) == _expected(news=1, tech=1, python=1, web=1, db=1)
+
+    # slugの変更では増減しない
+    models.update_article_by_slug('a', 'a', '', '', 'a2', '本文', 'tech', ['web', 'db'], True)
+    assert _counts(db) == _expected(news=1, tech=1, python=1, web=1, db=1)
+
+    # 非公開にする・公開する
+    models.update_article_by_slug('b', 'b', '', '', 'b', '本文', 'news', ['python'], False)
+    assert _counts(db) == _expected(tech=1, web=1, db=1)
+    models.update_article_by_slug('draft', 'draft', '', '', 'draft', '本文', 'tech', ['db'], True)
+    assert _counts(db) == _expected(tech=2, web=1, db=2)
+
+    models.delete_article_by_slug('a2')
+    models.delete_article_by_slug('b')  # 下書きの削除では減らない
+    assert _counts(db) == _expected(tech=1, db=1)
+    assert not models.delete_article_by_slug('b')  # 存在しない記事
+    assert _counts(db) == _expected(tech=1, db=1)
+
+
+def test_async(db, taxonomy):
+    article = models.Article(title='a', thumbnail='', contents='本文', description='', author='test',
+                             slug='a', category='news', tags=['python'], released=True)
+    asyncio.run(async_models.add(article))
+    assert _counts(db) == _expected(news=1, python=1)
+
+    assert asyncio.run(async_models.update_article_by_slug('a', 'a', '', '', 'a', '本文', 'tech', ['web'], True))
+    assert _counts(db) == _expected(tech=1, web=1)
+
+    assert asyncio.run(async_models.delete_article_by_slug('a'))
+    assert _counts(db) == _expected()
+
+
+def test_failed_update_does_not_count(db, taxonomy, add_article):
+    add_article('a', category='news', tags=['python'])
+    add_article('b', category='news')
+
+    with pytest.raises(models.SlugAlreadyExists):  # 移動先のslugが使われている
+        models.update_article_by_slug('a', 'a', '', '', 'b', '本文', 'tech', ['web'], True)
+    assert _counts(db) == _expected(news=2, python=1)
+
+
+def test_recount(db, taxonomy, add_article):
+    add_article('a', category='news', tags=['python'])
+    db.collection('categories').document('news').update({'count': 10})
+    db.collection('tags').document('web').update({'count': 3})
+
+    assert models.recount_articles() > 0
+    assert _counts(db) == _expected(news=1, python=1)
+    assert models.recount_articles() == 0  # 変更のないものは書き込まない
@@ -0,0 +1,98 @@
+"""
+tests/test_metrics.py
+本物の Firestore クライアントに metrics.instrument_firestore() をかけてRPCを記録できるか
+
+gRPC のチャンネルの代わりに transport のメソッドを差し替えるので，ネットワークには接続しない．
+"""
+import asyncio
+
+from google.auth.credentials import AnonymousCredentials
+from google.cloud import firestore
+from google.cloud.firestore_v1.types import document, firestore as firestore_pb
+from google.protobuf import timestamp_pb2
+
+import metrics
+
+PROJECT = 'test-project'
+
+
+def _document(name: str):
+    now = timestamp_pb2.Timestamp(seconds=1)
+    return document.Document(
+        name='projects/{}/databases/(default)/documents/articles/{}'.format(PROJECT, name),
+        fields={'title': document.Value(string_value=name)},
+        create_time=now, update_time=now)
+
+
+def _responses(rpc: str, names):
+    now = timestamp_pb2.Timestamp(seconds=1)
+    if rpc == 'run_query':
+        return [firestore_pb.RunQueryResponse(document=_document(name), read_time=now) for name in names]
+    return [firestore_pb.BatchGetDocumentsResponse(found=_document(name), read_time=now) for name in names]
+
+
+def _stub(client, rpc: str, names, is_async: bool):
+    """ transport の RPC をレスポンスを返すだけの関数にする """
+    transport = client._firestore_api._client._transport if is_async else client._firestore_api._transport
+    method = getattr(transport, rpc)
+    responses = _responses(rpc, names)
+
+    if is_async:
+        async def stream():
+            for response in responses:
+                yield response
+
+        async def call(request, **kwargs):
+            return stream()
+    else:
+        def call(request, **kwargs):
+            return iter(responses)
+
+    transport._wrapped_methods[method] = call
+
+
+def _counts(route: str, rpc: str):
+    return (metrics.firestore_seconds.counts().get((route, rpc), 0),
+            metrics.firestore_documents.values().get((route, rpc), 0))
+
+
+def test_async_client():
+    async def read():
+        # 非同期の transport はイベントループの中で作る (他のテストの asyncio.run() の後はループがない)
+        client = firestore.AsyncClient(project=PROJECT, credentials=AnonymousCredentials())
+        metrics.instrument_firestore(client)
+        _stub(client, 'run_query', ['a', 'b'], True)
+        _stub(client, 'batch_get_documents', ['c'], True)
+
+        token = metrics.current_route.set('/test-async')
+        try:
+            docs = [doc.id async for doc in client.collection('articles').stream()]
+            snapshot = await client.collection('articles').document('c').get()
+            return docs, snapshot
+        finally:
+            metrics.current_route.reset(token)
+
+    docs, snapshot = asyncio.run(read())
+    assert docs == ['a', 'b']
+    assert snapshot.exists and snapshot.get('title') == 'c'
+    assert _counts('/test-async', 'run_query') == (1, 2)
+    assert _counts('/test-async', 'batch_get_documents') == (1, 1)
+
+
+def test_sync_client():
+    client = firestore.Client(project=PROJECT, credentials=AnonymousCredentials())
+    metrics.instrument_firestore(client)
+    _stub(client, 'run_query', ['a', 'b'], False)
+    _stub(client, 'batch_get_documents', ['c'], False)
+
+    token = metrics.current_route.set('/test-sync')
+    try:
+        docs = [doc.id for doc in client.collection('articles').stream()]
+        snapshot = client.collection('articles').document('c').get()
+    finally:
+        metrics.current_route.reset(token)
+
+    assert docs == ['a', 'b']
+    assert snapshot.exists and snapshot.get('title') == 'c'
+    assert _counts('/test-sync', 'run_query') == (1, 2)
+    assert _counts('/test-sync', 'batch_get_documents') == (1, 1)
@@ -0,0 +1,77 @@
+"""
+tests/test_pagination.py
+一覧ページのカーソルによるページ送り (models.get_articles_page・async_models・/ と /category/{category})
+"""
+import asyncio
+
+import pytest
+
+import async_models
+import models
+
+
+@pytest.fixture
+def articles(add_article):
+    """ 新しい順の公開済みの記事のslug (下書き・他のカテゴリの記事も含めて作成) """
+    slugs = []
+    for i in range(7):
+        add_article('article-{}'.format(i), category='news' if i % 2 == 0 else 'tech')
+        slugs.insert(0, 'article-{}'.format(i))
+    add_article('draft', released=False)
+    return slugs
+
+
+def _slugs(page):
+    return [art['slug'] for art in page[0]]
+
+
+def test_next_and_prev(articles):
+    first = models.get_articles_page(3)
+    assert _slugs(first) == articles[:3]
+    assert first[1] is None and first[2] is not None
+
+    second = models.get_articles_page(3, after=first[2])
+    assert _slugs(second) == articles[3:6]
+    assert second[1] is not None and second[2] is not None
+
+    last = models.get_articles_page(3, after=second[2])
+    assert _slugs(last) == articles[6:]
+    assert last[1] is not None and last[2] is None
+
+    back = models.get_articles_page(3, before=second[1])
+    assert _slugs(back) == articles[:3]
+    assert back[1] is None and back[2] == first[2]
+
+
+def test_category(articles):
+    news = [slug for slug in articles if int(slug.split('-')[1]) % 2 == 0]
+    first = models.get_articles_page(2, category='news')
+    assert _slugs(first) == news[:2]
+    second = models.get_articles_page(2, after=first[2], category='news')
+    assert _slugs(second) == news[2:]
+    assert second[2] is None
+
+
+def test_async_matches_sync(articles):
+    first = models.get_articles_page(3)
+    assert asyncio.run(async_models.get_articles_page(3)) == first
+    assert asyncio.run(async_models.get_articles_page(3, after=first[2])) == models.get_articles_page(3, after=first[2])
+
+
+@pytest.mark.parametrize('cursor', ['abc', '-1', '1.5', '', '9' * 30])
+def test_invalid_cursor_is_ignored(articles, cursor):
+    first = models.get_articles_page(3)
+    assert models.get_articles_page(3, after=cursor) == first
+    assert models.get_articles_page(3, before=cursor) == first
+    assert asyncio.run(async_models.get_articles_page(3, after=cursor)) == first
+
+
+@pytest.mark.parametrize('cursor', ['abc', '9' * 30])
+def test_invalid_cursor_in_url(articles, cursor):
+    from controllers import api
+
+    for path in ('/', '/category/news'):
+        for param in ('after', 'before'):
+            res = api.requests.get(path, params={param: cursor})
+            assert res.status_code == 200
+            assert '/news/article-6"' in res.text  # 最初のページ
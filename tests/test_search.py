@@ -0,0 +1,75 @@
+"""
+tests/test_search.py
+検索インデックスの差分更新 (記事の追加・更新・削除) とファイルへの書き出し
+"""
+import pytest
+
+import models
+import search
+
+
+def _found(query: str, index=None):
+    return sorted(art['slug'] for art in (index or search.index).search(query, per_page=100)[0])
+
+
+@pytest.fixture
+def index(db, add_article):
+    """ 記事が2件のインデックス (ファイルに書き出し済み) """
+    add_article('responder', title='Responder入門', contents='Python の Web フレームワーク')
+    add_article('firestore', title='Firestore入門', contents='Python から Firestore を使う')
+    search.index.rebuild()
+    return search.index
+
+
+def test_rebuild(index):
+    assert _found('python') == ['firestore', 'responder']
+    assert _found('responder') == ['responder']
+    assert _found('python firestore') == ['firestore']  # 全ての語を含むもの
+    assert _found('django') == []
+
+
+def test_update_and_remove(index, add_article):
+    add_article('django', title='Django入門', contents='Python の Web フレームワーク')
+    add_article('draft', title='Django下書き', released=False)
+    assert _found('django') == ['django']
+    assert _found('python') == ['django', 'firestore', 'responder']
+
+    # タイトルの変更・slugの変更
+    models.update_article_by_slug('responder', 'Starlette入門', '', '', 'starlette', 'ASGI の Web フレームワーク',
+                                  'news', [], True)
+    assert _found('responder') == []
+    assert _found('starlette') == ['starlette']
+    assert _found('web') == ['django', 'starlette']
+
+    # 非公開にする・削除
+    models.update_article_by_slug('django', 'Django入門', '', '', 'django', '本文', 'news', [], False)
+    models.delete_article_by_slug('firestore')
+    assert _found('django') == []
+    assert _found('python') == []
+
+
+def test_flush(index, add_article):
+    add_article('django', title='Django入門')
+    models.delete_article_by_slug('responder')
+    index.flush()
+
+    reopened = search.SearchIndex(index.path)  # 書き出したファイルだけで検索する
+    assert _found('入門', reopened) == ['django', 'firestore']
+    assert _found('django', reopened) == ['django']
+    assert _found('responder', reopened) == []
+
+
+def test_flush_keeps_other_process_updates(index):
+    other = search.SearchIndex(index.path)  # 同じファイルを使う別のプロセス
+    index.update({'slug': 'a', 'title': 'Alpha', 'released': True})
+    other.update({'slug': 'b', 'title': 'Beta', 'released': True})
+    other.remove('responder')
+    index.flush()
+    other.flush()
+    if other._timer is not None:
+        other._timer.cancel()
+
+    reopened = search.SearchIndex(index.path)
+    assert _found('alpha', reopened) == ['a']
+    assert _found('beta', reopened) == ['b']
+    assert _found('入門', reopened) == ['firestore']
@@ -0,0 +1,110 @@
+"""
+tests/test_sitemap.py
+サイトマップの差分更新・子サイトマップへの分割と，配信(ETag・304)
+"""
+import os
+from datetime import datetime
+
+import pytest
+
+import sitemap_generator
+
+
+@pytest.fixture
+def sitemap(db, add_article, tmp_path, monkeypatch):
+    """ 公開済みの記事が3件のサイトマップ (一時ディレクトリに書き出す) """
+    monkeypatch.setattr(sitemap_generator, 'SITEMAP_DIR', str(tmp_path))
+    monkeypatch.setattr(sitemap_generator, 'SERVE_CHECK_INTERVAL', 0)
+    monkeypatch.setattr(sitemap_generator, '_entries', None)
+    monkeypatch.setattr(sitemap_generator, '_num_shards', 1)
+    monkeypatch.setattr(sitemap_generator, '_written', {})
+    monkeypatch.setattr(sitemap_generator, '_mtime', None)
+    monkeypatch.setattr(sitemap_generator, '_served', {})
+
+    for i in range(3):
+        add_article('article-{}'.format(i))
+    add_article('draft', released=False)
+    sitemap_generator.rebuild_sitemap()
+    return tmp_path
+
+
+def _locs(directory, name='sitemap.xml'):
+    with open(os.path.join(directory, name)) as f:
+        return sorted(line.strip()[len('<loc>'):-len('</loc>')] for line in f if '<loc>' in line)
+
+
+def _article(slug, category='news'):
+    return sitemap_generator.DOMAIN + '/category/{}/{}/'.format(category, slug)
+
+
+def test_rebuild(sitemap):
+    assert _locs(sitemap) == sorted([sitemap_generator.DOMAIN + '/'] + [_article('article-{}'.format(i)) for i in range(3)])
+
+
+def test_update(sitemap):
+    now = datetime.now()
+    sitemap_generator.update_sitemap(articles=[{'slug': 'new', 'category': 'tech', 'last_update': now},
+                                               {'slug': 'article-0', 'category': 'news', 'released': False}],
+                                     deleted=['article-1'])
+    assert _article('new', 'tech') in _locs(sitemap)
+    assert _article('article-0') not in _locs(sitemap)
+    assert _article('article-1') not in _locs(sitemap)
+
+    sitemap_generator.update_sitemap(renamed_categories={'news': 'topics'})
+    assert _article('article-2', 'topics') in _locs(sitemap)
+    assert _article('article-2') not in _locs(sitemap)
+
+
+def test_shards_rewrite_only_changed(sitemap, add_article, monkeypatch):
+    monkeypatch.setattr(sitemap_generator, 'MAX_URLS', 4)
+    for i in range(3, 10):
+        add_article('article-{}'.format(i))
+    sitemap_generator.rebuild_sitemap()
+
+    shards = sorted(name for name in os.listdir(sitemap) if name.startswith('sitemap-') and name.endswith('.xml'))
+    assert len(shards) > 1
+    assert sorted(loc for name in shards for loc in _locs(sitemap, name)) == \
+        sorted([sitemap_generator.DOMAIN + '/'] + [_article('article-{}'.format(i)) for i in range(10)])
+
+    # 1件の更新では，その記事の子サイトマップ(とトップを含む1つ目)だけを書き直す
+    mtimes = {name: os.stat(os.path.join(sitemap, name)).st_mtime_ns for name in shards}
+    sitemap_generator.update_sitemap(articles=[{'slug': 'article-5', 'category': 'tech', 'last_update': datetime.now()}])
+    target = sitemap_generator._shard_name(sitemap_generator._shard_of('article-5') + 1)
+    changed = {name for name in shards if os.stat(os.path.join(sitemap, name)).st_mtime_ns != mtimes[name]}
+    assert target in changed
+    assert changed <= {target, shards[0]}
+    assert _article('article-5', 'tech') in _locs(sitemap, target)
+
+
+def test_etag(sitemap):
+    from controllers import api
+
+    for encoding in ('gzip', 'identity'):
+        headers = {'Accept-Encoding': encoding}
+        res = api.requests.get('/sitemap.xml', headers=headers)
+        assert res.status_code == 200
+        etag = res.headers['ETag']
+
+        for if_none_match in (etag, 'W/' + etag, '"other", ' + etag, '*'):
+            res = api.requests.get('/sitemap.xml', headers=dict(headers, **{'If-None-Match': if_none_match}))
+            assert res.status_code == 304
+        assert api.requests.get('/sitemap.xml', headers=dict(headers, **{'If-None-Match': '"other"'})).status_code == 200
+
+        res = api.requests.get('/sitemap.xml', headers=dict(headers, **{'If-Modified-Since': res.headers['Last-Modified']}))
+        assert res.status_code == 304
+
+    # 更新したら古いETagでは 304 にならない
+    res = api.requests.get('/sitemap.xml')
+    etag = res.headers['ETag']
+    sitemap_generator.update_sitemap(articles=[{'slug': 'new', 'category': 'news', 'last_update': datetime.now()}])
+    res = api.requests.get('/sitemap.xml', headers={'If-None-Match': etag})
+    assert res.status_code == 200
+    assert res.headers['ETag'] != etag
+    assert _article('new').encode() in res.content
+
+
+def test_not_found(sitemap):
+    from controllers import api
+
+    assert api.requests.get('/sitemap-1.xml').status_code == 404
+    assert api.requests.get('/sitemap-x.xml').status_code == 404